@@ -0,0 +1,54 @@
+"""
+Compares scanning a message with one regex per censor config against a single
+MultiMatcher built from the blocklists of all configs.
+
+    python benchmarks/censor.py [configs] [words per config] [messages]
+"""
+import re
+import sys
+import time
+import random
+import string
+
+from rowboat.util.matcher import MultiMatcher
+
+
+def random_word(rand):
+    return u''.join(rand.choice(string.ascii_lowercase) for _ in range(rand.randint(4, 10)))
+
+
+def main(configs=3, words=5000, messages=2000):
+    rand = random.Random(0)
+    blocklists = [[random_word(rand) for _ in range(words)] for _ in range(configs)]
+    corpus = [
+        u' '.join(random_word(rand) for _ in range(rand.randint(5, 40)))
+        for _ in range(messages)
+    ]
+
+    start = time.time()
+    regexes = [re.compile(u'({})'.format(u'|'.join(
+        u'\\b{}\\b'.format(re.escape(word)) for word in blocklist)), re.I) for blocklist in blocklists]
+    regex_build = time.time() - start
+
+    start = time.time()
+    matcher = MultiMatcher([(word, idx, True) for idx, blocklist in enumerate(blocklists) for word in blocklist])
+    matcher_build = time.time() - start
+
+    start = time.time()
+    for content in corpus:
+        for regex in regexes:
+            regex.findall(content)
+    regex_scan = time.time() - start
+
+    start = time.time()
+    for content in corpus:
+        matcher.search(content)
+    matcher_scan = time.time() - start
+
+    print('{} configs of {} words, {} messages'.format(configs, words, messages))
+    print('  regex    build {:>8.1f}ms  scan {:>8.3f}ms/msg'.format(regex_build * 1000, regex_scan * 1000 / messages))
+    print('  matcher  build {:>8.1f}ms  scan {:>8.3f}ms/msg'.format(matcher_build * 1000, matcher_scan * 1000 / messages))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:4]))
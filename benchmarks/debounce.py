@@ -0,0 +1,104 @@
+"""
+Compares the modlog debounces kept in per (guild, event) lists against the
+indexed `DebouncesCollection` during a mass ban (every banned user gets a
+debounce which is found by the following ban and member remove events) and a
+mass role change (one role debounce per member, found by the member updates).
+
+    python benchmarks/debounce.py [members...]
+"""
+import sys
+import time
+import random
+
+from collections import defaultdict
+
+from rowboat.plugins.modlog.core import Debounce, DebouncesCollection
+
+GUILD_ID = 157733188964188160
+ROLE_ID = 232920279722967040
+
+
+class GuildBanAdd(object):
+    def __init__(self, user_id):
+        self.guild_id = GUILD_ID
+        self.user_id = user_id
+
+
+class GuildMemberRemove(GuildBanAdd):
+    pass
+
+
+class GuildMemberUpdate(GuildBanAdd):
+    pass
+
+
+class ListDebounces(object):
+    def __init__(self):
+        self._data = defaultdict(lambda: defaultdict(list))
+
+    def add(self, obj):
+        for event_name in obj.events:
+            self._data[obj.guild_id][event_name].append(obj)
+
+    def remove(self, obj, event=None):
+        for event_name in ([event] if event else list(obj.events)):
+            if event_name in obj.events:
+                obj.events.remove(event_name)
+
+            if obj in self._data[obj.guild_id][event_name]:
+                self._data[obj.guild_id][event_name].remove(obj)
+
+    def find(self, event, delete=True, **kwargs):
+        for obj in self._data[event.guild_id][event.__class__.__name__]:
+            if obj.is_expired():
+                obj.remove()
+                continue
+
+            if any(k not in kwargs or kwargs[k] != v for k, v in obj.selector.items()):
+                continue
+
+            if delete:
+                obj.remove(event=event.__class__.__name__)
+            return obj
+
+
+def mass_ban(collection, members):
+    for user_id in range(members):
+        collection.add(Debounce(collection, GUILD_ID, {'user_id': user_id}, ['GuildBanAdd', 'GuildMemberRemove']))
+
+    # The gateway events don't arrive in the order the bans were issued
+    user_ids = range(members)
+    random.Random(0).shuffle(user_ids)
+
+    for user_id in user_ids:
+        assert collection.find(GuildBanAdd(user_id), user_id=user_id)
+        assert collection.find(GuildMemberRemove(user_id), user_id=user_id)
+
+
+def mass_role(collection, members):
+    for _ in range(members):
+        collection.add(Debounce(collection, GUILD_ID, {'role_id': ROLE_ID}, ['GuildMemberUpdate']))
+
+    for user_id in range(members):
+        event = GuildMemberUpdate(user_id)
+        assert not collection.find(event, user_id=user_id)
+        assert collection.find(event, user_id=user_id, role_id=ROLE_ID)
+
+
+def main(*sizes):
+    for scenario in (mass_ban, mass_role):
+        print(scenario.__name__)
+
+        for members in (sizes or (100, 1000, 5000)):
+            results = []
+            for cls in (ListDebounces, DebouncesCollection):
+                start = time.time()
+                scenario(cls(), members)
+                results.append(((time.time() - start) / members) * 1000000)
+
+            print('  {:>6} members  lists {:>10.3f}us/member  indexed {:>10.3f}us/member'.format(
+                members, *results))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,76 @@
+"""
+Replays a mixed stream of messages (mostly chatter, some commands) through the
+CommandIndex and through a linear scan of every command regex, which is what
+`Bot.get_commands_for_message` does.
+
+    python benchmarks/dispatch.py [commands] [messages] [command ratio]
+"""
+import re
+import sys
+import time
+import random
+import string
+
+from collections import namedtuple
+
+from rowboat.util.dispatch import CommandIndex
+
+FakeCommand = namedtuple('FakeCommand', ('triggers', 'group', 'compiled_regex'))
+
+
+def random_word(rand):
+    return u''.join(rand.choice(string.ascii_lowercase) for _ in range(rand.randint(3, 9)))
+
+
+def linear(commands, prefix, content):
+    if not content.startswith(prefix):
+        return []
+
+    content = content[len(prefix):]
+    return sorted([
+        (command, command.compiled_regex.match(content)) for command in commands
+        if command.compiled_regex.match(content)
+    ], key=lambda obj: obj[0].group is None)
+
+
+def main(count=150, messages=100000, ratio=0.01):
+    rand = random.Random(0)
+
+    commands = []
+    for _ in range(count):
+        group = random_word(rand) if rand.random() < 0.5 else None
+        trigger = random_word(rand)
+        regex = re.compile(u'^{}({})( (.*)$|$)'.format(group + u' ' if group else u'', trigger), re.I)
+        commands.append(FakeCommand([trigger], group, regex))
+
+    stream = []
+    for _ in range(messages):
+        if rand.random() < ratio:
+            command = rand.choice(commands)
+            stream.append(u'!{}{} {}'.format(
+                command.group + u' ' if command.group else u'', command.triggers[0], random_word(rand)))
+        else:
+            stream.append(u' '.join(random_word(rand) for _ in range(rand.randint(1, 20))))
+
+    index = CommandIndex(commands)
+
+    for name, mode in (('prefix', u'!'), ('no prefix', u'')):
+        start = time.time()
+        for content in stream:
+            linear(commands, mode, content)
+        linear_time = time.time() - start
+
+        start = time.time()
+        for content in stream:
+            if mode and not content.startswith(mode):
+                continue
+            index.match(content[len(mode):])
+        index_time = time.time() - start
+
+        print('{} ({} commands, {} messages)'.format(name, count, messages))
+        print('  linear {:>8.2f}us/msg'.format(linear_time * 1000000 / messages))
+        print('  index  {:>8.2f}us/msg'.format(index_time * 1000000 / messages))
+
+
+if __name__ == '__main__':
+    main(*[cast(arg) for cast, arg in zip((int, int, float), sys.argv[1:4])])
@@ -0,0 +1,39 @@
+"""
+Compares the sorted set backed `LeakyBucket` against `WeightedLeakyBucket` for
+weighted increments, reporting time per call and the redis memory per key.
+
+    python benchmarks/leakybucket.py [calls] [weight]
+"""
+import sys
+import time
+
+from rowboat.redis import rdb
+from rowboat.util.leakybucket import LeakyBucket, WeightedLeakyBucket
+
+
+def bench(bucket, key, calls, weight):
+    bucket.clear(key)
+
+    start = time.time()
+    for _ in range(calls):
+        bucket.incr(key, weight)
+    duration = time.time() - start
+
+    name = bucket.key_fmt.format(key)
+    memory = int(rdb.debug_object(name)['serializedlength'])
+    return duration, memory
+
+
+def main(calls=1000, weight=200):
+    print('{} calls with a weight of {}'.format(calls, weight))
+
+    for cls in (LeakyBucket, WeightedLeakyBucket):
+        bucket = cls(rdb, 'BENCH:{}:{}'.format(cls.__name__, '{}'), calls * weight, 60000)
+        duration, memory = bench(bucket, 'bench', calls, weight)
+        print('  {:<20} {:>8.3f}ms/call {:>10} bytes/key'.format(
+            cls.__name__, (duration / calls) * 1000, memory))
+        bucket.clear('bench')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:3]))
@@ -0,0 +1,81 @@
+"""
+Compares rendering a stream of modlog actions with a `string.Formatter` per
+subscribed channel against precompiled templates rendered once per action,
+with only the timestamp prefix applied per distinct channel config. The
+stream is generated randomly from the actions in `data/actions_simple.yaml`,
+with every field resolving to a placeholder object.
+
+    python benchmarks/modlog.py [actions] [channels] [distinct configs]
+"""
+import sys
+import time
+import random
+import string
+
+from disco.util.sanitize import S
+
+from rowboat.util import ordered_load
+from rowboat.util.templates import Template
+
+
+class Placeholder(object):
+    def __getattr__(self, name):
+        return self
+
+    def __getitem__(self, key):
+        return self
+
+    def __unicode__(self):
+        return u'placeholder <@80351110224678912> `code`'
+
+
+class Formatter(string.Formatter):
+    def convert_field(self, value, conversion):
+        if conversion in ('z', 's'):
+            return S(unicode(value), escape_codeblocks=True)
+        return unicode(value)
+
+
+def convert_field(value, conversion):
+    if conversion in ('z', 's'):
+        return S(unicode(value), escape_codeblocks=True)
+    return unicode(value)
+
+
+def main(actions=10000, channels=4, configs=2):
+    with open('data/actions_simple.yaml') as f:
+        simple = ordered_load(f.read())
+
+    rand = random.Random(0)
+    names = list(simple.keys())
+    stream = [rand.choice(names) for _ in range(actions)]
+
+    # Every field of every format resolves to the placeholder
+    details = {}
+    for info in simple.values():
+        for _, field, _, _ in string.Formatter().parse(info['format']):
+            if field:
+                details[field.split('.')[0].split('[')[0]] = Placeholder()
+
+    fmt = Formatter()
+    start = time.time()
+    for action in stream:
+        for _ in range(channels):
+            fmt.format(unicode(simple[action]['format']), **details)
+    formatter = time.time() - start
+
+    start = time.time()
+    templates = {k: Template(v['format'], convert=convert_field) for k, v in simple.items()}
+    for action in stream:
+        base = templates[action].render(**details)
+        for _ in range(configs):
+            u'`[00:00:00]` ' + base
+    compiled = time.time() - start
+
+    print('{} actions to {} channels ({} distinct configs)'.format(actions, channels, configs))
+    print('  {:<12} {:>10.3f}us/action'.format('formatter', (formatter / actions) * 1000000))
+    print('  {:<12} {:>10.3f}us/action'.format('compiled', (compiled / actions) * 1000000))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:4]))
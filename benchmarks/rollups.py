@@ -0,0 +1,64 @@
+"""
+Compares the latency of the guild message stats query against the raw
+messages table with the same series read from the message rollups.
+
+    python benchmarks/rollups.py <guild id> [unit] [amount] [runs]
+"""
+import sys
+import time
+
+from rowboat import ENV
+from rowboat.sql import init_db, database
+from rowboat.models.message import MessageRollup
+
+RAW_SQL = '''
+    SELECT date, coalesce(count, 0) AS count
+    FROM
+        generate_series(
+            date_trunc(%s, NOW()) - interval %s,
+            date_trunc(%s, NOW()),
+            %s
+        ) AS date
+    LEFT OUTER JOIN (
+        SELECT date_trunc(%s, timestamp) AS dt, count(*) AS count
+        FROM messages
+        WHERE
+            timestamp >= (date_trunc(%s, NOW()) - interval %s) AND
+            guild_id=%s
+        GROUP BY dt
+    ) results
+    ON (date = results.dt);
+'''
+
+
+def raw_series(guild_id, unit, amount):
+    _, trunc = MessageRollup.UNITS[unit]
+    span = '{} {}'.format(amount, unit)
+    return list(database.execute_sql(
+        RAW_SQL, (trunc, span, trunc, '1 {}'.format(trunc), trunc, trunc, span, guild_id)).fetchall())
+
+
+def bench(func, runs, *args):
+    start = time.time()
+    for _ in range(runs):
+        result = func(*args)
+    return (time.time() - start) / runs, result
+
+
+def main(guild_id, unit='days', amount=7, runs=10):
+    init_db(ENV)
+
+    raw, raw_result = bench(raw_series, runs, guild_id, unit, amount)
+    rollup, rollup_result = bench(MessageRollup.series, runs, guild_id, unit, amount)
+
+    print('{} {} for guild {}, {} runs'.format(amount, unit, guild_id, runs))
+    print('  {:<8} {:>10.3f}ms/query'.format('raw', raw * 1000))
+    print('  {:<8} {:>10.3f}ms/query'.format('rollups', rollup * 1000))
+
+    if [i[1] for i in raw_result] != [i[1] for i in rollup_result]:
+        print('  counts differ, run `manage.py rollup-backfill` first')
+
+
+if __name__ == '__main__':
+    casts = (int, str, int, int)
+    main(*[cast(arg) for cast, arg in zip(casts, sys.argv[1:5])])
@@ -107,12 +107,63 @@ def workers(worker_id):
 def add_global_admin(user_id):
     from rowboat.redis import rdb
     from rowboat.models.user import User
+    from rowboat.util.redis import RedisSet
     init_db(ENV)
+
+    # Published like a RedisSet change so running bots pick it up
     rdb.sadd('global_admins', user_id)
+    rdb.publish(RedisSet.channel_fmt.format('global_admins'), u'A{}'.format(user_id))
+
     User.update(admin=True).where(User.user_id == user_id).execute()
     print 'Ok, added {} as a global admin'.format(user_id)
 
 
+@cli.command('rollup-backfill')
+@click.option('--days', '-d', default=30)
+@click.option('--guild-id', '-g', default=None)
+def rollup_backfill(days, guild_id):
+    from datetime import datetime, timedelta
+    from rowboat.models.message import MessageRollup
+    init_db(ENV)
+
+    # Rebuilt one day at a time to keep each transaction small
+    end = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    for _ in range(days):
+        start = end - timedelta(days=1)
+        MessageRollup.rebuild(start, end, guild_id=guild_id)
+        print 'Rebuilt rollups for {}'.format(start.date())
+        end = start
+
+
+@cli.command('replay-events')
+@click.option('--event', '-e', multiple=True, help='only replay these event types')
+@click.option('--session', '-s', default=None)
+@click.option('--limit', '-l', default=10000)
+def replay_events(event, session, limit):
+    import time
+    from collections import defaultdict
+    from disco.gateway.events import GatewayEvent
+    from rowboat.tasks import get_client
+    from rowboat.models.event import Event
+    init_db(ENV)
+
+    # The client is never connected, events go through its state handlers which
+    #  are called inline (instead of spawned) so they can be timed.
+    client = get_client()
+    client.events.wrapper = None
+    timings = defaultdict(list)
+
+    for packet in Event.replay(event, session, limit):
+        start = time.time()
+        obj = GatewayEvent.from_dispatch(client, packet)
+        client.events.emit(obj.__class__.__name__, obj)
+        timings[packet['t']].append(time.time() - start)
+
+    for name, durations in sorted(timings.items(), key=lambda i: -sum(i[1])):
+        print '{:<30} {:>8} events {:>10.3f}ms total {:>8.3f}ms/event'.format(
+            name, len(durations), sum(durations) * 1000, (sum(durations) / len(durations)) * 1000)
+
+
 @cli.command('wh-add')
 @click.argument('guild-id')
 @click.argument('flag')
@@ -30,12 +30,74 @@ ROWBOAT_USER_ROLE_ID = 339256926921555968
 ROWBOAT_CONTROL_CHANNEL = 290924692057882635
 
 # Discord Error codes
+ERR_UNKNOWN_INVITE = 10006
 ERR_UNKNOWN_MESSAGE = 10008
 
 # Etc
 YEAR_IN_SEC = 60 * 60 * 24 * 365
 CDN_URL = 'https://twemoji.maxcdn.com/2/72x72/{}.png'
 
+# Tunables (can be overridden by `constants` in the config)
+SQL_MESSAGE_BUFFER_INTERVAL = 0.5
+SQL_MESSAGE_BUFFER_ROWS = 500
+SQL_MESSAGE_BUFFER_MAX_PENDING = 10000
+
+# Presence driven user updates are merged per user and flushed in batches
+SQL_USER_UPDATE_INTERVAL = 15
+SQL_USER_UPDATE_BATCH_SIZE = 1000
+SQL_USER_UPDATE_MAX_PENDING = 50000
+
+# Command audit records are buffered and dropped once too many are pending
+COMMAND_BUFFER_INTERVAL = 2
+COMMAND_BUFFER_MAX_PENDING = 5000
+
+# Store spam rate limits in redis, required when running multiple bot processes
+SPAM_RATELIMIT_REDIS = False
+
+# Number of recent messages kept per guild and per user for duplicate detection
+SPAM_RECENT_MESSAGES = 50
+SPAM_RECENT_USERS = 100000
+
+# Invite lookups cached by the censor, invalid invites are cached for less time
+INVITE_CACHE_SIZE = 10000
+INVITE_CACHE_TTL = 43200
+INVITE_CACHE_NEGATIVE_TTL = 300
+
+# Number of members per guild whose resolved level is cached
+LEVEL_CACHE_SIZE = 10000
+
+# Number of parsed guild configs kept in memory
+CONFIG_REGISTRY_SIZE = 10000
+
+# Reddit polling, posts are fetched concurrently and sent through a queue
+REDDIT_BASE_URL = 'https://www.reddit.com'
+REDDIT_FETCH_CONCURRENCY = 8
+REDDIT_SEND_QUEUE_SIZE = 1000
+REDDIT_MAX_POSTS = 10
+
+# Tracked gateway events are copied into the events table in batches
+EVENTS_BUFFER_INTERVAL = 1
+EVENTS_BUFFER_ROWS = 2000
+EVENTS_BUFFER_MAX_PENDING = 20000
+EVENTS_RETENTION_HOURS = 24
+
+# Modlog delivery, messages per channel are limited to a bucket of size per period
+#  and lines are additionally packed into an embed once the backlog reaches a size.
+MODLOG_BUCKET_SIZE = 5
+MODLOG_BUCKET_PERIOD = 5
+MODLOG_SEND_CONCURRENCY = 16
+MODLOG_EMBED_BACKLOG = 20
+MODLOG_BUFFER_SIZE = 5000
+
+# Word counts skip the words listed in this file, set to None to count every word
+WORDS_STOP_WORDS_FILE = 'data/stopwords.txt'
+
+# Number of days `words top` sums counts over
+WORDS_TOP_DAYS = 30
+
+# Parse message searches with websearch_to_tsquery (quotes, OR, -word), requires postgres 11
+SEARCH_WEBSEARCH_QUERIES = False
+
 # Loaded from files
 with open('data/badwords.txt', 'r') as f:
     BAD_WORDS = f.readlines()
@@ -1,10 +1,28 @@
+import csv
+import json
+
+from cStringIO import StringIO
 from peewee import (
     BigIntegerField, CharField, DateTimeField, CompositeKey
 )
 from datetime import datetime, timedelta
-from playhouse.postgres_ext import BinaryJSONField
+from playhouse.postgres_ext import BinaryJSONField, ServerSide
+
+from rowboat.sql import BaseModel, database
+
+# Rows are copied into a staging table first, so replayed (duplicate) packets
+#  after a resume don't fail the whole batch.
+EVENTS_STAGING_SQL = '''
+    CREATE TEMP TABLE IF NOT EXISTS events_staging (LIKE events) ON COMMIT DELETE ROWS
+'''
+
+EVENTS_COPY_SQL = '''
+    COPY events_staging (session, seq, timestamp, event, data) FROM STDIN WITH (FORMAT csv)
+'''
 
-from rowboat.sql import BaseModel
+EVENTS_MERGE_SQL = '''
+    INSERT INTO events SELECT * FROM events_staging ON CONFLICT DO NOTHING
+'''
 
 
 @BaseModel.register
@@ -39,3 +57,50 @@ class Event(BaseModel):
             'event': event['t'],
             'data': event['d'],
         }
+
+    @classmethod
+    def copy_many(cls, events):
+        """
+        Bulk inserts a list of prepared events through COPY, which avoids
+        building a single huge INSERT statement for large packets.
+        """
+        if not events:
+            return
+
+        buff = StringIO()
+        writer = csv.writer(buff)
+        for event in events:
+            writer.writerow([
+                event['session'],
+                event['seq'],
+                event['timestamp'].isoformat(),
+                event['event'],
+                json.dumps(event['data']),
+            ])
+        buff.seek(0)
+
+        with database.atomic():
+            cursor = database.get_cursor()
+            cursor.execute(EVENTS_STAGING_SQL)
+            cursor.copy_expert(EVENTS_COPY_SQL, buff)
+            cursor.execute(EVENTS_MERGE_SQL)
+
+    @classmethod
+    def replay(cls, events=None, session=None, limit=None):
+        """
+        Iterates captured packets in the order they were received, in the
+        same form as they arrived over the gateway.
+        """
+        q = cls.select().order_by(cls.timestamp, cls.seq)
+
+        if events:
+            q = q.where((cls.event << list(events)))
+
+        if session:
+            q = q.where((cls.session == session))
+
+        if limit:
+            q = q.limit(limit)
+
+        for event in ServerSide(q):
+            yield {'t': event.event, 's': event.seq, 'd': event.data}
@@ -1,4 +1,7 @@
+import json
+import time
 import yaml
+import xxhash
 import logging
 
 from peewee import (
@@ -11,10 +14,60 @@ from playhouse.postgres_ext import BinaryJSONField, ArrayField
 from rowboat.sql import BaseModel
 from rowboat.redis import emit
 from rowboat.models.user import User
+from rowboat.util.lru import LRUCache
+from rowboat.util.stats import statsd
+from rowboat.constants import CONFIG_REGISTRY_SIZE
 
 log = logging.getLogger(__name__)
 
 
+def config_hash(config_raw, config):
+    """
+    Returns a content hash for a guild config, preferring the raw YAML and
+    falling back to the canonical JSON for guilds which never had it set.
+    """
+    if config_raw:
+        data = config_raw.encode('utf-8') if isinstance(config_raw, unicode) else str(config_raw)
+    else:
+        data = json.dumps(config, sort_keys=True)
+    return xxhash.xxh64(data).hexdigest()
+
+
+class ConfigRegistry(object):
+    """
+    Holds parsed `GuildConfig` objects keyed by guild and config
+    hash, so a config is only ever parsed once per process no matter how many
+    times (or from where) it's loaded.
+    """
+    def __init__(self, max_size):
+        self._configs = LRUCache(max_size)
+
+    def __len__(self):
+        return len(self._configs)
+
+    def get(self, guild_id, config_hash, config):
+        from rowboat.types.guild import GuildConfig
+
+        key = (guild_id, config_hash)
+        parsed = self._configs.get(key)
+        if parsed is not None:
+            statsd.increment('rowboat.config.cache.hit')
+            return parsed
+
+        statsd.increment('rowboat.config.cache.miss')
+
+        start = time.time()
+        parsed = GuildConfig(config)
+        statsd.timing('rowboat.config.parse', (time.time() - start) * 1000)
+
+        self._configs.set(key, parsed)
+        statsd.gauge('rowboat.config.cache.size', len(self._configs))
+        return parsed
+
+
+CONFIG_REGISTRY = ConfigRegistry(CONFIG_REGISTRY_SIZE)
+
+
 @BaseModel.register
 class Guild(BaseModel):
     WhitelistFlags = Enum(
@@ -71,10 +124,9 @@ class Guild(BaseModel):
         return int(flag) in self.whitelist
 
     def update_config(self, actor_id, raw):
-        from rowboat.types.guild import GuildConfig
-
         parsed = yaml.load(raw)
-        GuildConfig(parsed).validate()
+        new_hash = config_hash(raw, parsed)
+        CONFIG_REGISTRY.get(self.guild_id, new_hash, parsed).validate()
 
         GuildConfigChange.create(
             user_id=actor_id,
@@ -83,7 +135,7 @@ class Guild(BaseModel):
             after_raw=raw)
 
         self.update(config=parsed, config_raw=raw).where(Guild.guild_id == self.guild_id).execute()
-        self.emit('GUILD_UPDATE')
+        self.emit('GUILD_UPDATE', hash=new_hash)
 
     def emit(self, action, **kwargs):
         emit(action, id=self.guild_id, **kwargs)
@@ -98,15 +150,19 @@ class Guild(BaseModel):
         if updates:
             Guild.update(**updates).where(Guild.guild_id == self.guild_id).execute()
 
-    def get_config(self, refresh=False):
-        from rowboat.types.guild import GuildConfig
+    @property
+    def config_hash(self):
+        return config_hash(self.config_raw, self.config)
 
+    def get_config(self, refresh=False):
         if refresh:
-            self.config = Guild.select(Guild.config).where(Guild.guild_id == self.guild_id).get().config
+            self.config, self.config_raw = Guild.select(
+                Guild.config, Guild.config_raw
+            ).where(Guild.guild_id == self.guild_id).tuples().get()
 
         if refresh or not hasattr(self, '_cached_config'):
             try:
-                self._cached_config = GuildConfig(self.config)
+                self._cached_config = CONFIG_REGISTRY.get(self.guild_id, self.config_hash, self.config)
             except:
                 log.exception('Failed to load config for Guild %s, invalid: ', self.guild_id)
                 return None
@@ -2,23 +2,154 @@ import re
 import six
 import json
 import uuid
+import hashlib
 import traceback
 
+from collections import OrderedDict, Counter
 from peewee import (
-    BigIntegerField, ForeignKeyField, TextField, DateTimeField,
-    BooleanField, UUIDField
+    BigIntegerField, ForeignKeyField, TextField, DateTimeField, DateField,
+    BooleanField, UUIDField, CompositeKey, IntegerField, SQL, fn
 )
 from datetime import datetime, timedelta
-from playhouse.postgres_ext import BinaryJSONField, ArrayField
+from playhouse.postgres_ext import BinaryJSONField, ArrayField, ServerSide
 from disco.types.base import UNSET
 
 from rowboat import REV
 from rowboat.util import default_json
+from rowboat.util.stats import timed
+from rowboat.util.tokenize import load_stop_words, tokenize
+from rowboat.constants import WORDS_STOP_WORDS_FILE, WORDS_TOP_DAYS, SEARCH_WEBSEARCH_QUERIES
 from rowboat.models.user import User
-from rowboat.sql import BaseModel
+from rowboat.sql import BaseModel, database
 
 EMOJI_RE = re.compile(r'<:.+:([0-9]+)>')
 
+STOP_WORDS = load_stop_words(WORDS_STOP_WORDS_FILE)
+
+# Columns which are left as NULL in an update are kept as-is
+UPDATE_MANY_SQL = '''
+    UPDATE messages SET
+        edited_timestamp = v.edited_timestamp,
+        num_edits = messages.num_edits + v.edits,
+        mentions = v.mentions,
+        content = COALESCE(v.content, messages.content),
+        emojis = COALESCE(v.emojis, messages.emojis),
+        attachments = COALESCE(v.attachments, messages.attachments),
+        embeds = COALESCE(v.embeds, messages.embeds)
+    FROM (VALUES {}) AS v(id, edited_timestamp, edits, mentions, content, emojis, attachments, embeds)
+    WHERE messages.id = v.id
+'''
+
+UPDATE_MANY_ROW = '(%s::bigint, %s::timestamp, %s::integer, %s::bigint[], %s::text, %s::bigint[], %s::text[], %s::jsonb)'
+
+# Counts messages into every rollup period, {} is the WHERE clause and {} the conflict action
+ROLLUP_SQL = '''
+    INSERT INTO message_rollups (period, guild_id, bucket, channel_id, author_id, count)
+    SELECT p.period, m.guild_id, date_trunc(p.period, m.timestamp), m.channel_id, m.author_id, count(*)
+    FROM messages m
+    CROSS JOIN (VALUES ('hour'), ('day')) AS p(period)
+    WHERE m.guild_id IS NOT NULL AND {}
+    GROUP BY 1, 2, 3, 4, 5
+    ON CONFLICT (period, guild_id, bucket, channel_id, author_id) DO UPDATE SET count = {}
+'''
+
+ROLLUP_SERIES_SQL = '''
+    SELECT date, coalesce(count, 0) AS count
+    FROM
+        generate_series(
+            date_trunc(%s, NOW()) - interval %s,
+            date_trunc(%s, NOW()),
+            %s
+        ) AS date
+    LEFT OUTER JOIN (
+        SELECT date_trunc(%s, bucket) AS dt, sum(count)::bigint AS count
+        FROM message_rollups
+        WHERE
+            period=%s AND
+            guild_id=%s AND
+            bucket >= (date_trunc(%s, NOW()) - interval %s) {}
+        GROUP BY dt
+    ) results
+    ON (date = results.dt);
+'''
+
+# Uses the messages_content_fts index, {} is the tsquery function and {} additional filters
+MESSAGE_SEARCH_SQL = '''
+    SELECT
+        r.id, r.channel_id, r.author_id, u.username, u.discriminator, r.timestamp, r.deleted,
+        ts_headline('english', r.content, r.query, %s) AS headline
+    FROM (
+        SELECT m.id, m.channel_id, m.author_id, m.timestamp, m.deleted, m.content, q.query
+        FROM messages m, {}('english', %s) AS q(query)
+        WHERE
+            to_tsvector('english', m.content) @@ q.query AND
+            m.guild_id = %s {}
+        ORDER BY m.timestamp DESC, m.id DESC
+        LIMIT %s
+    ) r
+    JOIN users u ON (u.user_id = r.author_id)
+    ORDER BY r.timestamp DESC, r.id DESC;
+'''
+
+MESSAGE_SEARCH_CURSOR_FMT = '%Y%m%d%H%M%S%f'
+
+STARBOARD_CLEAN_SQL = '''
+    UPDATE starboard_entries SET
+        dirty = false,
+        star_channel_id = v.star_channel_id,
+        star_message_id = v.star_message_id
+    FROM (VALUES {}) AS v(message_id, star_channel_id, star_message_id)
+    WHERE starboard_entries.message_id = v.message_id
+'''
+
+STARBOARD_CLEAN_ROW = '(%s::bigint, %s::bigint, %s::bigint)'
+
+# Summarizes everything about an archives messages which can change after it
+#  was created, its edits, deletes and the authors names
+ARCHIVE_VERSION_SQL = '''
+    SELECT count(*), count(*) FILTER (WHERE m.deleted), COALESCE(sum(m.num_edits), 0),
+        COALESCE(sum(hashtext(u.username || '#' || u.discriminator)), 0)
+    FROM messages m
+    JOIN users u ON u.user_id = m.author_id
+    WHERE m.id = ANY(%s::bigint[])
+'''
+
+TOKEN_COUNTS_SQL = '''
+    INSERT INTO token_counts (guild_id, token, day, channel_id, author_id, count)
+    VALUES {}
+    ON CONFLICT (guild_id, token, day, channel_id, author_id) DO UPDATE SET count = token_counts.count + EXCLUDED.count
+'''
+
+TOKEN_COUNTS_ROW = '(%s::bigint, %s::text, %s::date, %s::bigint, %s::bigint, %s::integer)'
+
+GUILD_TOKEN_COUNTS_SQL = '''
+    INSERT INTO guild_token_counts (guild_id, token, day, count)
+    VALUES {}
+    ON CONFLICT (guild_id, token, day) DO UPDATE SET count = guild_token_counts.count + EXCLUDED.count
+'''
+
+GUILD_TOKEN_COUNTS_ROW = '(%s::bigint, %s::text, %s::date, %s::integer)'
+
+TOKEN_SERIES_SQL = '''
+    SELECT date, coalesce(count, 0) AS count
+    FROM
+        generate_series(
+            date_trunc(%s, NOW()) - interval %s,
+            date_trunc(%s, NOW()),
+            %s
+        ) AS date
+    LEFT OUTER JOIN (
+        SELECT date_trunc(%s, day) AS dt, sum(count)::bigint AS count
+        FROM guild_token_counts
+        WHERE
+            guild_id=%s AND
+            token=%s AND
+            day >= (date_trunc(%s, NOW()) - interval %s)::date
+        GROUP BY dt
+    ) results
+    ON (date = results.dt);
+'''
+
 
 @BaseModel.register
 class Message(BaseModel):
@@ -63,35 +194,22 @@ class Message(BaseModel):
 
     @classmethod
     def from_disco_message_update(cls, obj):
-        if not obj.edited_timestamp:
+        data = cls.convert_message_update(obj)
+        if not data:
             return
 
-        to_update = {
-            'edited_timestamp': obj.edited_timestamp,
-            'num_edits': cls.num_edits + 1,
-            'mentions': list(obj.mentions.keys()),
-        }
-
-        if obj.content is not UNSET:
-            to_update['content'] = obj.with_proper_mentions
-            to_update['emojis'] = list(map(int, EMOJI_RE.findall(obj.content)))
-
-        if obj.attachments is not UNSET:
-            to_update['attachments'] = [i.url for i in obj.attachments.values()]
-
-        if obj.embeds is not UNSET:
-            to_update['embeds'] = [json.dumps(i.to_dict(), default=default_json) for i in obj.embeds]
-
-        cls.update(**to_update).where(cls.id == obj.id).execute()
+        cls.update_many([data])
 
     @classmethod
     def from_disco_message(cls, obj):
+        User.ensure_many([obj.author] + list(obj.mentions.values()))
+
         _, created = cls.get_or_create(
             id=obj.id,
             defaults=dict(
                 channel_id=obj.channel_id,
                 guild_id=(obj.guild and obj.guild.id),
-                author=User.from_disco_user(obj.author),
+                author=obj.author.id,
                 content=obj.with_proper_mentions,
                 timestamp=obj.timestamp,
                 edited_timestamp=obj.edited_timestamp,
@@ -101,19 +219,150 @@ class Message(BaseModel):
                 attachments=[i.url for i in obj.attachments.values()],
                 embeds=[json.dumps(i.to_dict(), default=default_json) for i in obj.embeds]))
 
-        for user in obj.mentions.values():
-            User.from_disco_user(user)
+        if created:
+            MessageRollup.increment_many([obj.id])
+
+            if obj.guild:
+                TokenCount.increment_many([
+                    (obj.guild.id, obj.channel_id, obj.author.id, obj.timestamp, obj.with_proper_mentions)
+                ])
 
         return created
 
     @classmethod
     def from_disco_message_many(cls, messages, safe=False):
-        q = cls.insert_many(map(cls.convert_message, messages)).returning(cls.id)
+        if not messages:
+            return []
+
+        # Only upsert each author/mentioned user once per batch
+        users = {}
+        for message in messages:
+            users[message.author.id] = message.author
+            users.update(message.mentions)
+
+        User.ensure_many(users.values())
+
+        rows = list(map(cls.convert_message, messages))
+        q = cls.insert_many(rows).returning(cls.id)
 
         if safe:
             q = q.on_conflict('DO NOTHING')
 
-        return q.execute()
+        ids = [i.id for i in q.execute()]
+        MessageRollup.increment_many(ids)
+
+        inserted = set(ids)
+        TokenCount.increment_many([
+            (row['guild_id'], row['channel_id'], row['author'], row['timestamp'], row['content'])
+            for row in rows if row['id'] in inserted and row['guild_id']
+        ])
+        return ids
+
+    @classmethod
+    def update_many(cls, updates):
+        """
+        Applies a list of message edits (as returned by `convert_message_update`)
+        in a single UPDATE statement. An update may carry an `edits` count when
+        multiple edits for the same message have been merged together.
+        """
+        if not updates:
+            return 0
+
+        params = []
+        for update in updates:
+            params.extend([
+                update['id'],
+                update['edited_timestamp'],
+                update.get('edits', 1),
+                update['mentions'],
+                update.get('content'),
+                update.get('emojis'),
+                update.get('attachments'),
+                json.dumps(update['embeds']) if 'embeds' in update else None,
+            ])
+
+        cursor = database.execute_sql(UPDATE_MANY_SQL.format(
+            ', '.join([UPDATE_MANY_ROW] * len(updates))
+        ), params)
+        return cursor.rowcount
+
+    @classmethod
+    def apply_writes(cls, writes):
+        """
+        Applies a batch of buffered (op, payload) writes, where op is one of
+        `create` (a disco message), `update` (a dict from `convert_message_update`)
+        or `delete` (a message id).
+
+        Writes are grouped into one statement per op and applied in the order
+        create, update, delete. A message can only be edited after it was
+        created and deleted after it was edited, so this keeps the order of
+        writes for any single message id intact. Multiple edits to one message
+        are merged in the order they were received.
+        """
+        creates = OrderedDict()
+        updates = OrderedDict()
+        deletes = OrderedDict()
+
+        for op, payload in writes:
+            if op == 'create':
+                creates.setdefault(payload.id, payload)
+            elif op == 'update':
+                merged = updates.setdefault(payload['id'], {'edits': 0})
+                merged.update(payload)
+                merged['edits'] += 1
+            elif op == 'delete':
+                deletes[payload] = True
+
+        if creates:
+            cls.from_disco_message_many(list(creates.values()), safe=True)
+
+        if updates:
+            cls.update_many(list(updates.values()))
+
+        if deletes:
+            cls.update(deleted=True).where((cls.id << list(deletes.keys()))).execute()
+
+    @staticmethod
+    def write_key(write):
+        op, payload = write
+        if op == 'create':
+            return payload.id
+        elif op == 'update':
+            return payload['id']
+        return payload
+
+    @classmethod
+    def with_writes(cls, msg, writes):
+        """
+        Returns the message as it will be stored once the buffered `writes` for
+        it (see `apply_writes`) are applied, without writing anything. `msg` is
+        the currently stored message or None, in which case it is built from a
+        buffered create.
+        """
+        for op, payload in writes:
+            if op == 'create':
+                if msg is None:
+                    msg = cls(**cls.convert_message(payload))
+                    username, discriminator, avatar, bot = User.fingerprint(payload.author)
+                    msg.author = User(
+                        user_id=payload.author.id,
+                        username=username,
+                        discriminator=discriminator,
+                        avatar=avatar,
+                        bot=bot)
+            elif msg is None:
+                continue
+            elif op == 'update':
+                msg.edited_timestamp = payload['edited_timestamp']
+                msg.num_edits += 1
+                msg.mentions = payload['mentions']
+                for field in ('content', 'emojis', 'attachments', 'embeds'):
+                    if field in payload:
+                        setattr(msg, field, payload[field])
+            elif op == 'delete':
+                msg.deleted = True
+
+        return msg
 
     @staticmethod
     def convert_message(obj):
@@ -121,7 +370,7 @@ class Message(BaseModel):
             'id': obj.id,
             'channel_id': obj.channel_id,
             'guild_id': (obj.guild and obj.guild.id),
-            'author': User.from_disco_user(obj.author),
+            'author': obj.author.id,
             'content': obj.with_proper_mentions,
             'timestamp': obj.timestamp,
             'edited_timestamp': obj.edited_timestamp,
@@ -132,10 +381,334 @@ class Message(BaseModel):
             'embeds': [json.dumps(i.to_dict(), default=default_json) for i in obj.embeds],
         }
 
+    @staticmethod
+    def convert_message_update(obj):
+        if not obj.edited_timestamp:
+            return
+
+        data = {
+            'id': obj.id,
+            'edited_timestamp': obj.edited_timestamp,
+            'mentions': list(obj.mentions.keys()),
+        }
+
+        if obj.content is not UNSET:
+            data['content'] = obj.with_proper_mentions
+            data['emojis'] = list(map(int, EMOJI_RE.findall(obj.content)))
+
+        if obj.attachments is not UNSET:
+            data['attachments'] = [i.url for i in obj.attachments.values()]
+
+        if obj.embeds is not UNSET:
+            data['embeds'] = [json.dumps(i.to_dict(), default=default_json) for i in obj.embeds]
+
+        return data
+
     @classmethod
     def for_channel(cls, channel):
         return cls.select().where(cls.channel_id == channel.id)
 
+    @classmethod
+    def search(
+            cls, query, guild_id, channel_id=None, author_id=None, after=None, before=None,
+            cursor=None, limit=25, highlight=('**', '**')):
+        """
+        Full text searches the messages of a guild, newest first. Returns a list
+        of result dicts and the cursor for the next page (or None), which can be
+        passed back in to continue after the last result.
+        """
+        where = ''
+        params = [
+            u'StartSel="{}", StopSel="{}", MaxFragments=2, MaxWords=20, MinWords=5'.format(*highlight),
+            query,
+            guild_id,
+        ]
+
+        if channel_id:
+            where += ' AND m.channel_id = %s'
+            params.append(channel_id)
+
+        if author_id:
+            where += ' AND m.author_id = %s'
+            params.append(author_id)
+
+        if after:
+            where += ' AND m.timestamp >= %s'
+            params.append(after)
+
+        if before:
+            where += ' AND m.timestamp < %s'
+            params.append(before)
+
+        # Keyset pagination, continues strictly after the last seen result
+        if cursor:
+            timestamp, message_id = cursor.split('-', 1)
+            where += ' AND (m.timestamp, m.id) < (%s, %s)'
+            params.extend([datetime.strptime(timestamp, MESSAGE_SEARCH_CURSOR_FMT), int(message_id)])
+
+        params.append(limit)
+
+        sql = MESSAGE_SEARCH_SQL.format(
+            'websearch_to_tsquery' if SEARCH_WEBSEARCH_QUERIES else 'plainto_tsquery',
+            where,
+        )
+
+        tags = {'channel': bool(channel_id), 'author': bool(author_id), 'paged': bool(cursor)}
+        with timed('rowboat.search.messages', tags=tags):
+            rows = database.execute_sql(sql, params).fetchall()
+
+        results = [{
+            'id': row[0],
+            'channel_id': row[1],
+            'author_id': row[2],
+            'author': u'{}#{}'.format(row[3], str(row[4]).zfill(4)),
+            'timestamp': row[5],
+            'deleted': row[6],
+            'headline': row[7],
+        } for row in rows]
+
+        next_cursor = None
+        if len(results) == limit:
+            next_cursor = '{}-{}'.format(results[-1]['timestamp'].strftime(MESSAGE_SEARCH_CURSOR_FMT), results[-1]['id'])
+
+        return results, next_cursor
+
+
+@BaseModel.register
+class MessageRollup(BaseModel):
+    """
+    Hourly and daily message counts per guild, channel and author. Rows are
+    incremented whenever messages are inserted, so stats never have to scan
+    the messages table. `rebuild` recomputes a time range from the messages
+    table, e.g. to backfill history from before rollups existed.
+    """
+    PERIODS = ('hour', 'day')
+
+    # Stats unit -> (rollup period, bucket size)
+    UNITS = {
+        'hours': ('hour', 'hour'),
+        'days': ('day', 'day'),
+        'weeks': ('day', 'week'),
+        'months': ('day', 'month'),
+    }
+
+    period = TextField()
+    guild_id = BigIntegerField()
+    bucket = DateTimeField()
+    channel_id = BigIntegerField()
+    author_id = BigIntegerField()
+    count = BigIntegerField(default=0)
+
+    class Meta:
+        db_table = 'message_rollups'
+        primary_key = CompositeKey('period', 'guild_id', 'bucket', 'channel_id', 'author_id')
+
+    @classmethod
+    def increment_many(cls, message_ids):
+        if not message_ids:
+            return
+
+        database.execute_sql(
+            ROLLUP_SQL.format('m.id = ANY(%s)', 'message_rollups.count + EXCLUDED.count'),
+            (list(message_ids), ))
+
+    @classmethod
+    def rebuild(cls, start, end, guild_id=None):
+        """
+        Replaces all rollups between two day aligned datetimes with counts
+        computed from the messages table (using the timestamp index). Counts
+        for messages inserted while the range is rebuilt may be off by those
+        messages, so prefer rebuilding ranges which no longer receive writes.
+        """
+        where = 'm.timestamp >= %s AND m.timestamp < %s'
+        params = [start, end]
+
+        if guild_id:
+            where += ' AND m.guild_id = %s'
+            params.append(guild_id)
+
+        with database.atomic():
+            q = cls.delete().where((cls.bucket >= start) & (cls.bucket < end))
+            if guild_id:
+                q = q.where(cls.guild_id == guild_id)
+            q.execute()
+
+            database.execute_sql(ROLLUP_SQL.format(where, 'EXCLUDED.count'), params)
+
+    @classmethod
+    def series(cls, guild_id, unit='days', amount=7, channel_id=None, author_id=None):
+        """
+        Returns a list of (date, count) tuples for the last `amount` units,
+        including empty buckets.
+        """
+        period, trunc = cls.UNITS[unit]
+        span = '{} {}'.format(amount, unit)
+
+        where = ''
+        params = [trunc, span, trunc, '1 {}'.format(trunc), trunc, period, guild_id, trunc, span]
+
+        if channel_id:
+            where += ' AND channel_id=%s'
+            params.append(channel_id)
+
+        if author_id:
+            where += ' AND author_id=%s'
+            params.append(author_id)
+
+        return list(database.execute_sql(ROLLUP_SERIES_SQL.format(where), params).fetchall())
+
+
+@BaseModel.register
+class GuildTokenCount(BaseModel):
+    """
+    Daily word counts per guild, a rollup of `TokenCount` which keeps guild
+    wide reads independent of the number of channels and authors.
+    """
+    guild_id = BigIntegerField()
+    token = TextField()
+    day = DateField()
+    count = IntegerField(default=0)
+
+    class Meta:
+        db_table = 'guild_token_counts'
+        primary_key = CompositeKey('guild_id', 'token', 'day')
+
+        indexes = (
+            (('guild_id', 'day'), False),
+        )
+
+
+@BaseModel.register
+class TokenCount(BaseModel):
+    """
+    Daily word counts per guild, channel and author, tokenized from the stored
+    message content with `rowboat.util.tokenize` and incremented whenever
+    messages are inserted.
+    Edits and deletes are not reflected. Changing the stop words only applies
+    to new messages until the guild is rebuilt. Guild wide counts are kept in
+    `GuildTokenCount` as well.
+    """
+    UNITS = {
+        'days': 'day',
+        'weeks': 'week',
+        'months': 'month',
+    }
+
+    guild_id = BigIntegerField()
+    token = TextField()
+    day = DateField()
+    channel_id = BigIntegerField()
+    author_id = BigIntegerField()
+    count = IntegerField(default=0)
+
+    class Meta:
+        db_table = 'token_counts'
+        primary_key = CompositeKey('guild_id', 'token', 'day', 'channel_id', 'author_id')
+
+        indexes = (
+            (('channel_id', 'day'), False),
+            (('author_id', 'day'), False),
+        )
+
+    @staticmethod
+    def count_messages(messages, counts=None):
+        """
+        Adds the tokens of (guild_id, channel_id, author_id, timestamp, content)
+        tuples to a Counter keyed by token_counts primary key.
+        """
+        counts = counts if counts is not None else Counter()
+
+        for guild_id, channel_id, author_id, timestamp, content in messages:
+            day = timestamp.date()
+            for token in tokenize(content, STOP_WORDS):
+                counts[(guild_id, token, day, channel_id, author_id)] += 1
+
+        return counts
+
+    @classmethod
+    def increment_many(cls, messages):
+        cls.apply_counts(cls.count_messages(messages))
+
+    @classmethod
+    def apply_counts(cls, counts, chunk_size=1000):
+        guild_counts = Counter()
+        for (guild_id, token, day, _, _), count in counts.items():
+            guild_counts[(guild_id, token, day)] += count
+
+        cls._upsert(TOKEN_COUNTS_SQL, TOKEN_COUNTS_ROW, counts, chunk_size)
+        cls._upsert(GUILD_TOKEN_COUNTS_SQL, GUILD_TOKEN_COUNTS_ROW, guild_counts, chunk_size)
+
+    @staticmethod
+    def _upsert(sql, row, counts, chunk_size):
+        # Rows are always locked in key order, so concurrent writers (e.g. a
+        #  rebuild and live messages) can't deadlock each other.
+        rows = sorted(counts.items())
+
+        for idx in range(0, len(rows), chunk_size):
+            chunk = rows[idx:idx + chunk_size]
+
+            params = []
+            for key, count in chunk:
+                params.extend(key)
+                params.append(count)
+
+            database.execute_sql(sql.format(', '.join([row] * len(chunk))), params)
+
+    @classmethod
+    def rebuild(cls, guild_id, chunk_size=5000):
+        """
+        Recomputes all counts for a guild from its stored messages, which are
+        read through a server side cursor.
+        """
+        q = Message.select(
+            Message.guild_id,
+            Message.channel_id,
+            Message.author,
+            Message.timestamp,
+            Message.content,
+        ).where(
+            (Message.guild_id == guild_id)
+        ).tuples()
+
+        with database.atomic():
+            cls.delete().where(cls.guild_id == guild_id).execute()
+            GuildTokenCount.delete().where(GuildTokenCount.guild_id == guild_id).execute()
+
+            batch = []
+            for row in ServerSide(q):
+                batch.append(row)
+
+                if len(batch) >= chunk_size:
+                    cls.increment_many(batch)
+                    batch = []
+
+            cls.increment_many(batch)
+
+    @classmethod
+    def top(cls, field, value, limit=30, days=WORDS_TOP_DAYS):
+        """
+        Returns the most used (token, count) pairs of the last `days` days for
+        a guild_id, channel_id or author_id.
+        """
+        model = GuildTokenCount if field == 'guild_id' else cls
+
+        return list(model.select(
+            model.token,
+            fn.SUM(model.count).alias('total'),
+        ).where(
+            (getattr(model, field) == value) &
+            (model.day >= (datetime.utcnow() - timedelta(days=days)).date())
+        ).group_by(model.token).order_by(SQL('total').desc()).limit(limit).tuples())
+
+    @classmethod
+    def series(cls, guild_id, token, unit='days', amount=7):
+        trunc = cls.UNITS[unit]
+        span = '{} {}'.format(amount, unit)
+
+        return list(database.execute_sql(TOKEN_SERIES_SQL, (
+            trunc, span, trunc, '1 {}'.format(trunc), trunc, guild_id, token, trunc, span
+        )).fetchall())
+
 
 @BaseModel.register
 class Reaction(BaseModel):
@@ -202,8 +775,22 @@ class MessageArchive(BaseModel):
         return 'https://dashboard.rowboat.party/api/archive/{}.txt'.format(self.archive_id)
 
     def encode(self, fmt='txt'):
-        from rowboat.models.user import User
-
+        return ''.join(self.encode_stream(fmt))
+
+    def version(self):
+        """
+        Returns a short string which changes whenever the encoded archive
+        would, without encoding it.
+        """
+        row = database.execute_sql(ARCHIVE_VERSION_SQL, (list(self.message_ids), )).fetchone()
+        return hashlib.md5(repr(tuple(map(int, row)))).hexdigest()[:16]
+
+    def encode_stream(self, fmt='txt', chunk_size=500):
+        """
+        Generates the encoded archive as utf-8 chunks of `chunk_size` messages,
+        reading messages through a server side cursor so memory use does not
+        depend on the size of the archive.
+        """
         if fmt not in self.FORMATS:
             raise Exception('Invalid format {}'.format(fmt))
 
@@ -219,18 +806,30 @@ class MessageArchive(BaseModel):
             User
         ).where(
             (Message.id << self.message_ids)
-        )
+        ).order_by(Message.id)
 
         if fmt == 'txt':
-            return u'\n'.join(map(self.encode_message_text, q))
+            head, encoder, sep, tail = u'', self.encode_message_text, u'\n', u''
         elif fmt == 'csv':
-            return u'\n'.join([
-                'id,channel_id,timestamp,author_id,author,content,deleted,attachments'
-            ] + map(self.encode_message_csv, q))
+            head = u'id,channel_id,timestamp,author_id,author,content,deleted,attachments'
+            encoder, sep, tail = self.encode_message_csv, u'\n', u''
         elif fmt == 'json':
-            return json.dumps({
-                'messages': map(self.encode_message_json, q)
-            })
+            head, sep, tail = u'{"messages": [', u', ', u']}'
+            encoder = lambda msg: json.dumps(self.encode_message_json(msg))
+
+        # The csv header is a line of its own, so rows are separated from it
+        chunk = [head] if head else []
+        started = fmt == 'csv'
+        for msg in ServerSide(q):
+            chunk.append((sep if started else u'') + encoder(msg))
+            started = True
+
+            if len(chunk) >= chunk_size:
+                yield u''.join(chunk).encode('utf-8')
+                chunk = []
+
+        chunk.append(tail)
+        yield u''.join(chunk).encode('utf-8')
 
     @staticmethod
     def encode_message_text(msg):
@@ -318,6 +917,24 @@ class StarboardEntry(BaseModel):
         '''
         cls.raw(sql, user_id, user_id, message_id, user_id).execute()
 
+    @classmethod
+    def mark_clean(cls, entries):
+        """
+        Clears the dirty flag of the given entries and stores their current
+        starboard message, in a single UPDATE statement.
+        """
+        if not entries:
+            return 0
+
+        params = []
+        for entry in entries:
+            params.extend([entry.message_id, entry.star_channel_id, entry.star_message_id])
+
+        cursor = database.execute_sql(STARBOARD_CLEAN_SQL.format(
+            ', '.join([STARBOARD_CLEAN_ROW] * len(entries))
+        ), params)
+        return cursor.rowcount
+
     @classmethod
     def block_user(cls, user_id):
         sql = '''
@@ -413,13 +1030,21 @@ class Command(BaseModel):
             (('plugin', 'command'), False),
         )
 
+    @staticmethod
+    def prepare(event, command, exception=False):
+        return {
+            'message_id': event.message.id,
+            'plugin': command.plugin.name,
+            'command': command.name,
+            'version': REV,
+            'success': not exception,
+            'traceback': traceback.format_exc() if exception else None,
+        }
+
     @classmethod
     def track(cls, event, command, exception=False):
-        return cls.create(
-            message_id=event.message.id,
-            plugin=command.plugin.name,
-            command=command.name,
-            version=REV,
-            success=not exception,
-            traceback=traceback.format_exc() if exception else None,
-        )
+        return cls.create(**cls.prepare(event, command, exception))
+
+    @classmethod
+    def insert_many_safe(cls, rows):
+        cls.insert_many(rows).on_conflict('DO NOTHING').execute()
@@ -1,9 +1,40 @@
 from datetime import datetime
+from collections import OrderedDict
 from holster.enum import Enum
 from peewee import BigIntegerField, IntegerField, SmallIntegerField, TextField, BooleanField, DateTimeField
 from playhouse.postgres_ext import BinaryJSONField
 
-from rowboat.sql import BaseModel
+from rowboat.sql import BaseModel, database
+from rowboat.util.lru import LRUCache
+from rowboat.util.stats import statsd
+
+# Maps user ids to the fingerprint of what we last wrote for them, users who
+#  have not changed since are never sent to the database.
+USER_CACHE = LRUCache(100000)
+
+UPSERT_MANY_SQL = '''
+    INSERT INTO users (user_id, username, discriminator, avatar, bot, created_at, admin)
+    VALUES {}
+    ON CONFLICT (user_id) DO UPDATE SET
+        username = EXCLUDED.username,
+        discriminator = EXCLUDED.discriminator,
+        avatar = EXCLUDED.avatar
+    WHERE (users.username, users.discriminator, users.avatar) IS DISTINCT FROM
+        (EXCLUDED.username, EXCLUDED.discriminator, EXCLUDED.avatar)
+'''
+
+# Columns which are left as NULL in an update are kept as-is, avatars can be
+#  removed so they are only set when flagged.
+UPDATE_MANY_SQL = '''
+    UPDATE users SET
+        username = COALESCE(v.username, users.username),
+        discriminator = COALESCE(v.discriminator, users.discriminator),
+        avatar = CASE WHEN v.set_avatar THEN v.avatar ELSE users.avatar END
+    FROM (VALUES {}) AS v(user_id, username, discriminator, set_avatar, avatar)
+    WHERE users.user_id = v.user_id
+'''
+
+UPDATE_MANY_ROW = '(%s::bigint, %s::text, %s::smallint, %s::boolean, %s::text)'
 
 
 @BaseModel.register
@@ -48,7 +79,7 @@ class User(BaseModel):
         return self.user_id
 
     @classmethod
-    def ensure(cls, user, should_update=True):
+    def ensure(cls, user):
         return cls.from_disco_user(user)
 
     @classmethod
@@ -59,33 +90,84 @@ class User(BaseModel):
             return
 
     @classmethod
-    def from_disco_user(cls, user, should_update=True):
-        # DEPRECATED
-        obj, _ = cls.get_or_create(
-            user_id=user.id,
-            defaults={
-                'username': user.username,
-                'discriminator': user.discriminator,
-                'avatar': user.avatar,
-                'bot': user.bot
-            })
+    def from_disco_user(cls, user):
+        cls.ensure_many([user])
 
-        if should_update:
-            updates = {}
+        username, discriminator, avatar, bot = cls.fingerprint(user)
+        return cls(user_id=user.id, username=username, discriminator=discriminator, avatar=avatar, bot=bot)
 
-            if obj.username != user.username:
-                updates['username'] = user.username
+    @staticmethod
+    def fingerprint(user):
+        return (user.username, int(user.discriminator), user.avatar, bool(user.bot))
+
+    @classmethod
+    def ensure_many(cls, users):
+        """
+        Creates or updates the given disco users with a single upsert, skipping
+        any user whose information has not changed since we last wrote it.
+        """
+        pending = OrderedDict()
+        hits = 0
+
+        for user in users:
+            fingerprint = cls.fingerprint(user)
+            if USER_CACHE.get(user.id) == fingerprint:
+                hits += 1
+                continue
+
+            pending[user.id] = fingerprint
 
-            if obj.discriminator != user.discriminator:
-                updates['discriminator'] = user.discriminator
+        if hits:
+            statsd.increment('rowboat.users.cache.hit', hits)
 
-            if obj.avatar != user.avatar:
-                updates['avatar'] = user.avatar
+        if not pending:
+            return 0
 
-            if updates:
-                cls.update(**updates).where(User.user_id == user.id).execute()
+        statsd.increment('rowboat.users.cache.miss', len(pending))
 
-        return obj
+        now = datetime.utcnow()
+        params = []
+        for user_id, (username, discriminator, avatar, bot) in pending.items():
+            params.extend([user_id, username, discriminator, avatar, bot, now])
+
+        database.execute_sql(UPSERT_MANY_SQL.format(
+            ', '.join(['(%s, %s, %s, %s, %s, %s, false)'] * len(pending))
+        ), params)
+
+        for user_id, fingerprint in pending.items():
+            USER_CACHE.set(user_id, fingerprint)
+
+        return len(pending)
+
+    @classmethod
+    def update_many(cls, updates):
+        """
+        Applies a mapping of user id -> partial fields (any of `username`,
+        `discriminator` and `avatar`) with a single statement. Each user may
+        only appear once, so callers must merge updates beforehand.
+        """
+        if not updates:
+            return 0
+
+        params = []
+        for user_id, fields in updates.items():
+            params.extend([
+                user_id,
+                fields.get('username'),
+                fields.get('discriminator'),
+                'avatar' in fields,
+                fields.get('avatar'),
+            ])
+
+        cursor = database.execute_sql(UPDATE_MANY_SQL.format(
+            ', '.join([UPDATE_MANY_ROW] * len(updates))
+        ), params)
+
+        # What we last wrote for these users is stale now
+        for user_id in updates:
+            USER_CACHE.pop(user_id)
+
+        return cursor.rowcount
 
     def get_avatar_url(self, fmt='webp', size=1024):
         if not self.avatar:
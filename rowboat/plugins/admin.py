@@ -34,6 +34,10 @@ from rowboat.constants import (
 
 EMOJI_RE = re.compile(r'<:[a-zA-Z0-9_]+:([0-9]+)>')
 
+# Search filters, e.g. `from:@user in:#channel`
+SEARCH_FROM_RE = re.compile(r'(?:^|\s)from:<?@?!?([0-9]+)>?')
+SEARCH_IN_RE = re.compile(r'(?:^|\s)in:<?#?([0-9]+)>?')
+
 CUSTOM_EMOJI_STATS_SERVER_SQL = """
 SELECT gm.emoji_id, gm.name, count(*) FROM guild_emojis gm
 JOIN messages m ON m.emojis @> ARRAY[gm.emoji_id]
@@ -265,6 +269,37 @@ class AdminPlugin(Plugin):
             archive.url,
         ))
 
+    @Plugin.command('search', '<query:str...>', level=CommandLevels.MOD, group='messages')
+    def messages_search(self, event, query):
+        author = SEARCH_FROM_RE.search(query)
+        channel = SEARCH_IN_RE.search(query)
+        query = SEARCH_IN_RE.sub('', SEARCH_FROM_RE.sub('', query)).strip()
+
+        if not query:
+            raise CommandFail('must provide something to search for')
+
+        results, _ = Message.search(
+            query,
+            event.guild.id,
+            channel_id=channel and int(channel.group(1)),
+            author_id=author and int(author.group(1)),
+            limit=10)
+
+        if not results:
+            raise CommandFail('no messages found')
+
+        lines = []
+        for result in results:
+            lines.append(u'`{}` <#{}> **{}**{}: {}'.format(
+                result['timestamp'].strftime('%Y-%m-%d %H:%M'),
+                result['channel_id'],
+                S(result['author'], escape_codeblocks=True),
+                ' (deleted)' if result['deleted'] else '',
+                S(result['headline'].replace('\n', ' ')),
+            ))
+
+        event.msg.reply(u'\n'.join(lines)[:2000])
+
     @Plugin.command('clean cancel', level=CommandLevels.MOD)
     def clean_cacnel(self, event):
         if event.channel.id not in self.cleans:
@@ -1,21 +1,25 @@
-import re
 import json
 import urlparse
 
+from gevent.event import AsyncResult
 from holster.enum import Enum
 from disco.types.base import cached_property
 from disco.util.sanitize import S
 from disco.api.http import APIException
 
 from rowboat.redis import rdb
-from rowboat.util.stats import timed
+from rowboat.util.lru import LRUCache
+from rowboat.util.stats import statsd, timed, to_tags
+from rowboat.util.matcher import MultiMatcher
 from rowboat.util.zalgo import ZALGO_RE
 from rowboat.plugins import RowboatPlugin as Plugin
 from rowboat.types import SlottedModel, Field, ListField, DictField, ChannelField, snowflake, lower
 from rowboat.types.plugin import PluginConfig
-from rowboat.models.message import Message
 from rowboat.plugins.modlog import Actions
-from rowboat.constants import INVITE_LINK_RE, URL_RE
+from rowboat.constants import (
+    INVITE_LINK_RE, URL_RE, INVITE_CACHE_SIZE, INVITE_CACHE_TTL, INVITE_CACHE_NEGATIVE_TTL,
+    ERR_UNKNOWN_INVITE
+)
 
 CensorReason = Enum(
     'INVITE',
@@ -40,18 +44,32 @@ class CensorSubConfig(SlottedModel):
     blocked_words = ListField(lower, default=[])
     blocked_tokens = ListField(lower, default=[])
 
-    @cached_property
-    def blocked_re(self):
-        return re.compile(u'({})'.format(u'|'.join(
-            map(re.escape, self.blocked_tokens) +
-            map(lambda k: u'\\b{}\\b'.format(re.escape(k)), self.blocked_words)
-        )), re.I)
+    def blocked_patterns(self, tag):
+        return [(token, tag, False) for token in self.blocked_tokens] + \
+            [(word, tag, True) for word in self.blocked_words]
 
 
 class CensorConfig(PluginConfig):
     levels = DictField(int, CensorSubConfig)
     channels = DictField(ChannelField, CensorSubConfig)
 
+    @cached_property
+    def matchers(self):
+        return {}
+
+    def get_matcher(self, configs):
+        """
+        Returns a matcher for the blocked words and tokens of all the given
+        (key, config) pairs, tagging each hit with the index of its config.
+        Matchers are built lazily and cached per set of configs.
+        """
+        key = tuple(key for key, _ in configs)
+        if key not in self.matchers:
+            self.matchers[key] = MultiMatcher(sum((
+                config.blocked_patterns(idx) for idx, (_, config) in enumerate(configs)
+            ), []))
+        return self.matchers[key]
+
 
 # It's bad kids!
 class Censorship(Exception):
@@ -89,39 +107,106 @@ class Censorship(Exception):
 class CensorPlugin(Plugin):
     def compute_relevant_configs(self, event, author):
         if event.channel_id in event.config.channels:
-            yield event.config.channels[event.channel.id]
+            yield ('channel', event.channel.id), event.config.channels[event.channel.id]
 
         if event.config.levels:
-            user_level = int(self.bot.plugins.get('CorePlugin').get_level(event.guild, author))
+            if author.id == event.author.id and hasattr(event, 'user_level'):
+                user_level = int(event.user_level)
+            else:
+                user_level = int(self.bot.plugins.get('CorePlugin').get_level(event.guild, author))
 
-            for level, config in event.config.levels.items():
+            for level, config in sorted(event.config.levels.items()):
                 if user_level <= level:
-                    yield config
+                    yield ('level', level), config
+
+    def load(self, ctx):
+        super(CensorPlugin, self).load(ctx)
+        self.invite_cache = ctx.get('invite_cache') or LRUCache(INVITE_CACHE_SIZE)
+        self.invite_lookups = {}
+
+    def unload(self, ctx):
+        ctx['invite_cache'] = self.invite_cache
+        super(CensorPlugin, self).unload(ctx)
 
     def get_invite_info(self, code):
-        if rdb.exists('inv:{}'.format(code)):
-            return json.loads(rdb.get('inv:{}'.format(code)))
+        return self.get_invites_info([code])[code]
+
+    def get_invites_info(self, codes):
+        """
+        Resolves invite codes to a dict of guild information (or None for
+        invalid invites). Lookups go through an in-process cache, then a single
+        redis MGET, and only then to the API, with concurrent API lookups for
+        the same code sharing one request.
+        """
+        result = {}
+        missing = []
+
+        for code in set(codes):
+            if code in self.invite_cache:
+                result[code] = self.invite_cache.get(code)
+            else:
+                missing.append(code)
 
-        try:
-            obj = self.client.api.invites_get(code)
-        except:
-            return
+        statsd.increment('rowboat.plugin.censor.invites', len(result), tags=to_tags(cache='local'))
+
+        if missing:
+            found = 0
+            for code, value in zip(missing, rdb.mget(['inv:{}'.format(code) for code in missing])):
+                if value is None:
+                    continue
+
+                found += 1
+                result[code] = json.loads(value)
+                self.invite_cache.set(
+                    code, result[code], ttl=INVITE_CACHE_TTL if result[code] else INVITE_CACHE_NEGATIVE_TTL)
 
-        obj = {
-            'id': obj.guild.id,
-            'name': obj.guild.name,
-            'icon': obj.guild.icon
-        }
+            statsd.increment('rowboat.plugin.censor.invites', found, tags=to_tags(cache='redis'))
+            statsd.increment('rowboat.plugin.censor.invites', len(missing) - found, tags=to_tags(cache='miss'))
 
-        # Cache for 12 hours
-        rdb.setex('inv:{}'.format(code), json.dumps(obj), 43200)
-        return obj
+        for code in missing:
+            if code not in result:
+                result[code] = self.fetch_invite_info(code)
+
+        return result
+
+    def fetch_invite_info(self, code):
+        if code in self.invite_lookups:
+            return self.invite_lookups[code].get()
+
+        self.invite_lookups[code] = lookup = AsyncResult()
+        try:
+            try:
+                obj = self.client.api.invites_get(code)
+                obj = {
+                    'id': obj.guild.id,
+                    'name': obj.guild.name,
+                    'icon': obj.guild.icon
+                }
+            except APIException as e:
+                # Only remember invalid or expired invites, other errors may be
+                #  transient and must not get valid invites censored.
+                if e.code != ERR_UNKNOWN_INVITE and e.response.status_code != 404:
+                    lookup.set(None)
+                    return
+
+                obj = None
+            except Exception:
+                lookup.set(None)
+                return
+
+            ttl = INVITE_CACHE_TTL if obj else INVITE_CACHE_NEGATIVE_TTL
+            rdb.setex('inv:{}'.format(code), json.dumps(obj), ttl)
+            self.invite_cache.set(code, obj, ttl=ttl)
+
+            lookup.set(obj)
+            return obj
+        finally:
+            del self.invite_lookups[code]
 
     @Plugin.listen('MessageUpdate')
     def on_message_update(self, event):
-        try:
-            msg = Message.get(id=event.id)
-        except Message.DoesNotExist:
+        msg = self.call('SQLPlugin.get_message', event.id)
+        if not msg:
             self.log.warning('Not censoring MessageUpdate for id %s, %s, no stored message', event.channel_id, event.id)
             return
 
@@ -149,19 +234,34 @@ class CensorPlugin(Plugin):
         tags = {'guild_id': event.guild.id, 'channel_id': event.channel.id}
         with timed('rowboat.plugin.censor.duration', tags=tags):
             try:
-                # TODO: perhaps imap here? how to raise exception then?
-                for config in configs:
-                    if config.filter_zalgo:
-                        self.filter_zalgo(event, config)
+                # Scan the content once for everything any of the configs need
+                zalgo, invites, urls = None, [], []
+                if any(config.filter_zalgo for _, config in configs):
+                    zalgo = ZALGO_RE.search(event.content)
 
-                    if config.filter_invites:
-                        self.filter_invites(event, config)
+                if any(config.filter_invites or config.filter_domains for _, config in configs):
+                    invites = INVITE_LINK_RE.findall(event.content)
 
-                    if config.filter_domains:
-                        self.filter_domains(event, config)
+                if any(config.filter_domains for _, config in configs):
+                    content = INVITE_LINK_RE.sub('', event.content) if invites else event.content
+                    urls = URL_RE.findall(content)
 
-                    if config.blocked_words or config.blocked_tokens:
-                        self.filter_blocked_words(event, config)
+                words = [[] for _ in configs]
+                for idx, word in event.config.get_matcher(configs).search(event.content):
+                    words[idx].append(word)
+
+                for idx, (_, config) in enumerate(configs):
+                    if config.filter_zalgo and zalgo:
+                        self.filter_zalgo(event, zalgo)
+
+                    if config.filter_invites and invites:
+                        self.filter_invites(event, config, invites)
+
+                    if config.filter_domains and urls:
+                        self.filter_domains(event, config, urls)
+
+                    if words[idx]:
+                        self.filter_blocked_words(event, words[idx])
             except Censorship as c:
                 self.call(
                     'ModLogPlugin.create_debounce',
@@ -182,18 +282,16 @@ class CensorPlugin(Plugin):
                 except APIException:
                     self.log.exception('Failed to delete censored message: ')
 
-    def filter_zalgo(self, event, config):
-        s = ZALGO_RE.search(event.content)
-        if s:
-            raise Censorship(CensorReason.ZALGO, event, ctx={
-                'position': s.start()
-            })
+    def filter_zalgo(self, event, match):
+        raise Censorship(CensorReason.ZALGO, event, ctx={
+            'position': match.start()
+        })
 
-    def filter_invites(self, event, config):
-        invites = INVITE_LINK_RE.findall(event.content)
+    def filter_invites(self, event, config, invites):
+        infos = self.get_invites_info([invite for _, invite in invites])
 
         for _, invite in invites:
-            invite_info = self.get_invite_info(invite)
+            invite_info = infos[invite]
 
             need_whitelist = (
                 config.invites_guild_whitelist or
@@ -220,9 +318,7 @@ class CensorPlugin(Plugin):
                     'guild': invite_info,
                 })
 
-    def filter_domains(self, event, config):
-        urls = URL_RE.findall(INVITE_LINK_RE.sub('', event.content))
-
+    def filter_domains(self, event, config, urls):
         for url in urls:
             try:
                 parsed = urlparse.urlparse(url)
@@ -243,10 +339,7 @@ class CensorPlugin(Plugin):
                     'domain': parsed.netloc
                 })
 
-    def filter_blocked_words(self, event, config):
-        blocked_words = config.blocked_re.findall(event.content)
-
-        if blocked_words:
-            raise Censorship(CensorReason.WORD, event, ctx={
-                'words': blocked_words,
-            })
+    def filter_blocked_words(self, event, words):
+        raise Censorship(CensorReason.WORD, event, ctx={
+            'words': words,
+        })
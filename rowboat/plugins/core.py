@@ -14,10 +14,15 @@ from disco.bot import Bot
 from disco.types.message import MessageEmbed
 from disco.api.http import APIException
 from disco.bot.command import CommandEvent
+from disco.gateway.events import MessageCreate
 from disco.util.sanitize import S
 
 from rowboat import ENV
 from rowboat.util import LocalProxy
+from rowboat.util.dispatch import CommandIndex
+from rowboat.util.lru import LRUCache
+from rowboat.util.redis import RedisSet
+from rowboat.util.writebehind import WriteBehindBuffer
 from rowboat.util.stats import timed
 from rowboat.plugins import BasePlugin as Plugin
 from rowboat.plugins import CommandResponse
@@ -31,7 +36,7 @@ from rowboat.models.notification import Notification
 from rowboat.plugins.modlog import Actions
 from rowboat.constants import (
     GREEN_TICK_EMOJI, RED_TICK_EMOJI, ROWBOAT_GUILD_ID, ROWBOAT_USER_ROLE_ID,
-    ROWBOAT_CONTROL_CHANNEL
+    ROWBOAT_CONTROL_CHANNEL, LEVEL_CACHE_SIZE, COMMAND_BUFFER_INTERVAL, COMMAND_BUFFER_MAX_PENDING
 )
 
 PY_CODE_BLOCK = u'```py\n{}\n```'
@@ -50,12 +55,32 @@ class CorePlugin(Plugin):
         self.startup = ctx.get('startup', datetime.utcnow())
         self.guilds = ctx.get('guilds', {})
 
+        # Per guild cache of member id -> (roles, level)
+        self.levels = {}
+
+        self.global_admins = RedisSet(rdb, 'global_admins', coerce=int)
+        self.guilds_waiting_setup = RedisSet(rdb, GUILDS_WAITING_SETUP_KEY, coerce=int)
+
+        # Command audit records are written in the background, and dropped
+        #  rather than holding up commands if the database falls behind.
+        self.command_writes = WriteBehindBuffer(
+            'commands',
+            Command.insert_many_safe,
+            interval=COMMAND_BUFFER_INTERVAL,
+            max_pending=COMMAND_BUFFER_MAX_PENDING,
+            block=False)
+
         self.emitter = Emitter(gevent.spawn)
+        self.emitter.on('GUILD_CONFIG_UPDATE', self.on_guild_config_update)
 
         super(CorePlugin, self).load(ctx)
 
         # Overwrite the main bot instances plugin loader so we can magicfy events
         self.bot.add_plugin = self.our_add_plugin
+        self.bot.rmv_plugin = self.our_rmv_plugin
+
+        # Built lazily, and thrown away whenever the set of plugins changes
+        self._command_index = None
 
         if ENV != 'prod':
             self.spawn(self.wait_for_plugin_changes)
@@ -67,6 +92,8 @@ class CorePlugin(Plugin):
         self._wait_for_actions_greenlet.link_exception(self.spawn_wait_for_actions)
 
     def our_add_plugin(self, cls, *args, **kwargs):
+        self._command_index = None
+
         if getattr(cls, 'global_plugin', False):
             Bot.add_plugin(self.bot, cls, *args, **kwargs)
             return
@@ -76,6 +103,32 @@ class CorePlugin(Plugin):
         inst.register_trigger('listener', 'pre', functools.partial(self.on_pre, inst))
         Bot.add_plugin(self.bot, inst, *args, **kwargs)
 
+    def our_rmv_plugin(self, *args, **kwargs):
+        self._command_index = None
+        Bot.rmv_plugin(self.bot, *args, **kwargs)
+
+    @property
+    def command_index(self):
+        if not self._command_index:
+            self._command_index = CommandIndex(self.bot.commands, getattr(self.bot, 'group_abbrev', None))
+        return self._command_index
+
+    def get_commands_for_message(self, mention, prefix, msg):
+        """
+        Finds the commands matching a message. Prefixed (and DM) messages are
+        matched against the command index and bail out after one prefix check,
+        mentions are checked for cheaply before handing off to disco.
+        """
+        if mention:
+            if self.state.me.id not in msg.mentions:
+                return []
+            return list(self.bot.get_commands_for_message(True, {}, prefix, msg))
+
+        if prefix and not msg.content.startswith(prefix):
+            return []
+
+        return self.command_index.match(msg.content[len(prefix):])
+
     def wait_for_plugin_changes(self):
         import gevent_inotifyx as inotify
 
@@ -107,6 +160,10 @@ class CorePlugin(Plugin):
 
             data = json.loads(item['data'])
             if data['type'] == 'GUILD_UPDATE' and data['id'] in self.guilds:
+                # Nothing to reload if the config content didn't change
+                if data.get('hash') == self.guilds[data['id']].config_hash:
+                    continue
+
                 with self.send_control_message() as embed:
                     embed.title = u'Reloaded config for {}'.format(
                         self.guilds[data['id']].name
@@ -114,18 +171,23 @@ class CorePlugin(Plugin):
 
                 self.log.info(u'Reloading guild %s', self.guilds[data['id']].name)
 
-                # Refresh config, mostly to validate
                 try:
-                    config = self.guilds[data['id']].get_config(refresh=True)
+                    # Reload the guild entirely, the config is only parsed if
+                    #  its content actually changed.
+                    previous = self.guilds[data['id']].get_config()
+                    guild = Guild.with_id(data['id'])
+                    config = guild.get_config()
+                    if not config:
+                        continue
 
-                    # Reload the guild entirely
-                    self.guilds[data['id']] = Guild.with_id(data['id'])
+                    self.guilds[data['id']] = guild
 
                     # Update guild access
                     self.update_rowboat_guild_access()
 
-                    # Finally, emit the event
-                    self.emitter.emit('GUILD_CONFIG_UPDATE', self.guilds[data['id']], config)
+                    # Finally, emit the event if anything changed
+                    if config is not previous:
+                        self.emitter.emit('GUILD_CONFIG_UPDATE', guild, config)
                 except:
                     self.log.exception(u'Failed to reload config for guild %s', self.guilds[data['id']].name)
                     continue
@@ -145,6 +207,9 @@ class CorePlugin(Plugin):
     def unload(self, ctx):
         ctx['guilds'] = self.guilds
         ctx['startup'] = self.startup
+        self.global_admins.close()
+        self.guilds_waiting_setup.close()
+        self.command_writes.stop()
         super(CorePlugin, self).unload(ctx)
 
     def update_rowboat_guild_access(self):
@@ -235,6 +300,10 @@ class CorePlugin(Plugin):
 
         self._attach_local_event_data(event, plugin_name, guild_id)
 
+        # Resolve the authors level once, so plugins don't each have to
+        if isinstance(event, MessageCreate) and not hasattr(event, 'user_level'):
+            event.user_level = self.get_level(event.guild, event.author)
+
         return event
 
     def get_config(self, guild_id, *args, **kwargs):
@@ -272,6 +341,22 @@ class CorePlugin(Plugin):
     def on_guild_update(self, event):
         self.log.info('Got guild update for guild %s (%s)', event.guild.id, event.guild.channels)
 
+    @Plugin.listen('GuildMemberUpdate')
+    def on_guild_member_update(self, event):
+        if event.guild.id in self.levels:
+            self.levels[event.guild.id].pop(event.id)
+
+    @Plugin.listen('GuildRoleUpdate')
+    def on_guild_role_update(self, event):
+        self.levels.pop(event.guild_id, None)
+
+    @Plugin.listen('GuildRoleDelete')
+    def on_guild_role_delete(self, event):
+        self.levels.pop(event.guild_id, None)
+
+    def on_guild_config_update(self, guild, config):
+        self.levels.pop(guild.guild_id, None)
+
     @Plugin.listen('GuildBanAdd')
     def on_guild_ban_add(self, event):
         GuildBan.ensure(self.client.state.guilds.get(event.guild_id), event.user)
@@ -343,7 +428,7 @@ class CorePlugin(Plugin):
             guild = Guild.with_id(event.id)
         except Guild.DoesNotExist:
             # If the guild is not awaiting setup, leave it now
-            if not rdb.sismember(GUILDS_WAITING_SETUP_KEY, str(event.id)) and event.id != ROWBOAT_GUILD_ID:
+            if event.id not in self.guilds_waiting_setup and event.id != ROWBOAT_GUILD_ID:
                 self.log.warning(
                     'Leaving guild %s (%s), not within setup list',
                     event.id, event.name
@@ -364,6 +449,9 @@ class CorePlugin(Plugin):
 
         self.guilds[event.id] = guild
 
+        # Lets plugins which track guild configs pick up the loaded guild
+        self.emitter.emit('GUILD_LOADED', guild, config)
+
         if config.nickname:
             def set_nickname():
                 m = event.members.select_one(id=self.state.me.id)
@@ -376,21 +464,23 @@ class CorePlugin(Plugin):
 
     def get_level(self, guild, user):
         config = (guild.id in self.guilds and self.guilds.get(guild.id).get_config())
+        if not config:
+            return 0
 
-        user_level = 0
-        if config:
-            member = guild.get_member(user)
-            if not member:
-                return user_level
+        member = guild.get_member(user)
+        if not member:
+            return 0
 
-            for oid in member.roles:
-                if oid in config.levels and config.levels[oid] > user_level:
-                    user_level = config.levels[oid]
+        if guild.id not in self.levels:
+            self.levels[guild.id] = LRUCache(LEVEL_CACHE_SIZE)
 
-            # User ID overrides should override all others
-            if member.id in config.levels:
-                user_level = config.levels[member.id]
+        roles = tuple(member.roles)
+        cached = self.levels[guild.id].get(member.id)
+        if cached and cached[0] == roles:
+            return cached[1]
 
+        user_level = config.compute_level(member.id, roles)
+        self.levels[guild.id].set(member.id, (roles, user_level))
         return user_level
 
     @Plugin.listen('MessageCreate')
@@ -416,14 +506,13 @@ class CorePlugin(Plugin):
 
         # If the guild has configuration, use that (otherwise use defaults)
         if config and config.commands:
-            commands = list(self.bot.get_commands_for_message(
+            commands = self.get_commands_for_message(
                 config.commands.mention,
-                {},
                 config.commands.prefix,
-                event.message))
+                event.message)
         elif guild_id:
             # Otherwise, default to requiring mentions
-            commands = list(self.bot.get_commands_for_message(True, {}, '', event.message))
+            commands = self.get_commands_for_message(True, '', event.message)
         else:
             if ENV != 'prod':
                 if not event.message.content.startswith(ENV + '!'):
@@ -431,17 +520,17 @@ class CorePlugin(Plugin):
                 event.message.content = event.message.content[len(ENV) + 1:]
 
             # DM's just use the commands (no prefix/mention)
-            commands = list(self.bot.get_commands_for_message(False, {}, '', event.message))
+            commands = self.get_commands_for_message(False, '', event.message)
 
         # If we didn't find any matching commands, return
         if not len(commands):
             return
 
-        event.user_level = self.get_level(event.guild, event.author) if event.guild else 0
+        if not hasattr(event, 'user_level'):
+            event.user_level = self.get_level(event.guild, event.author) if event.guild else 0
 
         # Grab whether this user is a global admin
-        # TODO: cache this
-        global_admin = rdb.sismember('global_admins', event.author.id)
+        global_admin = event.author.id in self.global_admins
 
         # Iterate over commands and find a match
         for command, match in commands:
@@ -453,9 +542,7 @@ class CorePlugin(Plugin):
             if guild and not config and command.triggers[0] != 'setup':
                 continue
             elif config and config.commands and command.plugin != self:
-                overrides = {}
-                for obj in config.commands.get_command_override(command):
-                    overrides.update(obj)
+                overrides = config.commands.get_overrides(command)
 
                 if overrides.get('disabled'):
                     continue
@@ -473,7 +560,8 @@ class CorePlugin(Plugin):
                 except CommandResponse as e:
                     event.reply(e.response)
                 except:
-                    tracked = Command.track(event, command, exception=True)
+                    tracked = Command.prepare(event, command, exception=True)
+                    self.command_writes.put(tracked)
                     self.log.exception('Command error:')
 
                     with self.send_control_message() as embed:
@@ -485,11 +573,11 @@ class CorePlugin(Plugin):
                             event.channel.name,
                             event.channel.id
                         ), inline=True)
-                        embed.description = '```{}```'.format(u'\n'.join(tracked.traceback.split('\n')[-8:]))
+                        embed.description = '```{}```'.format(u'\n'.join(tracked['traceback'].split('\n')[-8:]))
 
                     return event.reply('<:{}> something went wrong, perhaps try again later'.format(RED_TICK_EMOJI))
 
-            Command.track(event, command)
+            self.command_writes.put(Command.prepare(event, command))
 
             # Dispatch the command used modlog event
             if config:
@@ -514,7 +602,7 @@ class CorePlugin(Plugin):
         if event.guild.id in self.guilds:
             return event.msg.reply(':warning: this server is already setup')
 
-        global_admin = rdb.sismember('global_admins', event.author.id)
+        global_admin = event.author.id in self.global_admins
 
         # Make sure this is the owner of the server
         if not global_admin:
@@ -527,7 +615,7 @@ class CorePlugin(Plugin):
             return event.msg.reply(':warning: bot must have the Administrator permission')
 
         guild = Guild.setup(event.guild)
-        rdb.srem(GUILDS_WAITING_SETUP_KEY, str(event.guild.id))
+        self.guilds_waiting_setup.remove(event.guild.id)
         self.guilds[event.guild.id] = guild
         event.msg.reply(':ok_hand: successfully loaded configuration')
 
@@ -653,12 +741,12 @@ class CorePlugin(Plugin):
 
     @Plugin.command('wh', '<guild:snowflake>', group='guilds', level=-1)
     def guild_whitelist(self, event, guild):
-        rdb.sadd(GUILDS_WAITING_SETUP_KEY, str(guild))
+        self.guilds_waiting_setup.add(guild)
         event.msg.reply('Ok, guild %s is now in the whitelist' % guild)
 
     @Plugin.command('unwh', '<guild:snowflake>', group='guilds', level=-1)
     def guild_unwhitelist(self, event, guild):
-        rdb.srem(GUILDS_WAITING_SETUP_KEY, str(guild))
+        self.guilds_waiting_setup.remove(guild)
         event.msg.reply('Ok, I\'ve made sure guild %s is no longer in the whitelist' % guild)
 
     @Plugin.command('disable', '<plugin:str>', group='plugins', level=-1)
@@ -1,7 +1,3 @@
-import gevent
-from gevent.lock import Semaphore
-from datetime import datetime, timedelta
-
 from peewee import fn
 from disco.gateway.packets import OPCode, RECV
 from disco.types.message import MessageTable, MessageEmbed
@@ -9,10 +5,14 @@ from disco.types.message import MessageTable, MessageEmbed
 from rowboat.redis import rdb
 from rowboat.plugins import BasePlugin as Plugin
 from rowboat.util.redis import RedisSet
+from rowboat.util.writebehind import WriteBehindBuffer
 from rowboat.models.event import Event
 from rowboat.models.user import User
 from rowboat.models.channel import Channel
 from rowboat.models.message import Command, Message
+from rowboat.constants import (
+    EVENTS_BUFFER_INTERVAL, EVENTS_BUFFER_ROWS, EVENTS_BUFFER_MAX_PENDING, EVENTS_RETENTION_HOURS
+)
 
 
 class InternalPlugin(Plugin):
@@ -22,9 +22,22 @@ class InternalPlugin(Plugin):
         super(InternalPlugin, self).load(ctx)
 
         self.events = RedisSet(rdb, 'internal:tracked-events')
-        self.session_id = None
-        self.lock = Semaphore()
-        self.cache = []
+        self.session_id = ctx.get('session_id')
+
+        # Tracked packets are dropped rather than ever blocking the gateway
+        self.event_writes = WriteBehindBuffer(
+            'events',
+            Event.copy_many,
+            interval=EVENTS_BUFFER_INTERVAL,
+            max_rows=EVENTS_BUFFER_ROWS,
+            max_pending=EVENTS_BUFFER_MAX_PENDING,
+            block=False)
+
+    def unload(self, ctx):
+        self.event_writes.stop()
+        self.events.close()
+        ctx['session_id'] = self.session_id
+        super(InternalPlugin, self).unload(ctx)
 
     @Plugin.command('errors', group='commands', level=-1)
     def on_commands_errors(self, event):
@@ -132,33 +145,15 @@ class InternalPlugin(Plugin):
 
     @Plugin.schedule(300, init=False)
     def prune_old_events(self):
-        # Keep 24 hours of all events
-        Event.delete().where(
-            (Event.timestamp > datetime.utcnow() - timedelta(hours=24))
-        ).execute()
-
-    @Plugin.listen('Ready')
-    def on_ready(self, event):
-        self.session_id = event.session_id
-        gevent.spawn(self.flush_cache)
+        Event.truncate(hours=EVENTS_RETENTION_HOURS)
 
     @Plugin.listen_packet((RECV, OPCode.DISPATCH))
     def on_gateway_event(self, event):
+        # Taken from the packet so every tracked packet after it has a session
+        if event['t'] == 'READY':
+            self.session_id = event['d']['session_id']
+
         if event['t'] not in self.events:
             return
 
-        with self.lock:
-            self.cache.append(event)
-
-    def flush_cache(self):
-        while True:
-            gevent.sleep(1)
-
-            if not len(self.cache):
-                continue
-
-            with self.lock:
-                Event.insert_many(filter(bool, [
-                    Event.prepare(self.session_id, event) for event in self.cache
-                ])).execute()
-                self.cache = []
+        self.event_writes.put(Event.prepare(self.session_id, event))
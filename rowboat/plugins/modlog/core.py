@@ -1,14 +1,13 @@
 import re
-import six
 import time
 import pytz
-import string
 import operator
 import humanize
 
 from holster.enum import Enum
 from holster.emitter import Priority
 from datetime import datetime
+from itertools import combinations
 from collections import defaultdict
 
 from disco.bot import CommandLevels
@@ -19,11 +18,13 @@ from disco.util.sanitize import S
 from rowboat.plugins import RowboatPlugin as Plugin
 from rowboat.types import SlottedModel, Field, ListField, DictField, ChannelField, snowflake
 from rowboat.types.plugin import PluginConfig
-from rowboat.models.message import Message, MessageArchive
+from rowboat.models.message import MessageArchive
 from rowboat.models.guild import Guild
 from rowboat.util import ordered_load, MetaException
+from rowboat.util.templates import Template
+from rowboat.util.timerwheel import TimerWheel
 
-from .pump import ModLogPump
+from .pump import ModLogPump, ModLogScheduler
 
 
 # Dynamically updated by the plugin
@@ -31,6 +32,9 @@ Actions = Enum()
 
 URL_REGEX = re.compile(r'(https?://[^\s]+)')
 
+# Seconds after which an unused debounce is dropped
+DEBOUNCE_EXPIRY = 60
+
 
 def filter_urls(content):
     return URL_REGEX.sub(r'<\1>', content)
@@ -77,78 +81,142 @@ class ModLogConfig(PluginConfig):
     _custom = DictField(dict, private=True)
     _channels = DictField(ChannelConfig, private=True)
 
+    # Action -> list of ((timestamps, timezone), channel ids) to render once for
+    _subscriptions = DictField(list, private=True)
+
     @cached_property
     def subscribed(self):
         return reduce(operator.or_, (i.subscribed for i in self.channels.values())) if self.channels else set()
 
 
-class Formatter(string.Formatter):
-    def convert_field(self, value, conversion):
-        if conversion in ('z', 's'):
-            return S(unicode(value), escape_codeblocks=True)
-        return unicode(value)
+def convert_field(value, conversion):
+    if conversion in ('z', 's'):
+        return S(unicode(value), escape_codeblocks=True)
+    return unicode(value)
+
+
+def compile_format(fmt):
+    return Template(fmt, convert=convert_field)
 
 
 class Debounce(object):
-    def __init__(self, plugin, guild_id, selector, events):
-        self.plugin = plugin
+    def __init__(self, collection, guild_id, selector, events):
+        self.collection = collection
         self.guild_id = guild_id
         self.selector = selector
         self.events = events
         self.timestamp = time.time()
 
+    @property
+    def expires_at(self):
+        return self.timestamp + DEBOUNCE_EXPIRY
+
     def is_expired(self):
-        return time.time() - self.timestamp > 60
+        return time.time() > self.expires_at
+
+    def keys(self, events=None):
+        selector = tuple(sorted(self.selector.items()))
+        return [(self.guild_id, event_name, selector) for event_name in (events or self.events)]
 
     def remove(self, event=None):
-        self.plugin.debounces.remove(self, event)
+        self.collection.remove(self, event)
 
 
 class DebouncesCollection(object):
+    """
+    Indexes debounces by (guild id, event name, selector), so finding or
+    removing one never scans the other debounces of the guild. A debounce
+    matches an event when every item of its selector is part of the `find`
+    kwargs, so `find` looks up each subset of its kwargs. Debounces are
+    expired through a timer wheel which `expire` advances.
+    """
     def __init__(self):
-        self._data = defaultdict(lambda: defaultdict(list))
+        self._index = defaultdict(set)
+        self._wheel = TimerWheel()
+
+    def __len__(self):
+        return len(self._wheel)
+
+    @classmethod
+    def rebuild(cls, debounces):
+        """
+        Builds a collection from the debounces of a handed off one, which may
+        come from a previous version of this module.
+        """
+        inst = cls()
+        for old in debounces:
+            if old.is_expired() or not old.events:
+                continue
+
+            obj = Debounce(inst, old.guild_id, old.selector, list(old.events))
+            obj.timestamp = old.timestamp
+            inst.add(obj)
+        return inst
 
     def __iter__(self):
-        for top in self._data.values():
-            for bot in top.values():
-                for obj in bot:
+        seen = set()
+        for bucket in self._index.values():
+            for obj in bucket:
+                if obj not in seen:
+                    seen.add(obj)
                     yield obj
 
     def add(self, obj):
-        for event_name in obj.events:
-            self._data[obj.guild_id][event_name].append(obj)
+        for key in obj.keys():
+            self._index[key].add(obj)
+        self._wheel.add(obj, obj.expires_at)
 
     def remove(self, obj, event=None):
-        for event_name in ([event] if event else obj.events):
+        events = [event] if event else list(obj.events)
+
+        for key in obj.keys(events):
+            bucket = self._index.get(key)
+            if bucket is None:
+                continue
+
+            bucket.discard(obj)
+            if not bucket:
+                del self._index[key]
+
+        for event_name in events:
             if event_name in obj.events:
                 obj.events.remove(event_name)
 
-            if obj in self._data[obj.guild_id][event_name]:
-                self._data[obj.guild_id][event_name].remove(obj)
+        if not obj.events:
+            self._wheel.remove(obj)
+
+    def expire(self, now=None):
+        for obj in self._wheel.advance(now):
+            self.remove(obj)
 
     def find(self, event, delete=True, **kwargs):
         guild_id = event.guild_id if hasattr(event, 'guild_id') else event.guild.id
-        for obj in self._data[guild_id][event.__class__.__name__]:
-            if obj.is_expired():
-                obj.remove()
-                continue
+        event_name = event.__class__.__name__
+        items = sorted(kwargs.items())
 
-            for k, v in kwargs.items():
-                if obj.selector.get(k) != v:
+        for size in range(len(items) + 1):
+            for selector in combinations(items, size):
+                bucket = self._index.get((guild_id, event_name, selector))
+                if not bucket:
                     continue
 
-            if delete:
-                obj.remove(event=event.__class__.__name__)
-            return obj
+                while bucket:
+                    obj = next(iter(bucket))
+                    if obj.is_expired():
+                        obj.remove()
+                        continue
+
+                    if delete:
+                        obj.remove(event=event_name)
+                    return obj
 
 
 @Plugin.with_config(ModLogConfig)
 class ModLogPlugin(Plugin):
-    fmt = Formatter()
-
     def load(self, ctx):
         if not Actions.attrs:
             self.action_simple = {}
+            self.action_templates = {}
 
             with open('data/actions_simple.yaml') as f:
                 simple = ordered_load(f.read())
@@ -157,14 +225,34 @@ class ModLogPlugin(Plugin):
                 self.register_action(k, v)
         else:
             self.action_simple = ctx['action_simple']
+            self.action_templates = {
+                action: compile_format(simple['format']) for action, simple in self.action_simple.items()
+            }
 
-        self.debounces = ctx.get('debounces') or DebouncesCollection()
+        self.debounces = DebouncesCollection.rebuild(ctx.get('debounces', []))
 
         # Tracks modlogs that are silenced
         self.hushed = {}
 
-        # Tracks pumps for all modlogs
-        self.pumps = {}
+        # Tracks pumps for all modlogs, which are all sent through one scheduler
+        self.pumps = ctx.get('pumps', {})
+        self.scheduler = ctx.get('scheduler') or ModLogScheduler()
+
+        # Guild id -> member ids, and user id -> guild ids, for the guilds
+        #  which log CHANGE_USERNAME. Rebuilt from the state on every load.
+        self.username_members = {}
+        self.username_guilds = defaultdict(set)
+
+        core = self.bot.plugins.get('CorePlugin')
+        for guild_id, guild in core.guilds.items():
+            self.update_username_subscriptions(guild_id, guild.get_config())
+
+        # Guilds are loaded by the CorePlugin after we start, so loads are
+        #  tracked just like config updates.
+        self._config_listeners = [
+            core.emitter.on('GUILD_CONFIG_UPDATE', self.on_guild_config_update),
+            core.emitter.on('GUILD_LOADED', self.on_guild_config_update),
+        ]
 
         super(ModLogPlugin, self).load(ctx)
 
@@ -173,15 +261,59 @@ class ModLogPlugin(Plugin):
             guild_id = event
         else:
             guild_id = event.guild_id if hasattr(event, 'guild_id') else event.guild.id
-        bounce = Debounce(self, guild_id, kwargs, events)
+        bounce = Debounce(self.debounces, guild_id, kwargs, events)
         self.debounces.add(bounce)
         return bounce
 
     def unload(self, ctx):
         ctx['action_simple'] = self.action_simple
         ctx['debounces'] = self.debounces
+        ctx['pumps'] = self.pumps
+        ctx['scheduler'] = self.scheduler
+        for listener in self._config_listeners:
+            listener.remove()
         super(ModLogPlugin, self).unload(ctx)
 
+    def update_username_subscriptions(self, guild_id, config):
+        for user_id in self.username_members.pop(guild_id, ()):
+            self._remove_username_guild(user_id, guild_id)
+
+        modlog = config and getattr(config.plugins, 'modlog', None)
+        if not modlog or Actions.CHANGE_USERNAME not in modlog.subscribed:
+            return
+
+        guild = self.state.guilds.get(guild_id)
+        self.username_members[guild_id] = set(guild.members.keys() if guild else [])
+
+        for user_id in self.username_members[guild_id]:
+            self.username_guilds[user_id].add(guild_id)
+
+    def add_username_member(self, guild_id, user_id):
+        if guild_id not in self.username_members:
+            return
+
+        self.username_members[guild_id].add(user_id)
+        self.username_guilds[user_id].add(guild_id)
+
+    def remove_username_member(self, guild_id, user_id):
+        if guild_id not in self.username_members:
+            return
+
+        self.username_members[guild_id].discard(user_id)
+        self._remove_username_guild(user_id, guild_id)
+
+    def _remove_username_guild(self, user_id, guild_id):
+        guild_ids = self.username_guilds.get(user_id)
+        if guild_ids is None:
+            return
+
+        guild_ids.discard(guild_id)
+        if not guild_ids:
+            del self.username_guilds[user_id]
+
+    def on_guild_config_update(self, guild, config):
+        self.update_username_subscriptions(guild.guild_id, config)
+
     def resolve_channels(self, guild, config):
         self.log.info('Resolving channels for guild %s (%s)',
             guild.id,
@@ -228,13 +360,33 @@ class ModLogPlugin(Plugin):
                     if not custom[action].get('emoji'):
                         custom[action]['emoji'] = self.action_simple[action]['emoji']
 
+                    # A broken format only falls back to the default for its action
+                    try:
+                        custom[action]['template'] = compile_format(custom[action]['format'])
+                    except ValueError:
+                        self.log.warning('Invalid custom format for %s in guild %s, using the default',
+                            action, guild.id)
+                        custom[action]['template'] = self.action_templates[action]
+
                 config._custom = custom
 
+        # Group the channels subscribed to each action by the options which
+        #  affect rendering, so a message is only rendered once per group.
+        subscriptions = defaultdict(lambda: defaultdict(list))
+        for channel_id, chan_config in channels.items():
+            for action in chan_config.subscribed:
+                subscriptions[action][(chan_config.timestamps, chan_config.timezone)].append(channel_id)
+
+        config._subscriptions = {
+            action: list(groups.items()) for action, groups in subscriptions.items()
+        }
+
         config.resolved = True
 
     def register_action(self, name, simple):
         action = Actions.add(name)
         self.action_simple[action] = simple
+        self.action_templates[action] = compile_format(simple['format'])
 
     def log_action_ext(self, action, guild_id, **details):
         config = self.call('CorePlugin.get_config', guild_id)
@@ -259,46 +411,44 @@ class ModLogPlugin(Plugin):
         if not config.resolved:
             self.resolve_channels(guild, config)
 
-        if not {action} & config.subscribed:
+        subscriptions = config._subscriptions.get(action)
+        if not subscriptions:
             return
 
-        def generate_simple(chan_config):
-            info = self.action_simple.get(action)
+        for _, channel_ids in subscriptions:
+            for channel_id in channel_ids:
+                if channel_id not in guild.channels:
+                    self.log.error('guild %s has outdated modlog channels (%s)', guild.id, channel_id)
+                    config._channels = []
+                    config._subscriptions = {}
+                    config.resolved = False
+                    return
+
+        emoji, template = self.action_simple[action]['emoji'], self.action_templates[action]
+        if config._custom and action in config._custom:
+            emoji, template = config._custom[action]['emoji'], config._custom[action]['template']
 
-            if config._custom:
-                if action in config._custom:
-                    info = config._custom[action]
+        # Format contents and create the message with the given emoji
+        base = u':{}: {}'.format(emoji, template.render(**details))
+        now = pytz.utc.localize(datetime.utcnow())
 
-            # Format contents and create the message with the given emoji
-            contents = self.fmt.format(six.text_type(info['format']), **details)
-            msg = u':{}: {}'.format(info['emoji'], contents)
+        for (timestamps, timezone), channel_ids in subscriptions:
+            msg = base
 
-            if chan_config.timestamps:
-                ts = pytz.utc.localize(datetime.utcnow()).astimezone(chan_config.tz)
-                msg = '`[{}]` '.format(ts.strftime('%H:%M:%S')) + msg
+            if timestamps:
+                ts = now.astimezone(pytz.timezone(timezone))
+                msg = u'`[{}]` '.format(ts.strftime('%H:%M:%S')) + msg
 
             if len(msg) > 2000:
                 msg = msg[0:1997] + '...'
 
-            return msg
-
-        for channel_id, chan_config in config._channels.items():
-            if channel_id not in guild.channels:
-                self.log.error('guild %s has outdated modlog channels (%s)', guild.id, channel_id)
-                config._channels = []
-                config.resolved = False
-                return
-
-            if not {action} & chan_config.subscribed:
-                continue
-
-            msg = generate_simple(chan_config)
-
-            if channel_id not in self.pumps:
-                self.pumps[channel_id] = ModLogPump(
-                    self.state.channels.get(channel_id),
-                )
-            self.pumps[channel_id].send(msg)
+            for channel_id in channel_ids:
+                if channel_id not in self.pumps:
+                    self.pumps[channel_id] = ModLogPump(
+                        self.state.channels.get(channel_id),
+                        self.scheduler,
+                    )
+                self.pumps[channel_id].send(msg)
 
     @Plugin.command('hush', group='modlog', level=CommandLevels.ADMIN)
     def command_hush(self, event):
@@ -316,11 +466,9 @@ class ModLogPlugin(Plugin):
         del self.hushed[event.guild.id]
         event.msg.reply(':white_check_mark: modlog has been unhushed, shhhhh... nobody saw anything')
 
-    @Plugin.schedule(120)
+    @Plugin.schedule(5)
     def cleanup_debounce(self):
-        for obj in self.debounces:
-            if obj.is_expired():
-                obj.remove()
+        self.debounces.expire()
 
     @Plugin.listen('ChannelCreate')
     def on_channel_create(self, event):
@@ -346,8 +494,20 @@ class ModLogPlugin(Plugin):
 
         self.log_action(Actions.GUILD_BAN_REMOVE, event)
 
+    @Plugin.listen('GuildDelete', metadata={'global_': True})
+    def on_guild_delete(self, event):
+        self.update_username_subscriptions(event.id, None)
+
+    @Plugin.listen('GuildMembersChunk', metadata={'global_': True})
+    def on_guild_members_chunk(self, event):
+        # Members of large guilds are only sent in chunks after the guild loaded
+        for member in event.members:
+            self.add_username_member(event.guild_id, member.id)
+
     @Plugin.listen('GuildMemberAdd')
     def on_guild_member_add(self, event):
+        self.add_username_member(event.guild_id, event.user.id)
+
         created = humanize.naturaltime(datetime.utcnow() - to_datetime(event.user.id))
         new = (
             event.config.new_member_threshold and
@@ -358,6 +518,8 @@ class ModLogPlugin(Plugin):
 
     @Plugin.listen('GuildMemberRemove')
     def on_guild_member_remove(self, event):
+        self.remove_username_member(event.guild_id, event.user.id)
+
         debounce = self.debounces.find(event, user_id=event.user.id)
 
         if debounce:
@@ -438,46 +600,48 @@ class ModLogPlugin(Plugin):
 
     @Plugin.listen('PresenceUpdate', priority=Priority.BEFORE, metadata={'global_': True})
     def on_presence_update(self, event):
-        plugin = self.bot.plugins.get('CorePlugin')
-        if not plugin or not event.user:
+        if not event.user:
             return
 
-        subscribed_guilds = defaultdict(list)
+        # Most presence updates are status or game changes, drop those before
+        #  looking up anything else.
+        username, discriminator = event.user.username, event.user.discriminator
+        if username is UNSET and discriminator is UNSET:
+            return
 
-        for guild_id, config in plugin.guilds.items():
-            guild = self.state.guilds.get(guild_id)
-            if not guild:
-                continue
+        pre_user = self.state.users.get(event.user.id)
+        if not pre_user:
+            return
+
+        if username in (UNSET, pre_user.username) and discriminator in (UNSET, pre_user.discriminator):
+            return
 
-            if event.user.id not in guild.members:
+        guild_ids = self.username_guilds.get(event.user.id)
+        if not guild_ids:
+            return
+
+        plugin = self.bot.plugins.get('CorePlugin')
+        before = unicode(pre_user)
+
+        for guild_id in list(guild_ids):
+            guild = self.state.guilds.get(guild_id)
+            if not guild or guild_id not in plugin.guilds:
                 continue
 
-            config = config.get_config()
-            if not config.plugins or not config.plugins.modlog:
+            config = plugin.guilds[guild_id].get_config()
+            if not config or not config.plugins or not config.plugins.modlog:
                 continue
 
             if event.user.id in config.plugins.modlog.ignored_users:
                 continue
 
-            if {Actions.CHANGE_USERNAME} & config.plugins.modlog.subscribed:
-                subscribed_guilds[Actions.CHANGE_USERNAME].append((guild, config))
-
-        if not len(subscribed_guilds):
-            return
-
-        pre_user = self.state.users.get(event.user.id)
-        before = unicode(pre_user)
-
-        if Actions.CHANGE_USERNAME in subscribed_guilds:
-            if event.user.username is not UNSET and event.user.username != pre_user.username:
-                for guild, config in subscribed_guilds[Actions.CHANGE_USERNAME]:
-                    self.log_action_raw(
-                        Actions.CHANGE_USERNAME,
-                        guild,
-                        config.plugins.modlog,
-                        before=before,
-                        after=unicode(event.user),
-                        e=event)
+            self.log_action_raw(
+                Actions.CHANGE_USERNAME,
+                guild,
+                config.plugins.modlog,
+                before=before,
+                after=unicode(event.user),
+                e=event)
 
     @Plugin.listen('MessageUpdate', priority=Priority.BEFORE)
     def on_message_update(self, event):
@@ -490,9 +654,8 @@ class ModLogPlugin(Plugin):
         if event.channel_id in event.config.ignored_channels:
             return
 
-        try:
-            msg = Message.get(Message.id == event.id)
-        except Message.DoesNotExist:
+        msg = self.call('SQLPlugin.get_message', event.id)
+        if not msg:
             return
 
         if not event.channel or not event.author:
@@ -510,9 +673,8 @@ class ModLogPlugin(Plugin):
         if event.guild.id in self.hushed:
             return
 
-        try:
-            msg = Message.get(Message.id == event.id)
-        except Message.DoesNotExist:
+        msg = self.call('SQLPlugin.get_message', event.id)
+        if not msg:
             return
 
         channel = self.state.channels.get(msg.channel_id)
@@ -1,85 +1,221 @@
 import time
 
 import gevent
+from gevent.event import Event
+from gevent.pool import Pool
+from collections import deque
+
 from disco.api.http import APIException
+from disco.types.message import MessageEmbed
 from disco.util.logging import LoggingClass
 
+from rowboat.util.stats import statsd, to_tags
+from rowboat.constants import (
+    MODLOG_BUCKET_SIZE, MODLOG_BUCKET_PERIOD, MODLOG_SEND_CONCURRENCY,
+    MODLOG_EMBED_BACKLOG, MODLOG_BUFFER_SIZE
+)
+
+MAX_CONTENT_LENGTH = 2000
+MAX_DESCRIPTION_LENGTH = 2048
+
+# Message send is disabled for this channel
+ERR_SEND_DISABLED = 40004
+
 
 class ModLogPump(LoggingClass):
-    def __init__(self, channel, sleep_duration=5):
+    """
+    Buffers modlog lines for a single channel. Lines are packed into as few
+    messages as possible without ever splitting or dropping one, while the
+    `ModLogScheduler` decides when the next message is sent. Once a backlog
+    builds up, messages additionally carry lines in an embed description.
+    """
+    def __init__(self, channel, scheduler):
         self.channel = channel
-        self.sleep_duration = sleep_duration
-        self._buffer = []
-        self._have = gevent.event.Event()
-        self._quiescent_period = None
-        self._lock = gevent.lock.Semaphore()
-
-        self._greenlet = gevent.spawn(self._emitter_loop)
+        self.scheduler = scheduler
+        self.paused_until = 0
 
-    def _start_emitter(self, greenlet=None):
-        self.log.warning('Restarting emitter for ModLogPump %s' % self.channel)
-        self._greenlet = gevent.spawn(self._emitter_loop)
-        self._greenlet.link_exception(self._start_emitter)
+        self._buffer = deque()
+        self._sent = deque(maxlen=MODLOG_BUCKET_SIZE)
+        self._tags = to_tags(guild_id=channel.guild_id)
 
-    def __del__(self):
-        if self._greenlet:
-            self._greenlet.kill()
+    def __len__(self):
+        return len(self._buffer)
 
-    def _emitter_loop(self):
-        while True:
-            self._have.wait()
-
-            backoff = False
-
-            with self.channel.client.api.capture() as responses:
-                try:
-                    self._emit()
-                except APIException as e:
-                    # Message send is disabled
-                    if e.code == 40004:
-                        backoff = True
-                except Exception:
-                    self.log.exception('Exception when executing ModLogPump._emit: ')
-
-            if responses.rate_limited:
-                backoff = True
-
-            # If we need to backoff, set a quiescent period that will batch
-            #  requests for the next 60 seconds.
-            if backoff:
-                self._quiescent_period = time.time() + 60
-
-            if self._quiescent_period:
-                if self._quiescent_period < time.time():
-                    self._quiescent_period = None
+    def send(self, payload):
+        if len(self._buffer) >= MODLOG_BUFFER_SIZE:
+            self._buffer.popleft()
+            statsd.increment('rowboat.modlog.dropped', tags=self._tags)
+
+        self._buffer.append((time.time(), payload))
+        statsd.gauge('rowboat.modlog.depth', len(self._buffer), tags=self._tags)
+        self.scheduler.schedule(self)
+
+    def ready_in(self, now):
+        """
+        Returns the number of seconds until the next message may be sent to
+        this channel, tracking the per-channel send bucket locally.
+        """
+        wait = self.paused_until - now
+
+        if len(self._sent) == self._sent.maxlen:
+            wait = max(wait, self._sent[0] + MODLOG_BUCKET_PERIOD - now)
+
+        return max(wait, 0)
+
+    def pack(self, embed=False):
+        """
+        Pops as many buffered lines as fit into one message, returning the
+        content, the embed description and the popped (timestamp, line) items.
+        """
+        items = []
+        parts = []
+
+        for limit in ((MAX_CONTENT_LENGTH, MAX_DESCRIPTION_LENGTH) if embed else (MAX_CONTENT_LENGTH, )):
+            lines = []
+            size = 0
+
+            while self._buffer:
+                timestamp, line = self._buffer[0]
+
+                # Lines are limited by the modlog already, this just makes sure
+                #  an oversized line can never block the buffer.
+                if not lines and len(line) > limit:
+                    line = line[:limit - 3] + u'...'
+
+                if size + len(line) + (1 if lines else 0) > limit:
+                    break
+
+                items.append(self._buffer.popleft())
+                size += len(line) + (1 if lines else 0)
+                lines.append(line)
+
+            parts.append(u'\n'.join(lines))
+
+        return parts[0], (parts[1] if len(parts) > 1 else u''), items
+
+    def restore(self, items, pause):
+        """
+        Puts popped items back in front of the buffer and pauses sending.
+        """
+        self._buffer.extendleft(reversed(items))
+        self.paused_until = time.time() + pause
+
+    def emit(self):
+        embed = len(self._buffer) >= MODLOG_EMBED_BACKLOG
+        content, description, items = self.pack(embed=embed)
+        if not items:
+            return
+
+        self._sent.append(time.time())
+
+        with self.channel.client.api.capture() as responses:
+            try:
+                if description:
+                    self.channel.send_message(content, embed=MessageEmbed(description=description))
                 else:
-                    gevent.sleep(self.sleep_duration)
+                    self.channel.send_message(content)
+            except APIException as e:
+                if e.code == ERR_SEND_DISABLED:
+                    self.restore(items, 60)
+                    return
+
+                self.log.exception('Failed to send modlog message to %s: ', self.channel.id)
+                statsd.increment('rowboat.modlog.failed', len(items), tags=self._tags)
 
-            if not self._buffer:
-                self._have.clear()
+                # Client errors (e.g. missing permissions) won't go away by
+                #  retrying, anything else is retried after a pause.
+                if 400 <= e.response.status_code < 500 and e.response.status_code != 429:
+                    return
 
-    def _emit(self):
-        with self._lock:
-            msg = self._get_next_message()
-            if not msg:
+                self.restore(items, MODLOG_BUCKET_PERIOD)
+                return
+            except Exception:
+                self.log.exception('Failed to send modlog message to %s: ', self.channel.id)
+                statsd.increment('rowboat.modlog.failed', len(items), tags=self._tags)
+                self.restore(items, MODLOG_BUCKET_PERIOD)
                 return
 
-            self.channel.send_message(msg)
+        # Our local bucket was out of sync with Discord's, wait a full period
+        if responses.rate_limited:
+            self.paused_until = time.time() + MODLOG_BUCKET_PERIOD
 
-    def _get_next_message(self):
-        data = ''
+        now = time.time()
+        statsd.histogram('rowboat.modlog.packing', len(items), tags=self._tags + ['embed:{}'.format(embed)])
+        statsd.timing('rowboat.modlog.latency', (now - items[0][0]) * 1000, tags=self._tags)
+        statsd.gauge('rowboat.modlog.depth', len(self._buffer), tags=self._tags)
 
-        while self._buffer:
-            payload = self._buffer.pop(0)
-            if len(data) + (len(payload) + 1) > 2000:
-                break
 
-            data += '\n'
-            data += payload
+class ModLogScheduler(LoggingClass):
+    """
+    Sends the messages of all modlog pumps. Pumps with pending lines are
+    served round-robin so a single busy channel can't starve the others, and
+    each pump is only sent to once its channel's bucket allows it. At most one
+    message per pump is in flight at any time.
+    """
+    def __init__(self, concurrency=MODLOG_SEND_CONCURRENCY):
+        self._ready = deque()
+        self._scheduled = set()
+        self._have = Event()
+        self._pool = Pool(concurrency)
 
-        return data
+        self._greenlet = gevent.spawn(self._loop)
 
-    def send(self, payload):
-        with self._lock:
-            self._buffer.append(payload)
-            self._have.set()
+    def schedule(self, pump):
+        if pump in self._scheduled:
+            return
+
+        self._scheduled.add(pump)
+        self._ready.append(pump)
+        self._have.set()
+
+    def stop(self):
+        if self._greenlet:
+            self._greenlet.kill()
+            self._greenlet = None
+
+        self._pool.kill()
+
+    def _loop(self):
+        while True:
+            self._have.clear()
+
+            try:
+                timeout = self._dispatch()
+            except Exception:
+                self.log.exception('Exception in ModLogScheduler._dispatch: ')
+                timeout = 1
+
+            self._have.wait(timeout=timeout)
+
+    def _dispatch(self):
+        """
+        Makes one round-robin pass over the waiting pumps, returning the time
+        until the next rate limited pump may send (or None).
+        """
+        now = time.time()
+        timeout = None
+
+        for _ in range(len(self._ready)):
+            pump = self._ready.popleft()
+
+            wait = pump.ready_in(now)
+            if wait:
+                self._ready.append(pump)
+                timeout = wait if timeout is None else min(timeout, wait)
+                continue
+
+            self._pool.spawn(self._send, pump)
+
+        return timeout
+
+    def _send(self, pump):
+        try:
+            pump.emit()
+        except Exception:
+            self.log.exception('Exception when emitting ModLogPump for %s: ', pump.channel.id)
+        finally:
+            if len(pump):
+                self._ready.append(pump)
+                self._have.set()
+            else:
+                self._scheduled.discard(pump)
@@ -1,17 +1,21 @@
-import json
 import emoji
 import requests
 
 from collections import defaultdict
+from gevent.pool import Pool
+from gevent.queue import Queue
 
 from holster.enum import Enum
 from disco.types.message import MessageEmbed
 
 from rowboat.plugins import RowboatPlugin as Plugin
 from rowboat.redis import rdb
-from rowboat.models.guild import Guild
 from rowboat.types.plugin import PluginConfig
 from rowboat.types import SlottedModel, DictField, Field, ChannelField
+from rowboat.util.reddit import RedditClient
+from rowboat.constants import (
+    REDDIT_BASE_URL, REDDIT_FETCH_CONCURRENCY, REDDIT_SEND_QUEUE_SIZE, REDDIT_MAX_POSTS
+)
 
 
 FormatMode = Enum(
@@ -41,32 +45,61 @@ class RedditConfig(PluginConfig):
 
 @Plugin.with_config(RedditConfig)
 class RedditPlugin(Plugin):
+    def load(self, ctx):
+        super(RedditPlugin, self).load(ctx)
+
+        self.reddit = RedditClient(REDDIT_BASE_URL)
+        self.fetch_pool = Pool(REDDIT_FETCH_CONCURRENCY)
+        self.send_queue = Queue(REDDIT_SEND_QUEUE_SIZE)
+
+        # Subreddit -> {guild id: SubRedditConfig}
+        self.subscriptions = defaultdict(dict)
+
+        # Subreddit -> names it was configured as, used to migrate the old per
+        #  channel high water marks
+        self.sub_names = defaultdict(set)
+
+        core = self.bot.plugins.get('CorePlugin')
+        for guild_id, guild in core.guilds.items():
+            self.update_subscriptions(guild_id, guild.get_config())
+
+        # Guilds are loaded by the CorePlugin after we start, so loads are
+        #  tracked just like config updates.
+        self._config_listeners = [
+            core.emitter.on('GUILD_CONFIG_UPDATE', self.on_guild_config_update),
+            core.emitter.on('GUILD_LOADED', self.on_guild_config_update),
+        ]
+        self.spawn(self.send_posts)
+
+    def unload(self, ctx):
+        for listener in self._config_listeners:
+            listener.remove()
+        self.fetch_pool.kill()
+        super(RedditPlugin, self).unload(ctx)
+
+    def update_subscriptions(self, guild_id, config):
+        for sub, guilds in self.subscriptions.items():
+            guilds.pop(guild_id, None)
+            if not guilds:
+                del self.subscriptions[sub]
+                self.sub_names.pop(sub, None)
+
+        reddit = config and getattr(config.plugins, 'reddit', None)
+        if not reddit:
+            return
+
+        for sub, sub_config in reddit.subs.items():
+            self.subscriptions[sub.lower()][guild_id] = sub_config
+            self.sub_names[sub.lower()].add(sub)
+
+    def on_guild_config_update(self, guild, config):
+        self.update_subscriptions(guild.guild_id, config)
+
     @Plugin.schedule(30, init=False)
     def check_subreddits(self):
-        # TODO: sharding
-        # TODO: filter in query
-        subs_raw = list(Guild.select(
-            Guild.guild_id,
-            Guild.config['plugins']['reddit']
-        ).where(
-            ~(Guild.config['plugins']['reddit'] >> None)
-        ).tuples())
-
-        # Group all subreddits, iterate, update channels
-
-        subs = defaultdict(list)
-
-        for gid, config in subs_raw:
-            config = json.loads(config)
-
-            for k, v in config['subs'].items():
-                subs[k].append((gid, SubRedditConfig(v)))
-
-        for sub, configs in subs.items():
-            try:
-                self.update_subreddit(sub, configs)
-            except requests.HTTPError:
-                self.log.exception('Error loading sub %s:', sub)
+        for sub in self.subscriptions.keys():
+            self.fetch_pool.spawn(self.update_subreddit, sub)
+        self.fetch_pool.join()
 
     def get_channel(self, guild, ref):
         # CLEAN THIS UP TO A RESOLVER
@@ -130,23 +163,48 @@ class RedditPlugin(Plugin):
 
             channel.send_message('', embed=embed)
 
-    def update_subreddit(self, sub, configs):
-        # TODO: use before on this request
-        r = requests.get(
-            'https://www.reddit.com/r/{}/new.json'.format(sub),
-            headers={
-                'User-Agent': 'discord:RowBoat:v0.0.1 (by /u/b1naryth1ef)'
-            }
-        )
-        r.raise_for_status()
-
-        data = list(reversed(map(lambda i: i['data'], r.json()['data']['children'])))
-
-        # TODO:
-        #  1. instead of tracking per guild, just track globally per subreddit
-        #  2. fan-out posts to each subscribed channel
-
-        for gid, config in configs:
+    def update_subreddit(self, sub):
+        try:
+            data = self.reddit.get_new_posts(sub)
+        except requests.RequestException:
+            self.log.exception('Error loading sub %s:', sub)
+            return
+
+        # Posts are tracked globally per subreddit, and fanned out to every
+        #  subscribed channel.
+        last = rdb.get('rdt:hwm:{}'.format(sub))
+        legacy = {}
+
+        if last is None:
+            legacy = self.get_legacy_marks(sub)
+            if not legacy:
+                # First time we see this subreddit, start from its newest post
+                #  instead of posting the backlog.
+                if data:
+                    rdb.set('rdt:hwm:{}'.format(sub), data[-1]['created_utc'])
+                return
+
+            last = min(legacy.values())
+
+        posts = [item for item in data if item['created_utc'] > float(last)]
+        if len(posts) > REDDIT_MAX_POSTS:
+            # The rest is sent with the next poll, which would otherwise just
+            #  get a 304 for the unchanged listing.
+            posts = posts[:REDDIT_MAX_POSTS]
+            self.reddit.forget(sub)
+
+        rdb.set('rdt:hwm:{}'.format(sub), posts[-1]['created_utc'] if posts else last)
+
+        if legacy:
+            rdb.delete(*[
+                'rdt:lpid:{}:{}'.format(channel_id, name)
+                for channel_id in legacy for name in self.sub_names[sub]
+            ])
+
+        if not posts:
+            return
+
+        for gid, config in self.subscriptions.get(sub, {}).items():
             guild = self.state.guilds.get(gid)
             if not guild:
                 self.log.warning('Skipping non existant guild %s', gid)
@@ -156,20 +214,43 @@ class RedditPlugin(Plugin):
             if not channel:
                 self.log.warning('Skipping non existant channel %s for guild %s (%s)', channel, guild.name, gid)
                 continue
-            last = float(rdb.get('rdt:lpid:{}:{}'.format(channel.id, sub)) or 0)
-
-            item_count, high_time = 0, last
-            for item in data:
-                if item['created_utc'] > last:
-                    try:
-                        self.send_post(config, channel, item)
-                    except:
-                        self.log.exception('Failed to post reddit content from %s\n\n', item)
-                    item_count += 1
-
-                    if item['created_utc'] > high_time:
-                        rdb.set('rdt:lpid:{}:{}'.format(channel.id, sub), item['created_utc'])
-                        high_time = item['created_utc']
-
-                if item_count > 10:
-                    break
+
+            for item in posts:
+                # Skip posts a channel already got under its old per channel mark
+                if item['created_utc'] <= legacy.get(channel.id, 0):
+                    continue
+
+                self.send_queue.put((config, channel, item))
+
+    def get_legacy_marks(self, sub):
+        """
+        Returns the per channel high water marks (rdt:lpid) which were tracked
+        for the subreddit before marks were kept per subreddit.
+        """
+        keys = []
+        for gid, config in self.subscriptions.get(sub, {}).items():
+            guild = self.state.guilds.get(gid)
+            channel = guild and self.get_channel(guild, config.channel)
+            if not channel:
+                continue
+
+            for name in self.sub_names[sub]:
+                keys.append((channel.id, 'rdt:lpid:{}:{}'.format(channel.id, name)))
+
+        if not keys:
+            return {}
+
+        marks = {}
+        for (channel_id, _), value in zip(keys, rdb.mget([key for _, key in keys])):
+            if value is not None:
+                marks[channel_id] = max(marks.get(channel_id, 0), float(value))
+        return marks
+
+    def send_posts(self):
+        while True:
+            config, channel, item = self.send_queue.get()
+
+            try:
+                self.send_post(config, channel, item)
+            except:
+                self.log.exception('Failed to post reddit content from %s\n\n', item)
@@ -2,7 +2,6 @@ import re
 import time
 import operator
 
-from gevent.lock import Semaphore
 from datetime import datetime, timedelta
 from collections import defaultdict
 from holster.enum import Enum
@@ -12,8 +11,12 @@ from rowboat.plugins import RowboatPlugin as Plugin
 from rowboat.redis import rdb
 from rowboat.plugins.modlog import Actions
 from rowboat.plugins.censor import URL_RE
-from rowboat.util.leakybucket import LeakyBucket
-from rowboat.util.stats import timed
+from rowboat.util.gevent import KeyedLocks
+from rowboat.util.lru import LRUCache
+from rowboat.util.ratelimit import RateLimitEngine
+from rowboat.util.ringbuffer import TimedRingBuffer
+from rowboat.util.stats import statsd, timed, to_tags
+from rowboat.constants import SPAM_RATELIMIT_REDIS, SPAM_RECENT_MESSAGES, SPAM_RECENT_USERS
 from rowboat.types.plugin import PluginConfig
 from rowboat.types import SlottedModel, DictField, Field
 from rowboat.models.user import Infraction
@@ -23,6 +26,20 @@ from rowboat.models.message import Message, EMOJI_RE
 UPPER_RE = re.compile('[A-Z]')
 
 
+# All bucketed checks, in the order they are evaluated, along with a function
+#  which computes how much a message counts against the check.
+SIMPLE_CHECKS = (
+    ('max_messages', 'Too Many Messages', lambda e: 1),
+    ('max_mentions', 'Too Many Mentions', lambda e: len(e.mentions)),
+    ('max_links', 'Too Many Links', lambda e: len(URL_RE.findall(e.message.content))),
+    ('max_upper_case', 'Too Many Capitals', lambda e: len(UPPER_RE.findall(e.message.content))),
+    # TODO: unicode emoji too pls
+    ('max_emojis', 'Too Many Emojis', lambda e: len(EMOJI_RE.findall(e.message.content))),
+    ('max_newlines', 'Too Many Newlines', lambda e: e.message.content.count('\n') + e.message.content.count('\r')),
+    ('max_attachments', 'Too Many Attachments', lambda e: len(e.message.attachments)),
+)
+
+
 PunishmentType = Enum(
     'NONE',
     'MUTE',
@@ -59,14 +76,6 @@ class SubConfig(SlottedModel):
     clean_count = Field(int, default=100)
     clean_duration = Field(int, default=900)
 
-    _cached_max_messages_bucket = Field(str, private=True)
-    _cached_max_mentions_bucket = Field(str, private=True)
-    _cached_max_links_bucket = Field(str, private=True)
-    _cached_max_upper_case_bucket = Field(str, private=True)
-    _cached_max_emojis_bucket = Field(str, private=True)
-    _cached_max_newlines_bucket = Field(str, private=True)
-    _cached_max_attachments_bucket = Field(str, private=True)
-
     def validate(self):
         if self.clean_duration < 0 or self.clean_duration > 86400:
             raise Exception('Invalid value for `clean_duration` must be between 0 and 86400')
@@ -74,17 +83,11 @@ class SubConfig(SlottedModel):
         if self.clean_count < 0 or self.clean_count > 1000:
             raise Exception('Invaliud value for `clean_count` must be between 0 and 1000')
 
-    def get_bucket(self, attr, guild_id):
+    def get_check(self, attr):
         obj = getattr(self, attr)
         if not obj or not obj.count or not obj.interval:
-            return (None, None)
-
-        bucket = getattr(self, '_cached_{}_bucket'.format(attr), None)
-        if not bucket:
-            bucket = LeakyBucket(rdb, 'spam:{}:{}:{}'.format(attr, guild_id, '{}'), obj.count, obj.interval * 1000)
-            setattr(self, '_cached_{}_bucket'.format(attr), bucket)
-
-        return obj, bucket
+            return None
+        return obj
 
 
 class SpamConfig(PluginConfig):
@@ -92,21 +95,25 @@ class SpamConfig(PluginConfig):
     levels = DictField(int, SubConfig)
 
     def compute_relevant_rules(self, member, level):
+        """
+        Yields (key, rule) for each rule which applies to the member, where key
+        uniquely identifies the rule within this config.
+        """
         if self.roles:
             if '*' in self.roles:
-                yield self.roles['*']
+                yield 'roles:*', self.roles['*']
 
             for rid in member.roles:
                 if rid in self.roles:
-                    yield self.roles[rid]
+                    yield u'roles:{}'.format(rid), self.roles[rid]
                 rname = member.guild.roles.get(rid)
                 if rname and rname.name in self.roles:
-                    yield self.roles[rname.name]
+                    yield u'roles:{}'.format(rname.name), self.roles[rname.name]
 
         if self.levels:
             for lvl in self.levels.keys():
                 if level <= lvl:
-                    yield self.levels[lvl]
+                    yield u'levels:{}'.format(lvl), self.levels[lvl]
 
 
 class Violation(Exception):
@@ -124,7 +131,22 @@ class Violation(Exception):
 class SpamPlugin(Plugin):
     def load(self, ctx):
         super(SpamPlugin, self).load(ctx)
-        self.guild_locks = {}
+        self.locks = KeyedLocks()
+        self.ratelimits = ctx.get('ratelimits') or RateLimitEngine(rdb if SPAM_RATELIMIT_REDIS else None)
+
+        # Recent message content hashes, per guild and per (guild, user), used
+        #  for duplicate detection. Buffers only cover messages seen after
+        #  `recent_since`, anything older is read from the database.
+        self.recent_since = ctx.get('recent_since') or time.time()
+        self.recent_guilds = ctx.get('recent_guilds') or {}
+        self.recent_users = ctx.get('recent_users') or LRUCache(SPAM_RECENT_USERS)
+
+    def unload(self, ctx):
+        ctx['ratelimits'] = self.ratelimits
+        ctx['recent_since'] = self.recent_since
+        ctx['recent_guilds'] = self.recent_guilds
+        ctx['recent_users'] = self.recent_users
+        super(SpamPlugin, self).unload(ctx)
 
     def violate(self, violation):
         key = 'lv:{e.member.guild_id}:{e.member.id}'.format(e=violation.event)
@@ -178,6 +200,7 @@ class SpamPlugin(Plugin):
 
             # Clean messages if requested
             if punishment != PunishmentType.NONE and violation.rule.clean:
+                self.call('SQLPlugin.flush_messages')
                 msgs = Message.select(
                     Message.id,
                     Message.channel_id
@@ -198,29 +221,68 @@ class SpamPlugin(Plugin):
 
                     channel.delete_messages(messages)
 
-    def check_duplicate_messages(self, event, member, rule):
+    def track_recent_message(self, event):
+        if not event.content:
+            return
+
+        value = hash(event.content)
+
+        if event.guild.id not in self.recent_guilds:
+            self.recent_guilds[event.guild.id] = TimedRingBuffer(SPAM_RECENT_MESSAGES, self.recent_since)
+        self.recent_guilds[event.guild.id].append(value)
+
+        key = (event.guild.id, event.author.id)
+        buff = self.recent_users.get(key)
+        if not buff:
+            if len(self.recent_users) >= self.recent_users.max_size:
+                # Evicting a user means a new buffer for them could be missing
+                #  messages, so only trust buffers created from now on.
+                self.recent_since = time.time()
+            buff = TimedRingBuffer(SPAM_RECENT_MESSAGES, self.recent_since)
+            self.recent_users.set(key, buff)
+        buff.append(value)
+
+    def get_recent_messages(self, event, member, rule):
+        """
+        Returns the content of messages sent within the rules duplicate interval,
+        preferring the in-memory buffers over the database.
+        """
+        is_global = rule.max_duplicates.meta and rule.max_duplicates.meta.get('global')
+        since = time.time() - rule.max_duplicates.interval
+
+        if is_global:
+            buff = self.recent_guilds.get(event.guild.id)
+        else:
+            buff = self.recent_users.get((event.guild.id, member.id))
+
+        if buff and buff.covers(since):
+            return buff.since(since)
+
+        self.call('SQLPlugin.flush_messages')
+
         q = [
             (Message.guild_id == event.guild.id),
             (Message.timestamp > (datetime.utcnow() - timedelta(seconds=rule.max_duplicates.interval)))
         ]
 
         # If we're not checking globally, include the member id
-        if not rule.max_duplicates.meta or not rule.max_duplicates.meta.get('global'):
+        if not is_global:
             q.append((Message.author_id == member.id))
 
         # Grab the previous messages the user sent in this server
-        msgs = list(Message.select(
-            Message.id,
+        msgs = Message.select(
             Message.content,
         ).where(reduce(operator.and_, q)).order_by(
             Message.timestamp.desc()
-        ).limit(50).tuples())
+        ).limit(SPAM_RECENT_MESSAGES).tuples()
 
+        return [hash(content) for content, in msgs if content]
+
+    def check_duplicate_messages(self, event, member, rule):
         # Group the messages by their content
         dupes = defaultdict(int)
-        for mid, content in msgs:
-            if content:
-                dupes[content] += 1
+        for content in self.get_recent_messages(event, member, rule):
+            dupes[content] += 1
 
         # If any of them are above the max dupes count, trigger a violation
         dupes = [v for k, v in dupes.items() if v > rule.max_duplicates.count]
@@ -235,59 +297,81 @@ class SpamPlugin(Plugin):
                     sum(dupes),
                     len(dupes)))
 
-    def check_message_simple(self, event, member, rule):
-        def check_bucket(name, base_text, func):
-            check, bucket = rule.get_bucket(name, event.guild.id)
-            if not bucket:
-                return
+    def check_message_simple(self, event, member, rules):
+        """
+        Evaluates every bucketed check of every rule for a message in a single
+        pass over the rate limit engine, then raises the first violation.
+        """
+        amounts = {}
+        checks, info = [], []
+
+        for key, rule in rules:
+            for name, base_text, func in SIMPLE_CHECKS:
+                check = rule.get_check(name)
+                if not check:
+                    continue
+
+                if name not in amounts:
+                    amounts[name] = func(event)
+
+                checks.append((
+                    (event.guild.id, key, event.author.id, name),
+                    amounts[name],
+                    check.count,
+                    check.interval * 1000,
+                ))
+                info.append((rule, check, name, base_text))
+
+        results = self.ratelimits.check(checks)
+
+        for key, rule in rules:
+            for (exceeded, count, size), (check_rule, check, name, base_text) in zip(results, info):
+                if check_rule is not rule or not exceeded:
+                    continue
 
-            if not bucket.check(event.author.id, func(event) if callable(func) else func):
                 raise Violation(rule, check, event, member,
                     name.upper(),
-                    base_text + ' ({} / {}s)'.format(bucket.count(event.author.id), bucket.size(event.author.id)))
-
-        check_bucket('max_messages', 'Too Many Messages', 1)
-        check_bucket('max_mentions', 'Too Many Mentions', lambda e: len(e.mentions))
-        check_bucket('max_links', 'Too Many Links', lambda e: len(URL_RE.findall(e.message.content)))
-        check_bucket('max_upper_case', 'Too Many Capitals', lambda e: len(UPPER_RE.findall(e.message.content)))
-        # TODO: unicode emoji too pls
-        check_bucket('max_emojis', 'Too Many Emojis', lambda e: len(EMOJI_RE.findall(e.message.content)))
-        check_bucket('max_newlines', 'Too Many Newlines', lambda e: e.message.content.count('\n') + e.message.content.count('\r'))
-        check_bucket('max_attachments', 'Too Many Attachments', lambda e: len(e.message.attachments))
+                    base_text + ' ({} / {}s)'.format(count, size))
 
-        if rule.max_duplicates and rule.max_duplicates.interval and rule.max_duplicates.count:
-            self.check_duplicate_messages(event, member, rule)
+            if rule.max_duplicates and rule.max_duplicates.interval and rule.max_duplicates.count:
+                self.check_duplicate_messages(event, member, rule)
 
     @Plugin.listen('MessageCreate', priority=Priority.AFTER)
     def on_message_create(self, event):
+        self.track_recent_message(event)
+
         if event.author.id == self.state.me.id:
             return
 
         if event.webhook_id:
             return
 
-        # Lineralize events by guild ID to prevent spamming events
-        if event.guild.id not in self.guild_locks:
-            self.guild_locks[event.guild.id] = Semaphore()
-        self.guild_locks[event.guild.id].acquire()
+        member = event.guild.get_member(event.author)
+        if not member:
+            self.log.warning(
+                'Failed to find member for guild id %s and author id %s', event.guild.id, event.author.id)
+            return
+
+        level = int(event.user_level)
+
+        rules = list(event.config.compute_relevant_rules(member, level))
+        if not rules:
+            return
+
+        # Lineralize events per author, and per guild if any rule checks for
+        #  duplicates across the whole guild.
+        keys = [(event.guild.id, event.author.id)]
+        if any(rule.max_duplicates and rule.max_duplicates.meta and rule.max_duplicates.meta.get('global')
+                for _, rule in rules):
+            keys.insert(0, (event.guild.id, ))
 
         tags = {'guild_id': event.guild.id, 'channel_id': event.channel.id}
-        with timed('rowboat.plugin.spam.duration', tags=tags):
-            try:
-                member = event.guild.get_member(event.author)
-                if not member:
-                    self.log.warning(
-                        'Failed to find member for guild id %s and author id %s', event.guild.id, event.author.id)
-                    return
-
-                level = int(self.bot.plugins.get('CorePlugin').get_level(event.guild, event.author))
-
-                # TODO: We should linerialize the work required for all rules in one go,
-                #  we repeat all the work in each rule which sucks.
-
-                for rule in event.config.compute_relevant_rules(member, level):
-                    self.check_message_simple(event, member, rule)
-            except Violation as v:
-                self.violate(v)
-            finally:
-                self.guild_locks[event.guild.id].release()
+        start = time.time()
+        with self.locks.lock(*keys):
+            statsd.timing('rowboat.plugin.spam.wait', (time.time() - start) * 1000, tags=to_tags(tags))
+
+            with timed('rowboat.plugin.spam.duration', tags=tags):
+                try:
+                    self.check_message_simple(event, member, rules)
+                except Violation as v:
+                    self.violate(v)
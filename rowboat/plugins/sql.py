@@ -5,7 +5,6 @@ import markovify
 import pygal
 import cairosvg
 
-from gevent.queue import LifoQueue, Empty
 from gevent.pool import Pool
 from holster.emitter import Priority
 from datetime import datetime
@@ -22,9 +21,17 @@ from rowboat.sql import database
 from rowboat.models.user import User
 from rowboat.models.guild import GuildEmoji, GuildVoiceSession
 from rowboat.models.channel import Channel
-from rowboat.models.message import Message, Reaction
+from rowboat.models.message import Message, Reaction, TokenCount, STOP_WORDS
+from rowboat.util.tokenize import tokenize
 from rowboat.util.input import parse_duration
+from rowboat.util.stats import statsd
+from rowboat.util.writebehind import WriteBehindBuffer
+from rowboat.constants import (
+    SQL_MESSAGE_BUFFER_INTERVAL, SQL_MESSAGE_BUFFER_ROWS, SQL_MESSAGE_BUFFER_MAX_PENDING,
+    SQL_USER_UPDATE_INTERVAL, SQL_USER_UPDATE_BATCH_SIZE, SQL_USER_UPDATE_MAX_PENDING
+)
 from rowboat.tasks.backfill import backfill_channel, backfill_guild
+from rowboat.tasks.words import rebuild_token_counts
 
 
 class SQLPlugin(Plugin):
@@ -33,36 +40,51 @@ class SQLPlugin(Plugin):
     def load(self, ctx):
         self.models = ctx.get('models', {})
         self.backfills = {}
-        self.user_updates = LifoQueue(maxsize=4096)
+
+        # User id -> the latest value of each changed field
+        self.user_updates = ctx.get('user_updates', {})
+
+        # Message writes are buffered and flushed in batches
+        self.message_writes = WriteBehindBuffer(
+            'messages',
+            Message.apply_writes,
+            interval=SQL_MESSAGE_BUFFER_INTERVAL,
+            max_rows=SQL_MESSAGE_BUFFER_ROWS,
+            max_pending=SQL_MESSAGE_BUFFER_MAX_PENDING,
+            key_func=Message.write_key)
+
         super(SQLPlugin, self).load(ctx)
 
     def unload(self, ctx):
+        self.message_writes.stop()
         ctx['models'] = self.models
+        ctx['user_updates'] = self.user_updates
         super(SQLPlugin, self).unload(ctx)
 
-    @Plugin.schedule(15, init=False)
+    @Plugin.schedule(SQL_USER_UPDATE_INTERVAL, init=False)
     def update_users(self):
-        already_updated = set()
-
-        while True:
-            # Only update so many at a time
-            if len(already_updated) > 10000:
-                return
+        # Updates received while flushing go into a new map, so they are
+        #  always written after (and over) the ones being flushed.
+        pending, self.user_updates = self.user_updates, {}
+        statsd.gauge('rowboat.users.updates.pending', len(pending))
 
-            try:
-                user_id, data = self.user_updates.get_nowait()
-            except Empty:
-                return
-
-            if user_id in already_updated:
-                continue
-
-            already_updated.add(user_id)
+        user_ids = pending.keys()
+        for idx in range(0, len(user_ids), SQL_USER_UPDATE_BATCH_SIZE):
+            batch = {user_id: pending[user_id] for user_id in user_ids[idx:idx + SQL_USER_UPDATE_BATCH_SIZE]}
 
             try:
-                User.update(**data).where(User.user_id == user_id).execute()
-            except:
-                self.log.exception('Failed to update user %s: ', user_id)
+                User.update_many(batch)
+            except Exception:
+                self.log.exception('Failed to update %s users, updating them one by one: ', len(batch))
+
+                # A single bad row fails the whole statement, so only that row
+                #  is dropped.
+                for user_id, fields in batch.items():
+                    try:
+                        User.update_many({user_id: fields})
+                    except Exception:
+                        self.log.exception('Failed to update user %s: ', user_id)
+                        statsd.increment('rowboat.users.updates.failed')
 
     @Plugin.listen('VoiceStateUpdate', priority=Priority.BEFORE)
     def on_voice_state_update(self, event):
@@ -85,23 +107,51 @@ class SQLPlugin(Plugin):
         if not updates:
             return
 
-        self.user_updates.put((event.user.id, updates))
+        pending = self.user_updates.get(event.user.id)
+        if pending is not None:
+            pending.update(updates)
+            statsd.increment('rowboat.users.updates.coalesced')
+        elif len(self.user_updates) >= SQL_USER_UPDATE_MAX_PENDING:
+            statsd.increment('rowboat.users.updates.dropped')
+        else:
+            self.user_updates[event.user.id] = updates
+
+    def flush_messages(self):
+        # Externally used, makes buffered message writes visible to queries
+        self.message_writes.flush()
+
+    def get_message(self, message_id):
+        # Externally used, returns a message including its buffered writes
+        writes = self.message_writes.pending(message_id)
+        if any(op == 'create' for op, _ in writes):
+            return Message.with_writes(None, writes)
+
+        try:
+            msg = Message.get(Message.id == message_id)
+        except Message.DoesNotExist:
+            msg = None
+
+        # Writes may have been flushed while we queried
+        return Message.with_writes(msg, self.message_writes.pending(message_id))
 
     @Plugin.listen('MessageCreate')
     def on_message_create(self, event):
-        Message.from_disco_message(event.message)
+        self.message_writes.put(('create', event.message))
 
     @Plugin.listen('MessageUpdate')
     def on_message_update(self, event):
-        Message.from_disco_message_update(event.message)
+        data = Message.convert_message_update(event.message)
+        if data:
+            self.message_writes.put(('update', data))
 
     @Plugin.listen('MessageDelete')
     def on_message_delete(self, event):
-        Message.update(deleted=True).where(Message.id == event.id).execute()
+        self.message_writes.put(('delete', event.id))
 
     @Plugin.listen('MessageDeleteBulk')
     def on_message_delete_bulk(self, event):
-        Message.update(deleted=True).where((Message.id << event.ids)).execute()
+        for message_id in event.ids:
+            self.message_writes.put(('delete', message_id))
 
     @Plugin.listen('MessageReactionAdd', priority=Priority.BEFORE)
     def on_message_reaction_add(self, event):
@@ -318,42 +368,26 @@ class SQLPlugin(Plugin):
         backfill_guild.queue(guild.id)
         event.msg.reply(':ok_hand: enqueued guild to be backfilled')
 
+    @Plugin.command('rebuild', '[guild:guild]', level=-1, group='words', global_=True)
+    def words_rebuild(self, event, guild=None):
+        guild = guild or event.guild
+        rebuild_token_counts.queue(guild.id)
+        event.msg.reply(':ok_hand: enqueued word counts to be rebuilt')
+
     @Plugin.command('usage', '<word:str> [unit:str] [amount:int]', level=-1, group='words')
     def words_usage(self, event, word, unit='days', amount=7):
-        sql = '''
-            SELECT date, coalesce(count, 0) AS count
-            FROM
-                generate_series(
-                    NOW() - interval %s,
-                    NOW(),
-                    %s
-                ) AS date
-            LEFT OUTER JOIN (
-                SELECT date_trunc(%s, timestamp) AS dt, count(*) AS count
-                FROM messages
-                WHERE
-                    timestamp >= (NOW() - interval %s) AND
-                    timestamp < (NOW()) AND
-                    guild_id=%s AND
-                    (SELECT count(*) FROM regexp_matches(content, %s)) >= 1
-                GROUP BY dt
-            ) results
-            ON (date_trunc(%s, date) = results.dt);
-        '''
+        if unit not in TokenCount.UNITS:
+            return event.msg.reply(':warning: unit must be one of {}'.format(', '.join(TokenCount.UNITS)))
+
+        # Stop words are never counted
+        tokens = tokenize(word, STOP_WORDS)
+        if len(tokens) != 1:
+            return event.msg.reply(':warning: `{}` is not a single countable word'.format(word))
 
         msg = event.msg.reply(':alarm_clock: One moment pls...')
 
         start = time.time()
-        tuples = list(Message.raw(
-            sql,
-            '{} {}'.format(amount, unit),
-            '1 {}'.format(unit),
-            unit,
-            '{} {}'.format(amount, unit),
-            event.guild.id,
-            '\s?{}\s?'.format(word),
-            unit
-        ).tuples())
+        tuples = TokenCount.series(event.guild.id, tokens[0], unit, amount)
         sql_duration = time.time() - start
 
         start = time.time()
@@ -396,25 +430,10 @@ class SQLPlugin(Plugin):
         else:
             raise Exception("You should not be here")
 
-        sql = """
-            SELECT word, count(*)
-            FROM (
-                SELECT regexp_split_to_table(content, '\s') as word
-                FROM messages
-                WHERE {}=%s
-                LIMIT 3000000
-            ) t
-            GROUP BY word
-            ORDER BY 2 DESC
-            LIMIT 30
-        """.format(q)
-
         t = MessageTable()
         t.set_header('Word', 'Count')
 
-        for word, count in Message.raw(sql, target.id).tuples():
-            if '```' in word:
-                continue
+        for word, count in TokenCount.top(q, target.id):
             t.add(word, count)
 
         event.msg.reply(t.compile())
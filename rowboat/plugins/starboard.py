@@ -1,3 +1,4 @@
+import json
 import peewee
 
 from peewee import fn, JOIN
@@ -78,6 +79,16 @@ class StarboardPlugin(Plugin):
         self.updates = {}
         self.locks = {}
 
+        # Message ids per guild which changed since the last update, and the
+        #  guilds which have been fully scanned for dirty entries since startup
+        self.dirty = ctx.get('dirty', {})
+        self.scanned = ctx.get('scanned', set())
+
+    def unload(self, ctx):
+        ctx['dirty'] = self.dirty
+        ctx['scanned'] = self.scanned
+        super(StarboardPlugin, self).unload(ctx)
+
     @Plugin.command('show', '<mid:snowflake>', group='stars', level=CommandLevels.TRUSTED)
     def stars_show(self, event, mid):
         try:
@@ -94,14 +105,7 @@ class StarboardPlugin(Plugin):
 
         _, sb_config = event.config.get_board(star.message.channel_id)
 
-        try:
-            source_msg = self.client.api.channels_messages_get(
-                star.message.channel_id,
-                star.message_id)
-        except:
-            raise CommandFail('no starboard message with that id')
-
-        content, embed = self.get_embed(star, source_msg, sb_config)
+        content, embed = self.get_embed(star, star.message, sb_config)
         event.msg.reply(content, embed=embed)
 
     @Plugin.command('stats', '[user:user]', group='stars', level=CommandLevels.MOD)
@@ -200,7 +204,7 @@ class StarboardPlugin(Plugin):
                 (StarboardEntry.message_id == mid)
             ).execute()
 
-        self.queue_update(event.guild.id, event.config)
+        self.queue_update(event.guild.id, event.config, [entry.message_id])
         event.msg.reply(u'Forcing an update on message {}'.format(mid))
 
     @Plugin.command('block', '<user:user>', group='stars', level=CommandLevels.MOD)
@@ -265,7 +269,7 @@ class StarboardPlugin(Plugin):
             event.msg.reply(u'No hidden starboard message with that ID')
             return
 
-        self.queue_update(event.guild.id, event.config)
+        self.queue_update(event.guild.id, event.config, [mid])
         event.msg.reply(u'Message {} has been unhidden from the starboard'.format(
             mid,
         ))
@@ -283,7 +287,7 @@ class StarboardPlugin(Plugin):
             event.msg.reply(u'No starred message with that ID')
             return
 
-        self.queue_update(event.guild.id, event.config)
+        self.queue_update(event.guild.id, event.config, [mid])
         event.msg.reply(u'Message {} has been hidden from the starboard'.format(
             mid,
         ))
@@ -300,6 +304,7 @@ class StarboardPlugin(Plugin):
 
         info_msg = event.msg.reply('Updating starboard...')
 
+        changed = []
         for star in stars:
             msg = self.client.api.channels_messages_get(
                 star.message.channel_id,
@@ -308,6 +313,7 @@ class StarboardPlugin(Plugin):
             users = [i.id for i in msg.get_reactors(STAR_EMOJI)]
 
             if set(users) != set(star.stars):
+                changed.append(star.message_id)
                 self.log.warning('star %s had outdated reactors list (%s vs %s)',
                     star.message_id,
                     len(users),
@@ -320,7 +326,7 @@ class StarboardPlugin(Plugin):
                     (StarboardEntry.message_id == star.message_id)
                 ).execute()
 
-        self.queue_update(event.guild.id, event.config)
+        self.queue_update(event.guild.id, event.config, changed)
         info_msg.delete()
         event.msg.reply(':ballot_box_with_check: Starboard Updated!')
 
@@ -351,7 +357,17 @@ class StarboardPlugin(Plugin):
         del self.locks[event.guild.id]
         event.msg.reply(':white_check_mark: starboard has been unlocked')
 
-    def queue_update(self, guild_id, config):
+    def queue_update(self, guild_id, config, message_ids=None):
+        """
+        Schedules an update of the guilds starboard. `message_ids` are the
+        entries which changed, if not passed every dirty entry of the guild is
+        rescanned.
+        """
+        if message_ids is None:
+            self.scanned.discard(guild_id)
+        else:
+            self.dirty.setdefault(guild_id, set()).update(message_ids)
+
         if guild_id in self.locks:
             return
 
@@ -363,51 +379,82 @@ class StarboardPlugin(Plugin):
             self.updates[guild_id].touch()
 
     def update_starboard(self, guild_id, config):
-        # Grab all dirty stars that where posted in the last 32 hours
-        stars = StarboardEntry.select().join(Message).where(
-            (StarboardEntry.dirty == 1) &
+        message_ids = self.dirty.pop(guild_id, set())
+
+        # Only look at stars that where posted in the last 32 hours
+        q = StarboardEntry.select(StarboardEntry, Message).join(Message).where(
             (Message.guild_id == guild_id) &
             (Message.timestamp > (datetime.utcnow() - timedelta(hours=32)))
         )
 
-        for star in stars:
-            sb_id, sb_config = config.get_board(star.message.channel_id)
+        # Changed entries are loaded regardless of their dirty flag, it may
+        #  have been cleared by an update which raced with the change. Entries
+        #  left dirty before we started tracking them require a full scan.
+        if guild_id in self.scanned:
+            if not message_ids:
+                return
+            q = q.where((StarboardEntry.message_id << list(message_ids)))
+        elif message_ids:
+            self.scanned.add(guild_id)
+            q = q.where((StarboardEntry.dirty == 1) | (StarboardEntry.message_id << list(message_ids)))
+        else:
+            self.scanned.add(guild_id)
+            q = q.where((StarboardEntry.dirty == 1))
 
-            if not sb_id:
-                StarboardEntry.update(dirty=False).where(StarboardEntry.message_id == star.message_id).execute()
-                continue
+        # Processed entries are marked clean in one batch at the end, entries
+        #  which failed are retried on the next update of this guild.
+        clean = []
+        pending = set(message_ids)
 
-            # If this star has no stars, delete it from the starboard
-            if not star.stars:
-                if not star.star_channel_id:
-                    StarboardEntry.update(dirty=False).where(StarboardEntry.message_id == star.message_id).execute()
-                    continue
+        try:
+            for star in q:
+                pending.discard(star.message_id)
+
+                try:
+                    updated = self.update_star(star, config)
+                except Exception:
+                    self.log.exception('Failed to update starboard entry %s: ', star.message_id)
+                    updated = False
+
+                if updated:
+                    clean.append(star)
+                else:
+                    self.dirty.setdefault(guild_id, set()).add(star.message_id)
+        except Exception:
+            # Loading the entries failed, so scan again next time
+            self.scanned.discard(guild_id)
+            self.dirty.setdefault(guild_id, set()).update(pending)
+            raise
+        finally:
+            StarboardEntry.mark_clean(clean)
+
+    def update_star(self, star, config):
+        """
+        Brings the starboard message of an entry up to date, returning whether
+        the entry is now clean.
+        """
+        sb_id, sb_config = config.get_board(star.message.channel_id)
 
-                self.delete_star(star)
-                continue
+        if not sb_id:
+            return True
 
-            # Grab the original message
-            try:
-                source_msg = self.client.api.channels_messages_get(
-                    star.message.channel_id,
-                    star.message_id)
-            except:
-                self.log.exception('Star message went missing %s / %s: ', star.message.channel_id, star.message_id)
-                # TODO: really delete this
-                self.delete_star(star, update=True)
-                continue
+        # If this star has no stars or the source message went missing,
+        #  delete it from the starboard
+        if not star.stars or star.message.deleted:
+            if star.star_channel_id:
+                self.delete_star(star, update=False)
+            return True
 
-            # If we previously posted this in the wrong starboard, delete it
-            if star.star_channel_id and (
-                    star.star_channel_id != sb_id or
-                    len(star.stars) < sb_config.min_stars) or star.blocked:
-                self.delete_star(star, update=True)
+        # If we previously posted this in the wrong starboard, delete it
+        if star.star_channel_id and (
+                star.star_channel_id != sb_id or
+                len(star.stars) < sb_config.min_stars) or star.blocked:
+            self.delete_star(star, update=False)
 
-            if len(star.stars) < sb_config.min_stars or star.blocked:
-                StarboardEntry.update(dirty=False).where(StarboardEntry.message_id == star.message_id).execute()
-                continue
+        if len(star.stars) < sb_config.min_stars or star.blocked:
+            return True
 
-            self.post_star(star, source_msg, sb_id, sb_config)
+        return self.post_star(star, star.message, sb_id, sb_config)
 
     def delete_star(self, star, update=True):
         try:
@@ -418,6 +465,10 @@ class StarboardPlugin(Plugin):
         except:
             pass
 
+        # Update this for post_star and mark_clean
+        star.star_channel_id = None
+        star.star_message_id = None
+
         if update:
             StarboardEntry.update(
                 dirty=False,
@@ -427,12 +478,11 @@ class StarboardPlugin(Plugin):
                 (StarboardEntry.message_id == star.message_id)
             ).execute()
 
-            # Update this for post_star
-            star.star_channel_id = None
-            star.star_message_id = None
-
     def post_star(self, star, source_msg, starboard_id, config):
-        # Generate the embed and post it
+        """
+        Posts or edits the starboard message for an entry, updating the entry
+        in memory. Returns whether the starboard message is now up to date.
+        """
         content, embed = self.get_embed(star, source_msg, config)
 
         if not star.star_message_id:
@@ -443,7 +493,7 @@ class StarboardPlugin(Plugin):
                         embed=embed)
             except:
                 self.log.exception('Failed to post starboard message: ')
-                return
+                return False
         else:
             try:
                 msg = self.client.api.channels_messages_modify(
@@ -460,14 +510,12 @@ class StarboardPlugin(Plugin):
                     # Recurse so we repost
                     return self.post_star(star, source_msg, starboard_id, config)
 
-        # Update our starboard entry
-        StarboardEntry.update(
-            dirty=False,
-            star_channel_id=msg.channel_id,
-            star_message_id=msg.id,
-        ).where(
-            (StarboardEntry.message_id == star.message_id)
-        ).execute()
+                self.log.exception('Failed to edit starboard message: ')
+                return False
+
+        star.star_channel_id = msg.channel_id
+        star.star_message_id = msg.id
+        return True
 
     @Plugin.listen('MessageReactionAdd', conditional=is_star_event)
     def on_message_reaction_add(self, event):
@@ -520,12 +568,12 @@ class StarboardPlugin(Plugin):
             else:
                 return
 
-        self.queue_update(event.guild.id, event.config)
+        self.queue_update(event.guild.id, event.config, [event.message_id])
 
     @Plugin.listen('MessageReactionRemove', conditional=is_star_event)
     def on_message_reaction_remove(self, event):
         StarboardEntry.remove_star(event.message_id, event.user_id)
-        self.queue_update(event.guild.id, event.config)
+        self.queue_update(event.guild.id, event.config, [event.message_id])
 
     @Plugin.listen('MessageReactionRemoveAll')
     def on_message_reaction_remove_all(self, event):
@@ -536,7 +584,7 @@ class StarboardPlugin(Plugin):
         ).where(
             (StarboardEntry.message_id == event.message_id)
         ).execute()
-        self.queue_update(event.guild.id, event.config)
+        self.queue_update(event.guild.id, event.config, [event.message_id])
 
     @Plugin.listen('MessageUpdate')
     def on_message_update(self, event):
@@ -551,7 +599,7 @@ class StarboardPlugin(Plugin):
         ).execute()
 
         if count:
-            self.queue_update(event.guild.id, event.config)
+            self.queue_update(event.guild.id, event.config, [event.message.id])
 
     @Plugin.listen('MessageDelete')
     def on_message_delete(self, event):
@@ -568,6 +616,9 @@ class StarboardPlugin(Plugin):
                 self.delete_star(star, update=False)
 
     def get_embed(self, star, msg, config):
+        """
+        Builds the starboard post for an entry from the stored `Message`.
+        """
         # Create the 'header' (non-embed) text
         stars = ':star:'
 
@@ -587,26 +638,31 @@ class StarboardPlugin(Plugin):
         embed.description = msg.content
 
         if msg.attachments:
-            attach = list(msg.attachments.values())[0]
-            if attach.url.lower().endswith(('png', 'jpeg', 'jpg', 'gif', 'webp')):
-                embed.set_image(url=attach.url)
+            attach = msg.attachments[0]
+            if attach.lower().endswith(('png', 'jpeg', 'jpg', 'gif', 'webp')):
+                embed.set_image(url=attach)
 
         if msg.embeds:
-            if msg.embeds[0].image.url:
-                embed.set_image(url=msg.embeds[0].image.url)
-            elif msg.embeds[0].thumbnail.url:
-                embed.set_image(url=msg.embeds[0].thumbnail.url)
-
-        author = msg.guild.get_member(msg.author)
+            source_embed = json.loads(msg.embeds[0])
+            if source_embed.get('image', {}).get('url'):
+                embed.set_image(url=source_embed['image']['url'])
+            elif source_embed.get('thumbnail', {}).get('url'):
+                embed.set_image(url=source_embed['thumbnail']['url'])
+
+        guild = self.state.guilds.get(msg.guild_id)
+        author = guild and guild.get_member(msg.author_id)
         if author:
             embed.set_author(
                 name=author.name,
                 icon_url=author.user.avatar_url
             )
-        else:
+        elif msg.author_id in self.state.users:
+            user = self.state.users[msg.author_id]
             embed.set_author(
-                name=msg.author.username,
-                icon_url=msg.author.avatar_url)
+                name=user.username,
+                icon_url=user.avatar_url)
+        else:
+            embed.set_author(name=msg.author.username)
 
         embed.timestamp = msg.timestamp.isoformat()
         embed.color = config.get_color(len(star.stars))
@@ -0,0 +1,8 @@
+from . import task
+from rowboat.models.message import TokenCount
+
+
+@task(max_concurrent=1, max_queue_size=10, global_lock=lambda guild_id: guild_id)
+def rebuild_token_counts(task, guild_id):
+    TokenCount.rebuild(guild_id)
+    task.log.info('Completed rebuilding token counts for guild %s', guild_id)
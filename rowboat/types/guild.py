@@ -1,6 +1,7 @@
 import os
 
 from holster.enum import Enum
+from disco.types.base import cached_property
 
 from rowboat.types import Model, SlottedModel, Field, DictField, text, raw, rule_matcher
 
@@ -53,9 +54,36 @@ class CommandsConfig(SlottedModel):
     def get_command_override(self, command):
         return rule_matcher(command, self.overrides or [])
 
+    @cached_property
+    def resolved_overrides(self):
+        return {}
+
+    def get_overrides(self, command):
+        """
+        Returns the merged overrides for a command, resolved once per config.
+        """
+        if command not in self.resolved_overrides:
+            overrides = {}
+            for obj in self.get_command_override(command):
+                overrides.update(obj)
+            self.resolved_overrides[command] = overrides
+        return self.resolved_overrides[command]
+
 
 class GuildConfig(SlottedModel):
     nickname = Field(text)
     commands = Field(CommandsConfig, default=None, create=False)
     levels = DictField(int, int)
     plugins = Field(PluginsConfig.parse)
+
+    def compute_level(self, member_id, roles):
+        user_level = 0
+        for oid in roles:
+            if oid in self.levels and self.levels[oid] > user_level:
+                user_level = self.levels[oid]
+
+        # User ID overrides should override all others
+        if member_id in self.levels:
+            user_level = self.levels[member_id]
+
+        return user_level
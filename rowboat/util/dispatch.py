@@ -0,0 +1,74 @@
+class _Node(object):
+    __slots__ = ('children', 'exact', 'prefix')
+
+    def __init__(self):
+        self.children = {}
+        self.exact = []
+        self.prefix = []
+
+
+class CommandIndex(object):
+    """
+    A prefix trie over the first word of every command (its group, or its
+    triggers for ungrouped commands), used to narrow down which commands could
+    possibly match a message before running any of their regexes.
+
+    Commands are matched with their own `compiled_regex`, so the index only
+    has to return a superset of the real matches. Group abbreviations (see
+    `Bot.group_abbrev`) are indexed as prefixes, since they match any word
+    starting with the abbreviation. Results keep the same order as
+    `Bot.get_commands_for_message`: grouped commands first, then by the order
+    commands where passed in. Commands with raw regex triggers can't be
+    indexed and are always candidates.
+    """
+    def __init__(self, commands, group_abbrev=None):
+        self._root = _Node()
+        self._commands = list(commands)
+        self._always = []
+        group_abbrev = group_abbrev or {}
+
+        for idx, command in enumerate(self._commands):
+            if getattr(command, 'is_regex', False):
+                self._always.append(idx)
+            elif command.group:
+                self._add(command.group.split(' ', 1)[0], idx)
+
+                if command.group in group_abbrev:
+                    self._add(group_abbrev[command.group], idx, prefix=True)
+            else:
+                for trigger in command.triggers:
+                    self._add(trigger.split(' ', 1)[0], idx)
+
+    def __len__(self):
+        return len(self._commands)
+
+    def _add(self, word, idx, prefix=False):
+        node = self._root
+        for char in word.lower():
+            node = node.children.setdefault(char, _Node())
+
+        (node.prefix if prefix else node.exact).append(idx)
+
+    def candidates(self, content):
+        word = content.split(' ', 1)[0].lower()
+
+        found = set(self._always)
+        node = self._root
+        for char in word:
+            node = node.children.get(char)
+            if node is None:
+                return found
+            found.update(node.prefix)
+
+        found.update(node.exact)
+        return found
+
+    def match(self, content):
+        options = []
+        for idx in sorted(self.candidates(content)):
+            command = self._commands[idx]
+            match = command.compiled_regex.match(content)
+            if match:
+                options.append((command, match))
+
+        return sorted(options, key=lambda obj: obj[0].group is None)
@@ -2,6 +2,9 @@ from __future__ import absolute_import
 
 import gevent
 
+from contextlib import contextmanager
+from gevent.lock import Semaphore
+
 
 def wait_many(*args, **kwargs):
     def _async():
@@ -15,3 +18,48 @@ def wait_many(*args, **kwargs):
         for awaitable in args:
             if awaitable.exception:
                 raven_client.captureException(exc_info=awaitable.exc_info)
+
+
+class KeyedLocks(object):
+    """
+    A table of locks created on demand for arbitrary keys. Locks are reference
+    counted and removed from the table as soon as nobody holds or waits on
+    them, so the table only ever contains keys which are currently in use.
+    """
+    def __init__(self):
+        self._locks = {}
+
+    def __len__(self):
+        return len(self._locks)
+
+    @contextmanager
+    def lock(self, *keys):
+        """
+        Acquires the locks for all keys, in the order given. Callers passing
+        multiple keys must always pass them in the same order.
+        """
+        held, waiting = [], None
+        try:
+            for key in keys:
+                entry = self._locks.get(key)
+                if not entry:
+                    entry = self._locks[key] = [Semaphore(), 0]
+                entry[1] += 1
+
+                waiting = (key, entry)
+                entry[0].acquire()
+                held.append(waiting)
+                waiting = None
+            yield
+        finally:
+            for key, entry in reversed(held):
+                entry[0].release()
+                self._unref(key, entry)
+
+            if waiting:
+                self._unref(*waiting)
+
+    def _unref(self, key, entry):
+        entry[1] -= 1
+        if not entry[1]:
+            del self._locks[key]
@@ -72,3 +72,93 @@ class LeakyBucket(object):
         if len(res) <= 1:
             return 0
         return (res[-1] - res[0]) / 1000.0
+
+
+# Buckets are stored as a hash of slot -> weight, where each slot covers
+#  `time_period / slots` milliseconds. Stale slots are dropped on every call, so
+#  a bucket never holds more than `slots + 1` fields regardless of its weight.
+#
+# function(keys=[rl_key], args=[amount, current slot, oldest live slot, expire ms])
+#  -> {count, first slot, last slot}
+WEIGHTED_INCR_SCRIPT = '''
+local key = KEYS[1]
+local oldest = tonumber(ARGV[3])
+
+if tonumber(ARGV[1]) > 0 then
+  redis.call("HINCRBY", key, ARGV[2], ARGV[1])
+end
+
+local count, first, last = 0, 0, 0
+local data = redis.call("HGETALL", key)
+for i=1,#data,2 do
+  local slot = tonumber(data[i])
+  if slot < oldest then
+    redis.call("HDEL", key, data[i])
+  else
+    count = count + tonumber(data[i + 1])
+    if first == 0 or slot < first then first = slot end
+    if slot > last then last = slot end
+  end
+end
+
+redis.call("PEXPIRE", key, ARGV[4])
+
+return {count, first, last}
+'''
+
+DEFAULT_SLOTS = 20
+
+
+def weighted_args(amount, time_period, slots=DEFAULT_SLOTS, now=None):
+    """
+    Returns the slot width and the arguments for `WEIGHTED_INCR_SCRIPT`.
+    """
+    if now is None:
+        now = get_ms_time()
+
+    width = max(1, time_period // slots)
+    slot = now // width
+    return width, [amount, slot, slot - slots + 1, time_period * 2]
+
+
+class WeightedLeakyBucket(object):
+    """
+    A drop-in replacement for `LeakyBucket` which stores a fixed number of
+    weighted slots per key instead of one sorted set member per action, making
+    weighted increments O(1) in both time and memory. The window is precise to
+    `time_period / slots` milliseconds.
+    """
+    def __init__(self, redis, key_fmt, max_actions, time_period, slots=DEFAULT_SLOTS):
+        self.redis = redis
+        self.key_fmt = key_fmt
+        self.max_actions = max_actions
+        self.time_period = time_period
+        self.slots = slots
+
+        self._script = self.redis.register_script(WEIGHTED_INCR_SCRIPT)
+
+    def _call(self, key, amount):
+        width, args = weighted_args(amount, self.time_period, self.slots)
+        count, first, last = self._script(keys=[self.key_fmt.format(key)], args=args)
+        return int(count), ((int(last) - int(first)) * width) / 1000.0
+
+    def incr(self, key, amount=1):
+        return self._call(key, amount)[0]
+
+    def check(self, key, amount=1):
+        count = self.incr(key, amount)
+        if count >= self.max_actions:
+            return False
+        return True
+
+    def get(self, key):
+        return self._call(key, 0)[0]
+
+    def clear(self, key):
+        self.redis.delete(self.key_fmt.format(key))
+
+    def count(self, key):
+        return self.get(key)
+
+    def size(self, key):
+        return self._call(key, 0)[1]
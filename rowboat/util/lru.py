@@ -0,0 +1,68 @@
+import time
+
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class LRUCache(object):
+    """
+    A simple bounded mapping which evicts the least recently used key once
+    more than `max_size` keys are stored. Keys may optionally expire after a
+    ttl (in seconds), either the cache wide default or one passed to `set`.
+    Tracks hits and misses for `get`.
+    """
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self._lookup(key) is not _MISSING
+
+    def _lookup(self, key):
+        try:
+            value, expires = self._data.pop(key)
+        except KeyError:
+            return _MISSING
+
+        if expires and expires <= time.time():
+            return _MISSING
+
+        self._data[key] = (value, expires)
+        return value
+
+    def get(self, key, default=None):
+        value = self._lookup(key)
+        if value is _MISSING:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl or self.ttl
+
+        self._data.pop(key, None)
+        self._data[key] = (value, time.time() + ttl if ttl else None)
+
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        value = self._lookup(key)
+        if value is _MISSING:
+            return default
+
+        del self._data[key]
+        return value
+
+    def clear(self):
+        self._data.clear()
@@ -0,0 +1,100 @@
+import string
+
+from collections import deque
+
+WORD_CHARS = frozenset(string.ascii_letters + string.digits + '_')
+
+
+def is_boundary(text, pos):
+    """
+    Returns whether `pos` is a word boundary in text, with the same (ascii)
+    semantics as `\\b` in a regex compiled without `re.UNICODE`.
+    """
+    before = pos > 0 and text[pos - 1] in WORD_CHARS
+    after = pos < len(text) and text[pos] in WORD_CHARS
+    return before != after
+
+
+class MultiMatcher(object):
+    """
+    An Aho-Corasick automaton which finds any number of literal patterns in a
+    single case-insensitive pass over the text. Patterns are added as
+    (pattern, tag, whole_word) tuples, where whole_word patterns only match on
+    word boundaries. `search` returns a (tag, matched text) tuple for every
+    occurrence of every pattern, in the order they end in the text.
+    """
+    def __init__(self, patterns):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]
+
+        for pattern, tag, whole_word in patterns:
+            if pattern:
+                self._insert(pattern.lower(), tag, whole_word)
+
+        self._build()
+
+    def __nonzero__(self):
+        return len(self._goto) > 1
+
+    def _insert(self, pattern, tag, whole_word):
+        state = 0
+        for char in pattern:
+            nxt = self._goto[state].get(char)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][char] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(())
+            state = nxt
+
+        self._out[state] += ((len(pattern), tag, whole_word), )
+
+    def _build(self):
+        # States directly below the root always fail back to it
+        queue = deque(self._goto[0].values())
+
+        while queue:
+            state = queue.popleft()
+
+            for char, nxt in self._goto[state].items():
+                queue.append(nxt)
+
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+
+                self._fail[nxt] = self._goto[fail].get(char, 0)
+                self._out[nxt] += self._out[self._fail[nxt]]
+
+    def search(self, text):
+        hits = []
+        if not self:
+            return hits
+
+        goto, fail, out = self._goto, self._fail, self._out
+
+        # Full case mapping may expand a character (e.g. u'\u0130'), in which
+        #  case offsets are mapped back to the character they came from.
+        lowered = text.lower()
+        offsets = None
+        if len(lowered) != len(text):
+            offsets = [idx for idx, char in enumerate(text) for _ in char.lower()]
+
+        state = 0
+        for pos, char in enumerate(lowered):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+
+            for length, tag, whole_word in out[state]:
+                start, end = pos - length + 1, pos + 1
+                if offsets:
+                    start, end = offsets[start], offsets[end - 1] + 1
+
+                if whole_word and not (is_boundary(text, start) and is_boundary(text, end)):
+                    continue
+                hits.append((tag, text[start:end]))
+
+        return hits
@@ -0,0 +1,115 @@
+from rowboat.util.lru import LRUCache
+from rowboat.util.leakybucket import DEFAULT_SLOTS, WEIGHTED_INCR_SCRIPT, get_ms_time, weighted_args
+
+
+class SlidingWindow(object):
+    """
+    A sliding window counter backed by a fixed size array of slots. Each slot
+    covers `interval / slots` milliseconds and remembers which absolute slot
+    index it currently holds, so stale slots are reset lazily on write and
+    ignored on read.
+    """
+    __slots__ = ('interval', 'width', 'counts', 'indexes')
+
+    def __init__(self, interval, slots=DEFAULT_SLOTS):
+        self.interval = interval
+        self.width = max(1, interval // slots)
+        self.counts = [0] * slots
+        self.indexes = [-1] * slots
+
+    def add(self, now, amount):
+        idx = now // self.width
+        cell = idx % len(self.counts)
+
+        if self.indexes[cell] != idx:
+            self.indexes[cell] = idx
+            self.counts[cell] = 0
+
+        self.counts[cell] += amount
+
+    def _live(self, now):
+        oldest = (now // self.width) - len(self.counts) + 1
+        return [(idx, count) for idx, count in zip(self.indexes, self.counts) if idx >= oldest and count]
+
+    def count(self, now):
+        return sum(count for _, count in self._live(now))
+
+    def size(self, now):
+        """
+        Returns the number of seconds between the oldest and newest action
+        within the window.
+        """
+        live = self._live(now)
+        if len(live) <= 1:
+            return 0
+        idxs = [idx for idx, _ in live]
+        return ((max(idxs) - min(idxs)) * self.width) / 1000.0
+
+
+class RateLimitEngine(object):
+    """
+    Evaluates many sliding window rate limits in one go. A check is a tuple of
+    (key, amount, limit, interval) where key is a tuple identifying the bucket
+    and interval is in milliseconds. `check` returns a list with one
+    (exceeded, count, size) tuple per check.
+
+    By default all windows are kept in memory. If `redis` is passed the
+    windows are instead stored as `WeightedLeakyBucket` hashes and every call
+    to `check` is written through as a single pipeline, which allows multiple
+    processes to share the same limits.
+    """
+    def __init__(self, redis=None, max_keys=100000, slots=DEFAULT_SLOTS):
+        self.redis = redis
+        self.slots = slots
+        self._windows = LRUCache(max_keys)
+
+        if self.redis:
+            self._script = self.redis.register_script(WEIGHTED_INCR_SCRIPT)
+
+    def check(self, checks, now=None):
+        if now is None:
+            now = get_ms_time()
+
+        if self.redis:
+            return self._check_redis(checks, now)
+        return self._check_local(checks, now)
+
+    def clear(self):
+        self._windows.clear()
+
+    def _check_local(self, checks, now):
+        results = []
+
+        for key, amount, limit, interval in checks:
+            window = self._windows.get(key)
+            if not window or window.interval != interval:
+                window = SlidingWindow(interval, self.slots)
+                self._windows.set(key, window)
+
+            if amount:
+                window.add(now, amount)
+
+            count = window.count(now)
+            results.append((count >= limit, count, window.size(now)))
+
+        return results
+
+    def _check_redis(self, checks, now):
+        pipe = self.redis.pipeline(transaction=False)
+
+        widths = []
+        for key, amount, limit, interval in checks:
+            width, args = weighted_args(amount, interval, self.slots, now)
+            self._script(keys=[self._redis_key(key)], args=args, client=pipe)
+            widths.append(width)
+
+        results = []
+        for (key, amount, limit, interval), width, (count, first, last) in zip(checks, widths, pipe.execute()):
+            size = ((int(last) - int(first)) * width) / 1000.0
+            results.append((int(count) >= limit, int(count), size))
+
+        return results
+
+    @staticmethod
+    def _redis_key(key):
+        return u'rl:{}'.format(u':'.join(map(unicode, key)))
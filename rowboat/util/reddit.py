@@ -0,0 +1,51 @@
+import requests
+
+USER_AGENT = 'discord:RowBoat:v0.0.1 (by /u/b1naryth1ef)'
+
+
+class RedditClient(object):
+    """
+    A minimal client for subreddit listings which remembers the ETag of the
+    last listing fetched for each subreddit, so unchanged listings are answered
+    with an empty 304 by reddit.
+    """
+    def __init__(self, base_url='https://www.reddit.com', timeout=10):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = USER_AGENT
+
+        self._etags = {}
+
+    def get_new_posts(self, sub, limit=25):
+        """
+        Returns the newest posts of a subreddit, oldest first, or an empty list
+        if nothing changed since the last call.
+        """
+        headers = {}
+        if sub in self._etags:
+            headers['If-None-Match'] = self._etags[sub]
+
+        r = self.session.get(
+            u'{}/r/{}/new.json'.format(self.base_url, sub),
+            params={'limit': limit},
+            headers=headers,
+            timeout=self.timeout)
+
+        if r.status_code == 304:
+            return []
+
+        r.raise_for_status()
+
+        if r.headers.get('ETag'):
+            self._etags[sub] = r.headers['ETag']
+
+        return list(reversed([i['data'] for i in r.json()['data']['children']]))
+
+    def forget(self, sub):
+        """
+        Drops the stored ETag of a subreddit, so the next call fetches its full
+        listing even if it did not change.
+        """
+        self._etags.pop(sub, None)
@@ -1,55 +1,185 @@
 from __future__ import absolute_import
 
+import json
 import gevent
 
+from abc import ABCMeta, abstractmethod
 from gevent.lock import Semaphore
+from redis.exceptions import ConnectionError
+from disco.util.logging import LoggingClass
 
 
-class RedisSet(object):
-    def __init__(self, rdb, key_name):
+class RedisReplicated(LoggingClass):
+    """
+    Base class for a local, read-only-fast mirror of a Redis key. Writers
+    update Redis and publish the change on a pubsub channel which every
+    mirror listens on. Whenever the subscription is (re)established the
+    mirror reloads the full key, so changes missed while disconnected are
+    never lost.
+
+    Subclasses implement `_load` (read the full key) and `_apply` (apply a
+    single published change) and operate on `self._data`.
+    """
+    __metaclass__ = ABCMeta
+
+    channel_fmt = None
+
+    def __init__(self, rdb, key_name, coerce=None):
         self.rdb = rdb
         self.key_name = key_name
-        self.update_key_name = u'redis-set:{}'.format(self.key_name)
+        self.update_key_name = self.channel_fmt.format(key_name)
+        self.coerce = coerce or (lambda value: value)
 
-        self._set = rdb.smembers(key_name)
         self._lock = Semaphore()
+        self._data = self._load()
+
         self._ps = self.rdb.pubsub()
         self._ps.subscribe(self.update_key_name)
-
         self._inst = gevent.spawn(self._listener)
 
+    def __len__(self):
+        return len(self._data)
+
+    def __iter__(self):
+        return iter(self._data)
+
     def __contains__(self, other):
-        return other in self._set
+        return other in self._data
+
+    def close(self):
+        if self._inst:
+            self._inst.kill()
+            self._inst = None
+        self._ps.close()
+
+    def resync(self):
+        with self._lock:
+            self._data = self._load()
+
+    def _publish(self, op, data):
+        self.rdb.publish(self.update_key_name, u'{}{}'.format(op, data))
+
+    def _listener(self):
+        while True:
+            try:
+                for item in self._ps.listen():
+                    # Sent on every (re)subscribe, we may have missed updates
+                    if item['type'] == 'subscribe':
+                        self.resync()
+                        continue
+
+                    if item['type'] != 'message':
+                        continue
+
+                    with self._lock:
+                        self._apply(item['data'][0], item['data'][1:])
+            except ConnectionError:
+                self.log.warning('Lost connection while replicating %s, reconnecting', self.key_name)
+                gevent.sleep(1)
+
+                try:
+                    self._ps.close()
+                    self._ps = self.rdb.pubsub()
+                    self._ps.subscribe(self.update_key_name)
+                except ConnectionError:
+                    continue
+
+    @abstractmethod
+    def _load(self):
+        pass
+
+    @abstractmethod
+    def _apply(self, op, data):
+        pass
+
+
+class RedisSet(RedisReplicated):
+    """
+    A replicated Redis set. Members are stored as strings in Redis and passed
+    through `coerce` locally, so e.g. `coerce=int` allows checking ids.
+    """
+    channel_fmt = u'redis-set:{}'
 
     def add(self, key):
-        if key in self._set:
+        key = self.coerce(key)
+        if key in self._data:
             return
 
         with self._lock:
             self.rdb.sadd(self.key_name, key)
-            self._set.add(key)
-            self.rdb.publish(self.update_key_name, u'A{}'.format(key))
+            self._data.add(key)
+            self._publish('A', key)
 
     def remove(self, key):
-        if key not in self._set:
+        key = self.coerce(key)
+        if key not in self._data:
             return
 
         with self._lock:
             self.rdb.srem(self.key_name, key)
-            self._set.remove(key)
-            self.rdb.publish(self.update_key_name, u'R{}'.format(key))
+            self._data.remove(key)
+            self._publish('R', key)
 
-    def _listener(self):
-        for item in self._ps.listen():
-            if item['type'] != 'message':
-                continue
-
-            with self._lock:
-                op, data = item['data'][0], item['data'][1:]
-
-                if op == 'A':
-                    if data not in self._set:
-                        self._set.add(data)
-                elif op == 'R':
-                    if data in self._set:
-                        self._set.remove(data)
+    def _load(self):
+        return set(map(self.coerce, self.rdb.smembers(self.key_name)))
+
+    def _apply(self, op, data):
+        data = self.coerce(data)
+
+        if op == 'A':
+            self._data.add(data)
+        elif op == 'R':
+            self._data.discard(data)
+
+
+class RedisHash(RedisReplicated):
+    """
+    A replicated Redis hash. Fields are passed through `coerce` and values
+    through `value_coerce` locally.
+    """
+    channel_fmt = u'redis-hash:{}'
+
+    def __init__(self, rdb, key_name, coerce=None, value_coerce=None):
+        self.value_coerce = value_coerce or (lambda value: value)
+        super(RedisHash, self).__init__(rdb, key_name, coerce)
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def items(self):
+        return self._data.items()
+
+    def set(self, key, value):
+        key, value = self.coerce(key), self.value_coerce(value)
+
+        with self._lock:
+            self.rdb.hset(self.key_name, key, value)
+            self._data[key] = value
+            self._publish('S', json.dumps([key, value]))
+
+    def delete(self, key):
+        key = self.coerce(key)
+        if key not in self._data:
+            return
+
+        with self._lock:
+            self.rdb.hdel(self.key_name, key)
+            del self._data[key]
+            self._publish('D', json.dumps([key]))
+
+    def _load(self):
+        return {
+            self.coerce(k): self.value_coerce(v)
+            for k, v in self.rdb.hgetall(self.key_name).items()
+        }
+
+    def _apply(self, op, data):
+        data = json.loads(data)
+
+        if op == 'S':
+            self._data[self.coerce(data[0])] = self.value_coerce(data[1])
+        elif op == 'D':
+            self._data.pop(self.coerce(data[0]), None)
@@ -0,0 +1,29 @@
+import time
+
+from collections import deque
+
+
+class TimedRingBuffer(object):
+    """
+    A bounded buffer of the most recent (timestamp, value) pairs. `started`
+    records from when on the buffer has seen every value, which lets callers
+    tell whether it can answer a query for a given window or if they need to
+    fall back to another source (e.g. right after a restart).
+    """
+    __slots__ = ('started', '_items')
+
+    def __init__(self, maxlen, started=None):
+        self.started = started or time.time()
+        self._items = deque(maxlen=maxlen)
+
+    def __len__(self):
+        return len(self._items)
+
+    def append(self, value, timestamp=None):
+        self._items.append((timestamp or time.time(), value))
+
+    def covers(self, since):
+        return self.started <= since
+
+    def since(self, since):
+        return [value for timestamp, value in self._items if timestamp > since]
@@ -0,0 +1,55 @@
+import string
+
+_parser = string.Formatter()
+
+
+def default_convert(value, conversion):
+    return unicode(value)
+
+
+class Template(object):
+    """
+    A `str.format` style template which is parsed once up front, so rendering
+    only has to resolve fields and join the parts. Field conversions (`!s`,
+    `!r` or custom ones) are applied through `convert(value, conversion)`.
+    Nested replacement fields within format specs are not supported.
+    """
+    __slots__ = ('fmt', 'convert', '_parts')
+
+    def __init__(self, fmt, convert=default_convert):
+        self.fmt = fmt
+        self.convert = convert
+        self._parts = [
+            (literal, self._compile_field(field_name) if field_name is not None else None, spec, conversion)
+            for literal, field_name, spec, conversion in _parser.parse(unicode(fmt))
+        ]
+
+    @staticmethod
+    def _compile_field(field_name):
+        first, rest = field_name._formatter_field_name_split()
+        if first == '':
+            raise ValueError('Template fields must be named')
+
+        rest = list(rest)
+
+        def getter(kwargs):
+            obj = kwargs[first]
+            for is_attr, key in rest:
+                obj = getattr(obj, key) if is_attr else obj[key]
+            return obj
+        return getter
+
+    def render(self, **kwargs):
+        out = []
+
+        for literal, getter, spec, conversion in self._parts:
+            if literal:
+                out.append(literal)
+
+            if getter is None:
+                continue
+
+            value = self.convert(getter(kwargs), conversion)
+            out.append(format(value, spec) if spec else value)
+
+        return u''.join(out)
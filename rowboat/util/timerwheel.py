@@ -0,0 +1,89 @@
+import math
+import time
+
+
+class TimerWheel(object):
+    """
+    A hierarchical timing wheel which tracks when items expire. Adding and
+    removing an item is O(1), and `advance` only touches the items which
+    expire (or move down a level) in the elapsed ticks, instead of scanning
+    every tracked item.
+
+    Each of the `levels` wheels has `slots` slots; a slot on level n covers
+    `slots ** n` ticks of `resolution` seconds. Items further out than the
+    top level covers are parked until the top level wraps around.
+    """
+    def __init__(self, resolution=1.0, slots=64, levels=3, now=None):
+        self.resolution = resolution
+        self.slots = slots
+        self.levels = levels
+
+        self._tick = int((time.time() if now is None else now) / resolution)
+        self._wheels = [[set() for _ in range(slots)] for _ in range(levels)]
+        self._overflow = set()
+
+        # item -> (tick, bucket)
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, item):
+        return item in self._entries
+
+    def add(self, item, expires_at):
+        self.remove(item)
+
+        # Items which already expired go off on the next tick
+        self._place(item, max(int(math.ceil(expires_at / self.resolution)), self._tick + 1))
+
+    def remove(self, item):
+        entry = self._entries.pop(item, None)
+        if entry:
+            entry[1].discard(item)
+
+    def advance(self, now=None):
+        """
+        Moves the wheel forward to `now`, returning every item which expired.
+        """
+        target = int((time.time() if now is None else now) / self.resolution)
+        expired = []
+
+        while self._tick < target:
+            self._tick += 1
+
+            # Cascade the higher levels first, they may move items down into
+            #  the slot which expires on this tick.
+            for level in range(self.levels, 0, -1):
+                span = self.slots ** level
+                if self._tick % span:
+                    continue
+
+                if level == self.levels:
+                    bucket, self._overflow = self._overflow, set()
+                else:
+                    bucket = self._wheels[level][(self._tick // span) % self.slots]
+                    self._wheels[level][(self._tick // span) % self.slots] = set()
+
+                for item in bucket:
+                    self._place(item, self._entries[item][0])
+
+            slot = self._tick % self.slots
+            bucket, self._wheels[0][slot] = self._wheels[0][slot], set()
+            for item in bucket:
+                del self._entries[item]
+                expired.append(item)
+
+        return expired
+
+    def _place(self, item, tick):
+        delta = tick - self._tick
+
+        bucket = self._overflow
+        for level in range(self.levels):
+            if delta < self.slots ** (level + 1):
+                bucket = self._wheels[level][(tick // (self.slots ** level)) % self.slots]
+                break
+
+        bucket.add(item)
+        self._entries[item] = (tick, bucket)
@@ -0,0 +1,38 @@
+import re
+
+from collections import Counter
+
+# Mentions, channels, custom emoji and links are never counted as words
+IGNORED_RE = re.compile(r'<[@#:!&a-zA-Z0-9_]+>|https?://\S+')
+WORD_RE = re.compile(r"\w[\w']*", re.U)
+
+MIN_LENGTH = 2
+MAX_LENGTH = 32
+
+
+def load_stop_words(path):
+    if not path:
+        return frozenset()
+
+    with open(path, 'r') as f:
+        return frozenset(line.strip().lower() for line in f if line.strip())
+
+
+def tokenize(text, stop_words=frozenset()):
+    """
+    Splits a message into lowercased word tokens, dropping stop words, tokens
+    which are purely numeric and tokens outside of a sane length.
+    """
+    tokens = []
+
+    for token in WORD_RE.findall(IGNORED_RE.sub(u' ', text or u'').lower()):
+        token = token.strip(u"'_")
+        if not MIN_LENGTH <= len(token) <= MAX_LENGTH or token.isdigit() or token in stop_words:
+            continue
+        tokens.append(token)
+
+    return tokens
+
+
+def count_tokens(text, stop_words=frozenset()):
+    return Counter(tokenize(text, stop_words))
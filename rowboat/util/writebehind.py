@@ -0,0 +1,143 @@
+from __future__ import absolute_import
+
+import time
+import gevent
+
+from gevent.event import Event
+from gevent.lock import Semaphore
+from disco.util.logging import LoggingClass
+
+from rowboat.util.stats import statsd, timed, to_tags
+
+
+class WriteBehindBuffer(LoggingClass):
+    """
+    Collects items in memory and hands them to `flush_func` in batches, either
+    once every `interval` seconds or as soon as `max_rows` items are pending.
+
+    Items are always flushed in the order they were added, and only one flush
+    runs at a time. Once `max_pending` items are waiting the buffer applies
+    backpressure: if `block` is set the producer performs the flush itself
+    (and thus waits on the database), otherwise the item is dropped.
+
+    A batch which fails to flush is put back in front of the pending items and
+    retried with the next flush, until it failed `max_retries` times in a row.
+
+    If a `key_func` is given, the items which were not written yet (including
+    the ones being flushed) can be looked up by their key with `pending`.
+    """
+    def __init__(self, name, flush_func, interval=0.5, max_rows=500, max_pending=10000, block=True,
+                 max_retries=3, key_func=None):
+        self.name = name
+        self.flush_func = flush_func
+        self.interval = interval
+        self.max_rows = max_rows
+        self.max_pending = max_pending
+        self.block = block
+        self.max_retries = max_retries
+        self.key_func = key_func
+
+        self.dropped = 0
+        self.failures = 0
+
+        self._items = []
+        self._pending = {}
+        self._have = Event()
+        self._lock = Semaphore()
+        self._tags = to_tags(buffer=name)
+
+        self._greenlet = gevent.spawn(self._flush_loop)
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item):
+        if len(self._items) >= self.max_pending:
+            if not self.block:
+                self.dropped += 1
+                statsd.increment('rowboat.buffer.dropped', tags=self._tags)
+                return False
+
+            statsd.increment('rowboat.buffer.backpressure', tags=self._tags)
+            with timed('rowboat.buffer.backpressure.wait', tags=self._tags):
+                self.flush()
+
+        self._items.append(item)
+
+        if self.key_func:
+            self._pending.setdefault(self.key_func(item), []).append(item)
+
+        if len(self._items) >= self.max_rows:
+            self._have.set()
+
+        return True
+
+    def flush(self):
+        with self._lock:
+            # Swap the pending list out, producers never wait on the lock
+            items, self._items = self._items, []
+            if not items:
+                return 0
+
+            statsd.gauge('rowboat.buffer.depth', len(items), tags=self._tags)
+
+            start = time.time()
+            try:
+                self.flush_func(items)
+                self._forget(items)
+            except Exception:
+                self.failures += 1
+                self.log.exception('Failed to flush %s items for buffer %s: ', len(items), self.name)
+
+                if self.failures > self.max_retries:
+                    self.failures = 0
+                    self._forget(items)
+                    statsd.increment('rowboat.buffer.failed', len(items), tags=self._tags)
+                else:
+                    statsd.increment('rowboat.buffer.retried', len(items), tags=self._tags)
+                    self._items[:0] = items
+                return 0
+            finally:
+                statsd.timing('rowboat.buffer.flush', (time.time() - start) * 1000, tags=self._tags)
+
+            self.failures = 0
+            statsd.increment('rowboat.buffer.flushed', len(items), tags=self._tags)
+            return len(items)
+
+    def pending(self, key):
+        """
+        Returns the items for `key` which were not written yet, oldest first.
+        """
+        return list(self._pending.get(key, ()))
+
+    def stop(self):
+        """
+        Stops the background flusher and writes out everything still pending.
+        """
+        if self._greenlet:
+            self._greenlet.kill()
+            self._greenlet = None
+
+        return self.flush()
+
+    def _forget(self, items):
+        if not self.key_func:
+            return
+
+        # Items are written in order, so they are always the oldest ones for
+        #  their key.
+        for item in items:
+            key = self.key_func(item)
+            del self._pending[key][0]
+            if not self._pending[key]:
+                del self._pending[key]
+
+    def _flush_loop(self):
+        while True:
+            self._have.wait(timeout=self.interval)
+            self._have.clear()
+
+            try:
+                self.flush()
+            except Exception:
+                self.log.exception('Exception in WriteBehindBuffer._flush_loop: ')
@@ -1,7 +1,8 @@
 import json
+import zlib
 import subprocess
 
-from flask import Blueprint, g, make_response
+from flask import Blueprint, g, request, Response, stream_with_context
 from datetime import datetime
 
 from rowboat.redis import rdb
@@ -47,17 +48,40 @@ def archive(aid, fmt):
     except MessageArchive.DoesNotExist:
         return 'Invalid or Expires Archive ID', 404
 
+    if fmt not in MessageArchive.FORMATS:
+        return 'Invalid Format', 400
+
+    # The set of messages in an archive never changes, but their content,
+    #  deleted state and authors can
+    etag = '"{}.{}.{}"'.format(archive.archive_id, fmt, archive.version())
+    if etag in request.headers.get('If-None-Match', ''):
+        return '', 304
+
     mime_type = None
     if fmt == 'json':
-        mime_type == 'application/json'
+        mime_type = 'application/json'
     elif fmt == 'txt':
         mime_type = 'text/plain'
     elif fmt == 'csv':
         mime_type = 'text/csv'
 
-    res = make_response(archive.encode(fmt))
-    res.headers['Content-Type'] = mime_type
-    return res
+    body = archive.encode_stream(fmt)
+    headers = {'ETag': etag, 'Vary': 'Accept-Encoding'}
+
+    if 'gzip' in request.accept_encodings:
+        body = gzip_stream(body)
+        headers['Content-Encoding'] = 'gzip'
+
+    return Response(stream_with_context(body), mimetype=mime_type, headers=headers)
+
+
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
 
 
 @dashboard.route('/api/deploy', methods=['POST'])
@@ -3,12 +3,14 @@ import json
 import functools
 import operator
 
-from flask import Blueprint, request, g, jsonify
+from datetime import datetime
+
+from flask import Blueprint, request, g, jsonify, escape
 
 from rowboat.util.decos import authed
 from rowboat.models.guild import Guild, GuildConfigChange
 from rowboat.models.user import User, Infraction
-from rowboat.models.message import Message
+from rowboat.models.message import Message, MessageRollup
 
 guilds = Blueprint('guilds', __name__, url_prefix='/api/guilds')
 
@@ -205,40 +207,60 @@ def guild_config_history(guild):
     return jsonify(map(serialize, q))
 
 
+# Private use characters mark highlights, so they survive escaping the content
+HIGHLIGHT_START, HIGHLIGHT_STOP = u'\ue000', u'\ue001'
+
+
+@guilds.route('/<gid>/messages/search', methods=['GET'])
+@with_guild
+def guild_messages_search(guild):
+    query = request.values.get('q', '').strip()
+    if not query:
+        return 'Missing Query', 400
+
+    def timestamp(name):
+        value = request.values.get(name)
+        return datetime.utcfromtimestamp(float(value)) if value else None
+
+    try:
+        limit = min(max(int(request.values.get('limit', 25)), 1), 100)
+
+        results, cursor = Message.search(
+            query,
+            guild.guild_id,
+            channel_id=request.values.get('channel_id', type=int),
+            author_id=request.values.get('author_id', type=int),
+            after=timestamp('after'),
+            before=timestamp('before'),
+            cursor=request.values.get('cursor'),
+            limit=limit,
+            highlight=(HIGHLIGHT_START, HIGHLIGHT_STOP))
+    except ValueError:
+        return 'Invalid Parameters', 400
+
+    for result in results:
+        result['id'] = str(result['id'])
+        result['channel_id'] = str(result['channel_id'])
+        result['author_id'] = str(result['author_id'])
+        result['timestamp'] = result['timestamp'].isoformat()
+        result['headline'] = unicode(escape(result['headline'])).replace(
+            HIGHLIGHT_START, u'<mark>').replace(HIGHLIGHT_STOP, u'</mark>')
+
+    return jsonify({
+        'results': results,
+        'cursor': cursor,
+    })
+
+
 @guilds.route('/<gid>/stats/messages', methods=['GET'])
 @with_guild()
 def guild_stats_messages(guild):
     unit = request.values.get('unit', 'days')
     amount = int(request.values.get('amount', 7))
 
-    sql = '''
-        SELECT date, coalesce(count, 0) AS count
-        FROM
-            generate_series(
-                NOW() - interval %s,
-                NOW(),
-                %s
-            ) AS date
-        LEFT OUTER JOIN (
-            SELECT date_trunc(%s, timestamp) AS dt, count(*) AS count
-            FROM messages
-            WHERE
-                timestamp >= (NOW() - interval %s) AND
-                timestamp < (NOW()) AND
-                guild_id=%s AND
-            GROUP BY dt
-        ) results
-        ON (date_trunc(%s, date) = results.dt);
-    '''
-
-    tuples = list(Message.raw(
-        sql,
-        '{} {}'.format(amount, unit),
-        '1 {}'.format(unit),
-        unit,
-        '{} {}'.format(amount, unit),
-        guild.guild_id,
-        unit
-    ).tuples())
+    if unit not in MessageRollup.UNITS:
+        return 'Invalid unit', 400
+
+    tuples = MessageRollup.series(guild.guild_id, unit, amount)
 
     return jsonify(tuples)
@@ -0,0 +1,116 @@
+from gevent.monkey import patch_all
+patch_all()  # noqa: E402
+
+from rowboat.plugins.modlog.pump import (
+    ModLogPump, ModLogScheduler, MAX_CONTENT_LENGTH, MAX_DESCRIPTION_LENGTH
+)
+
+
+class FakeChannel(object):
+    id = 1
+    guild_id = 2
+
+
+class FakeScheduler(object):
+    def __init__(self):
+        self.scheduled = []
+
+    def schedule(self, pump):
+        self.scheduled.append(pump)
+
+
+class FakePool(object):
+    def __init__(self):
+        self.spawned = []
+
+    def spawn(self, func, pump):
+        self.spawned.append(pump)
+
+
+class FakePump(object):
+    def __init__(self, wait=0, pending=0):
+        self.wait = wait
+        self.pending = pending
+        self.channel = FakeChannel()
+
+    def __len__(self):
+        return self.pending
+
+    def ready_in(self, now):
+        return self.wait
+
+    def emit(self):
+        self.pending = max(self.pending - 1, 0)
+
+
+def test_pack_lines():
+    pump = ModLogPump(FakeChannel(), FakeScheduler())
+    for idx in range(3):
+        pump.send(u'line {}'.format(idx))
+
+    content, description, items = pump.pack()
+    assert content == u'line 0\nline 1\nline 2'
+    assert description == u''
+    assert len(items) == 3
+    assert len(pump) == 0
+
+
+def test_pack_oversized_line():
+    pump = ModLogPump(FakeChannel(), FakeScheduler())
+    pump.send(u'a' * (MAX_CONTENT_LENGTH + 10))
+    pump.send(u'next')
+
+    content, _, items = pump.pack()
+    assert len(content) == MAX_CONTENT_LENGTH
+    assert content.endswith(u'...')
+    assert len(items) == 1
+
+    # The following line is kept for the next message
+    assert pump.pack()[0] == u'next'
+
+
+def test_pack_embed_overflow():
+    pump = ModLogPump(FakeChannel(), FakeScheduler())
+    line = u'x' * 99
+    for _ in range(50):
+        pump.send(line)
+
+    content, description, items = pump.pack(embed=True)
+    assert len(content) <= MAX_CONTENT_LENGTH
+    assert len(description) <= MAX_DESCRIPTION_LENGTH
+    assert len(content.split(u'\n')) == 20
+    assert len(description.split(u'\n')) == 20
+    assert len(items) == 40
+    assert len(pump) == 10
+
+
+def test_pack_restore():
+    pump = ModLogPump(FakeChannel(), FakeScheduler())
+    pump.send(u'one\ntwo')
+    pump.send(u'three')
+
+    _, _, items = pump.pack()
+    pump.restore(items, 0)
+    assert pump.pack()[0] == u'one\ntwo\nthree'
+
+
+def test_scheduler_round_robin():
+    scheduler = ModLogScheduler()
+    scheduler.stop()
+    scheduler._pool = FakePool()
+
+    ready, limited, other = FakePump(pending=2), FakePump(wait=3, pending=1), FakePump(pending=1)
+    for pump in (ready, limited, other, ready):
+        scheduler.schedule(pump)
+
+    # Each pump is only queued once, rate limited pumps wait for their turn
+    assert scheduler._dispatch() == 3
+    assert scheduler._pool.spawned == [ready, other]
+    assert list(scheduler._ready) == [limited]
+
+    # Pumps with lines left are queued again after sending
+    scheduler._send(ready)
+    scheduler._send(other)
+    assert list(scheduler._ready) == [limited, ready]
+    assert other not in scheduler._scheduled
+    assert ready in scheduler._scheduled
@@ -0,0 +1,43 @@
+import re
+
+from collections import namedtuple
+
+from rowboat.util.dispatch import CommandIndex
+
+FakeCommand = namedtuple('FakeCommand', ('triggers', 'group', 'compiled_regex', 'is_regex'))
+
+
+def command(triggers, group=None, abbrev=None):
+    prefix = u''
+    if group:
+        prefix = u'{}(?:\\w+)? '.format(abbrev) if abbrev else group + u' '
+    regex = re.compile(u'^{}({})( (.*)$|$)'.format(prefix, u'|'.join(triggers)), re.I)
+    return FakeCommand(triggers, group, regex, False)
+
+
+def test_command_index():
+    ping = command([u'ping'])
+    info = command([u'info', u'i'], u'infractions', u'inf')
+    search = command([u'search'], u'infractions', u'inf')
+    clean = command([u'clean all'])
+
+    index = CommandIndex([ping, info, search, clean], {u'infractions': u'inf'})
+
+    assert [c for c, _ in index.match(u'ping')] == [ping]
+    assert [c for c, _ in index.match(u'PING pong')] == [ping]
+    assert [c for c, _ in index.match(u'infractions info 1')] == [info]
+    assert [c for c, _ in index.match(u'inf search 1')] == [search]
+    assert [c for c, _ in index.match(u'clean all')] == [clean]
+    assert index.match(u'pingg') == []
+    assert index.match(u'hello there') == []
+    assert index.candidates(u'hello there') == set()
+
+
+def test_command_index_regex():
+    ping = command([u'ping'])
+    thanks = FakeCommand([u'(thanks|ty)'], None, re.compile(u'(thanks|ty)', re.I), True)
+
+    index = CommandIndex([ping, thanks])
+
+    assert [c for c, _ in index.match(u'ty bot')] == [thanks]
+    assert index.candidates(u'hello') == {1}
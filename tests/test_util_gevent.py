@@ -0,0 +1,28 @@
+from gevent.monkey import patch_all
+patch_all()  # noqa: E402
+
+import gevent
+
+from rowboat.util.gevent import KeyedLocks
+
+
+def test_keyed_locks():
+    locks = KeyedLocks()
+    order = []
+
+    def worker(key, name):
+        with locks.lock(key):
+            order.append(name)
+            gevent.sleep(0.05)
+            order.append(name)
+
+    gevent.joinall([
+        gevent.spawn(worker, 'a', 1),
+        gevent.spawn(worker, 'a', 2),
+        gevent.spawn(worker, 'b', 3),
+    ])
+
+    # Different keys interleave, the same key runs one after the other
+    assert order[:2] == [1, 3]
+    assert [i for i in order if i != 3] == [1, 1, 2, 2]
+    assert len(locks) == 0
@@ -0,0 +1,31 @@
+import unittest
+
+from gevent import monkey; monkey.patch_all()
+
+from rowboat.redis import rdb
+from rowboat.util.leakybucket import LeakyBucket, WeightedLeakyBucket
+
+
+class TestWeightedLeakyBucket(unittest.TestCase):
+    def test_matches_leaky_bucket(self):
+        old = LeakyBucket(rdb, 'TESTING:lb:{}', 10, 5000)
+        new = WeightedLeakyBucket(rdb, 'TESTING:wlb:{}', 10, 5000)
+        old.clear(1)
+        new.clear(1)
+
+        for amount in (1, 3, 0, 4):
+            self.assertEquals(old.check(1, amount), new.check(1, amount))
+            self.assertEquals(old.count(1), new.count(1))
+
+        self.assertFalse(new.check(1, 2))
+        self.assertEquals(new.count(1), 10)
+
+    def test_constant_memory(self):
+        bucket = WeightedLeakyBucket(rdb, 'TESTING:wlb:{}', 10, 5000)
+        bucket.clear(2)
+
+        bucket.incr(2, 2000)
+        bucket.incr(2, 2000)
+
+        self.assertEquals(bucket.get(2), 4000)
+        self.assertLessEqual(rdb.hlen('TESTING:wlb:2'), bucket.slots + 1)
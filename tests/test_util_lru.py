@@ -0,0 +1,39 @@
+import time
+import unittest
+
+from rowboat.util.lru import LRUCache
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_eviction(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+
+        # Touch a so b becomes the oldest entry
+        self.assertEquals(cache.get('a'), 1)
+        cache.set('c', 3)
+
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertTrue('c' in cache)
+        self.assertEquals(len(cache), 2)
+
+    def test_counters(self):
+        cache = LRUCache(10)
+        cache.set('a', 1)
+        cache.get('a')
+        cache.get('b')
+
+        self.assertEquals(cache.hits, 1)
+        self.assertEquals(cache.misses, 1)
+
+    def test_ttl(self):
+        cache = LRUCache(10, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=0.01)
+        time.sleep(0.02)
+
+        self.assertEquals(cache.get('a'), 1)
+        self.assertEquals(cache.get('b', 'gone'), 'gone')
+        self.assertFalse('b' in cache)
@@ -0,0 +1,44 @@
+import re
+import random
+import string
+
+from rowboat.util.matcher import MultiMatcher
+
+
+def test_matcher_tags():
+    matcher = MultiMatcher([
+        (u'he', 1, False),
+        (u'she', 2, False),
+        (u'hers', 1, False),
+        (u'his', 2, True),
+    ])
+
+    assert matcher.search(u'uSHErs this his') == [
+        (2, u'SHE'), (1, u'HE'), (1, u'HErs'), (2, u'his'),
+    ]
+
+
+def test_matcher_words_like_regex():
+    words = [u'bad', u'c++', u'o.o']
+    matcher = MultiMatcher([(word, None, True) for word in words])
+    regex = re.compile(u'({})'.format(u'|'.join(
+        u'\\b{}\\b'.format(re.escape(word)) for word in words)), re.I)
+
+    rand = random.Random(1)
+    for _ in range(500):
+        text = u''.join(rand.choice(u'bad c+o. _x') for _ in range(20))
+        assert sorted(w for _, w in matcher.search(text)) == sorted(regex.findall(text)), text
+
+
+def test_empty_matcher():
+    matcher = MultiMatcher([(u'', None, False)])
+    assert not matcher
+    assert matcher.search(string.ascii_letters) == []
+
+
+def test_matcher_expanding_lowercase():
+    # u'\u0130'.lower() is two characters long with full case mapping (python 3)
+    matcher = MultiMatcher([(u'bad', None, True), (u'x', None, False)])
+    assert matcher.search(u'\u0130\u0130 bad \u0130') == [(None, u'bad')]
+    assert matcher.search(u'\u0130bad\u0130X') == [(None, u'bad'), (None, u'X')]
+    assert matcher.search(u'\u0130\u0130xbad') == [(None, u'x')]
@@ -0,0 +1,27 @@
+from rowboat.util.ratelimit import RateLimitEngine, SlidingWindow
+
+
+def test_sliding_window_expires():
+    window = SlidingWindow(1000, slots=10)
+    window.add(0, 3)
+    window.add(500, 2)
+
+    assert window.count(500) == 5
+    assert window.size(500) == 0.5
+    assert window.count(1050) == 2
+    assert window.count(1600) == 0
+
+
+def test_engine_check():
+    engine = RateLimitEngine()
+    checks = [
+        (('guild', 'roles:*', 1, 'max_messages'), 1, 3, 1000),
+        (('guild', 'roles:*', 1, 'max_mentions'), 0, 3, 1000),
+    ]
+
+    assert [r[0] for r in engine.check(checks, now=0)] == [False, False]
+    assert [r[0] for r in engine.check(checks, now=100)] == [False, False]
+    assert [r[:2] for r in engine.check(checks, now=200)] == [(True, 3), (False, 0)]
+
+    # Once the window has passed the bucket is empty again
+    assert engine.check(checks, now=1500)[0][:2] == (False, 1)
@@ -0,0 +1,55 @@
+from gevent.monkey import patch_all
+patch_all()  # noqa: E402
+
+import json
+import gevent
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from rowboat.util.reddit import RedditClient
+
+LISTING = json.dumps({'data': {'children': [
+    {'data': {'name': 't3_2', 'created_utc': 2.0}},
+    {'data': {'name': 't3_1', 'created_utc': 1.0}},
+]}})
+
+
+class FakeRedditHandler(BaseHTTPRequestHandler):
+    requests = []
+
+    def do_GET(self):
+        self.requests.append((self.path, self.headers.get('If-None-Match')))
+
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('ETag', '"v1"')
+        self.end_headers()
+        self.wfile.write(LISTING)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_reddit_client_etag():
+    server = HTTPServer(('127.0.0.1', 0), FakeRedditHandler)
+    greenlet = gevent.spawn(server.serve_forever)
+
+    try:
+        client = RedditClient('http://127.0.0.1:{}'.format(server.server_port))
+
+        posts = client.get_new_posts('test')
+        assert [post['name'] for post in posts] == ['t3_1', 't3_2']
+
+        # The second request is conditional and nothing changed
+        assert client.get_new_posts('test') == []
+
+        assert [etag for _, etag in FakeRedditHandler.requests] == [None, '"v1"']
+        assert FakeRedditHandler.requests[0][0].startswith('/r/test/new.json')
+    finally:
+        server.shutdown()
+        greenlet.kill()
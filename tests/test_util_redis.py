@@ -4,7 +4,7 @@ import unittest
 from gevent import monkey; monkey.patch_all()
 
 from rowboat.redis import rdb
-from rowboat.util.redis import RedisSet
+from rowboat.util.redis import RedisSet, RedisHash
 
 
 class TestRedisSet(unittest.TestCase):
@@ -24,4 +24,44 @@ class TestRedisSet(unittest.TestCase):
 
         time.sleep(1)
 
-        self.assertEquals(s1._set, s2._set)
+        self.assertEquals(set(s1), set(s2))
+
+    def test_coerce(self):
+        rdb.delete('TESTING:test-set-int')
+        rdb.sadd('TESTING:test-set-int', '1')
+        s1 = RedisSet(rdb, 'TESTING:test-set-int', coerce=int)
+        s2 = RedisSet(rdb, 'TESTING:test-set-int', coerce=int)
+
+        s2.add(2)
+        time.sleep(1)
+
+        self.assertTrue(1 in s1)
+        self.assertTrue(2 in s1)
+        self.assertFalse('1' in s1)
+
+    def test_resync(self):
+        rdb.delete('TESTING:test-set-resync')
+        s1 = RedisSet(rdb, 'TESTING:test-set-resync')
+
+        # Writes which bypass the set are only seen after a resync
+        rdb.sadd('TESTING:test-set-resync', 'a')
+        self.assertFalse('a' in s1)
+        s1.resync()
+        self.assertTrue('a' in s1)
+
+
+class TestRedisHash(unittest.TestCase):
+    def test_basic_hash(self):
+        rdb.delete('TESTING:test-hash')
+        h1 = RedisHash(rdb, 'TESTING:test-hash', coerce=int, value_coerce=int)
+        h2 = RedisHash(rdb, 'TESTING:test-hash', coerce=int, value_coerce=int)
+
+        h1.set(1, 10)
+        h2.set('2', '20')
+        h1.set(3, 30)
+        h2.delete(3)
+
+        time.sleep(1)
+
+        self.assertEquals(dict(h1.items()), {1: 10, 2: 20})
+        self.assertEquals(dict(h1.items()), dict(h2.items()))
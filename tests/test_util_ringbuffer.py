@@ -0,0 +1,13 @@
+from rowboat.util.ringbuffer import TimedRingBuffer
+
+
+def test_ring_buffer():
+    buff = TimedRingBuffer(3, started=100)
+
+    for ts in range(101, 106):
+        buff.append(ts, timestamp=ts)
+
+    assert len(buff) == 3
+    assert buff.since(103) == [104, 105]
+    assert buff.covers(100)
+    assert not buff.covers(99)
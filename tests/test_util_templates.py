@@ -0,0 +1,35 @@
+import string
+
+from rowboat.util.templates import Template
+
+
+class Formatter(string.Formatter):
+    def convert_field(self, value, conversion):
+        return unicode(value)
+
+
+class Obj(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def __unicode__(self):
+        return u'obj'
+
+
+def test_template_matches_format():
+    details = {
+        'e': Obj(user=Obj(id=1234), name=u'general'),
+        'items': [u'a', u'b'],
+        'count': 5,
+    }
+
+    for fmt in [
+            u'{e.user!s} (`{e.user.id}`) left #{e.name}',
+            u'{items[1]} {count:>4} {{literal}}',
+            u'no fields']:
+        assert Template(fmt).render(**details) == Formatter().format(fmt, **details)
+
+
+def test_template_convert():
+    tmpl = Template(u'{a!z} {b}', convert=lambda value, conversion: u'<{}>'.format(value) if conversion else value)
+    assert tmpl.render(a=u'x', b=u'y') == u'<x> y'
@@ -0,0 +1,59 @@
+import unittest
+
+from rowboat.util.timerwheel import TimerWheel
+
+
+class TestTimerWheel(unittest.TestCase):
+    def test_expiry(self):
+        wheel = TimerWheel(slots=4, levels=2, now=1000)
+        wheel.add('a', 1002)
+        wheel.add('b', 1010)
+        wheel.add('c', 1100)
+
+        self.assertEquals(wheel.advance(1001), [])
+        self.assertEquals(wheel.advance(1002), ['a'])
+        self.assertEquals(wheel.advance(1009), [])
+        self.assertEquals(wheel.advance(1010), ['b'])
+        self.assertEquals(len(wheel), 1)
+
+        # Parked beyond the top level, and cascaded down when it wraps
+        self.assertEquals(wheel.advance(1099), [])
+        self.assertEquals(wheel.advance(1100), ['c'])
+        self.assertEquals(len(wheel), 0)
+
+    def test_remove(self):
+        wheel = TimerWheel(now=1000)
+        wheel.add('a', 1005)
+        wheel.add('b', 1005)
+        wheel.remove('a')
+        wheel.remove('missing')
+
+        self.assertFalse('a' in wheel)
+        self.assertEquals(wheel.advance(1010), ['b'])
+
+    def test_readd(self):
+        wheel = TimerWheel(now=1000)
+        wheel.add('a', 1005)
+        wheel.add('a', 1500)
+
+        self.assertEquals(wheel.advance(1005), [])
+        self.assertEquals(wheel.advance(1500), ['a'])
+
+    def test_past(self):
+        wheel = TimerWheel(now=1000)
+        wheel.add('a', 900)
+        self.assertEquals(wheel.advance(1001), ['a'])
+
+    def test_jump(self):
+        wheel = TimerWheel(slots=8, levels=3, now=0)
+        expires = {i: (i * 37) % 2000 + 1 for i in range(200)}
+        for key, at in expires.items():
+            wheel.add(key, at)
+
+        expired = {}
+        for now in range(0, 2100, 13):
+            for key in wheel.advance(now):
+                expired[key] = now
+
+        for key, at in expires.items():
+            self.assertTrue(at <= expired[key] < at + 13)
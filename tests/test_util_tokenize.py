@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+from rowboat.util.tokenize import tokenize, count_tokens
+
+
+def test_tokenize():
+    assert tokenize(u"Hello, World! It's 2017") == [u'hello', u'world', u"it's"]
+    assert tokenize(u'<@1234> check https://example.com/a?b=c <:kappa:1234>') == [u'check']
+    assert tokenize(u'Ünïcode wörds') == [u'ünïcode', u'wörds']
+    assert tokenize(u'a ' + u'x' * 40) == []
+    assert tokenize(None) == []
+
+
+def test_tokenize_stop_words():
+    assert tokenize(u'the cat and the hat', frozenset([u'the', u'and'])) == [u'cat', u'hat']
+    assert count_tokens(u'spam spam Spam eggs') == {u'spam': 3, u'eggs': 1}
@@ -0,0 +1,106 @@
+from gevent.monkey import patch_all
+patch_all()  # noqa: E402
+
+import gevent
+
+from rowboat.util.writebehind import WriteBehindBuffer
+
+
+def test_flush_on_interval():
+    batches = []
+    buff = WriteBehindBuffer('test', batches.append, interval=0.1, max_rows=100)
+
+    buff.put(1)
+    buff.put(2)
+    gevent.sleep(0.25)
+
+    assert batches == [[1, 2]]
+    buff.stop()
+
+
+def test_flush_on_max_rows():
+    batches = []
+    buff = WriteBehindBuffer('test', batches.append, interval=10, max_rows=3)
+
+    # Nothing yields while we put, so all items land in the first flush
+    for i in range(7):
+        buff.put(i)
+    gevent.sleep(0.05)
+
+    assert batches == [list(range(7))]
+    buff.stop()
+
+
+def test_backpressure_drops():
+    batches = []
+    buff = WriteBehindBuffer('test', batches.append, interval=10, max_rows=100, max_pending=2, block=False)
+
+    assert buff.put(1)
+    assert buff.put(2)
+    assert not buff.put(3)
+    assert buff.dropped == 1
+
+    buff.stop()
+    assert batches == [[1, 2]]
+
+
+def test_backpressure_blocks():
+    batches = []
+    buff = WriteBehindBuffer('test', batches.append, interval=10, max_rows=100, max_pending=2)
+
+    for i in range(5):
+        buff.put(i)
+
+    buff.stop()
+    assert sum(batches, []) == list(range(5))
+
+
+def test_failed_flush_retries():
+    batches = []
+
+    def flush(items):
+        if len(batches) < 2:
+            batches.append(None)
+            raise Exception('database is down')
+        batches.append(items)
+
+    buff = WriteBehindBuffer('test', flush, interval=10, max_rows=100, max_retries=2)
+    buff.put(1)
+    assert buff.flush() == 0
+
+    # Failed items stay in front of newer ones
+    buff.put(2)
+    assert buff.flush() == 0
+    assert buff.flush() == 2
+    assert batches[-1] == [1, 2]
+    buff.stop()
+
+
+def test_failed_flush_gives_up():
+    def flush(items):
+        raise Exception('bad batch')
+
+    buff = WriteBehindBuffer('test', flush, interval=10, max_rows=100, max_retries=1)
+    buff.put(1)
+    buff.flush()
+    assert len(buff) == 1
+    buff.flush()
+    assert len(buff) == 0
+    buff.stop()
+
+
+def test_pending_by_key():
+    def flush(items):
+        assert buff.pending('a') == [('a', 1), ('a', 2)]
+
+    buff = WriteBehindBuffer('test', flush, interval=10, max_rows=100, key_func=lambda item: item[0])
+    buff.put(('a', 1))
+    buff.put(('b', 1))
+    buff.put(('a', 2))
+    assert buff.pending('a') == [('a', 1), ('a', 2)]
+    assert buff.pending('c') == []
+
+    buff.flush()
+    assert buff.pending('a') == []
+    assert buff.pending('b') == []
+    buff.stop()